@@ -0,0 +1,146 @@
+"""
+Маршрутизация inline-кнопок: прежняя схема (шесть фильтров-лямбд со
+startswith, проверяемых по очереди, и split("_") в обработчике) против
+CallbackRouter (один поиск в словаре по коду действия).
+
+Сначала проверяет кодек callback_data: упаковка и разбор каждого действия,
+разбор кнопок старого формата и ограничение в 64 байта. При расхождении
+завершается с кодом 1. Обработчики заменены пустыми, чтобы мерить только выбор.
+
+Запуск из корня репозитория:
+    python -m bench.callback_routing --updates 20000
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from bench.env import prepare_env, silence_logs, BENCH_TOKEN
+
+prepare_env()
+
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+from bench.fake_telegram import callback_update, dumps
+from bot.callback_data import MAX_LENGTH
+from bot.handlers import VIEW_NOTE, EDIT_NOTE, DELETE_NOTE, HIDE_READ, NOTES_LIST, CANCEL_PURCHASE
+from bot.router import CallbackRouter
+
+
+USER_ID = 42
+BIG_ID = 2 ** 63 - 1
+
+# (действие, поля, старый формат той же кнопки)
+NO_CURSOR = {"after_note_id": None, "before_note_id": None}
+CASES = [
+    (VIEW_NOTE, {"note_id": 123456, **NO_CURSOR}, "view_note_123456"),
+    (EDIT_NOTE, {"note_id": 123456, **NO_CURSOR}, "edit_note_123456"),
+    (DELETE_NOTE, {"note_id": 123456, **NO_CURSOR}, "delete_note_123456"),
+    (NOTES_LIST, NO_CURSOR, "back_to_notes"),
+    (CANCEL_PURCHASE, {}, "cancel_purchase"),
+    (HIDE_READ, {"note_id": 123456}, "hide_read_123456"),
+]
+
+# Фильтры в том порядке, в котором они регистрировались раньше
+OLD_FILTERS = [
+    lambda call: call.data and call.data.startswith("view_note_"),
+    lambda call: call.data and call.data.startswith("edit_note_"),
+    lambda call: call.data and call.data.startswith("delete_note_"),
+    lambda call: call.data == "back_to_notes",
+    lambda call: call.data == "cancel_purchase",
+    lambda call: call.data and call.data.startswith("hide_read_"),
+]
+
+
+def check_codec() -> list[str]:
+    errors = []
+    router = CallbackRouter(None)
+    for action in (VIEW_NOTE, EDIT_NOTE, DELETE_NOTE, HIDE_READ, NOTES_LIST, CANCEL_PURCHASE):
+        router.register(action, action.code)
+
+    for action, values, legacy in CASES:
+        packed = action.pack(**values)
+        for data in (packed, legacy):
+            handler, decoded = router.resolve(data)
+            if handler != action.code or decoded != values:
+                errors.append(f"{data!r}: got {handler!r} {decoded}, expected {action.code!r} {values}")
+        print(f"{legacy:<20} -> {packed!r}")
+
+    # Кнопка послания с курсором страницы, с которой его открыли
+    values = {"note_id": 123456, "after_note_id": 777, "before_note_id": None}
+    handler, decoded = router.resolve(VIEW_NOTE.pack(**values))
+    if handler != VIEW_NOTE.code or decoded != values:
+        errors.append(f"{VIEW_NOTE.pack(**values)!r}: got {handler!r} {decoded}, expected {values}")
+
+    widest = VIEW_NOTE.pack(note_id=BIG_ID, after_note_id=BIG_ID, before_note_id=BIG_ID)
+    if len(widest.encode()) > MAX_LENGTH:
+        errors.append(f"{widest!r} is longer than {MAX_LENGTH} bytes")
+    for data in ("", "1x:1", "1v:zz:zz:zz:zz", "view_note_abc", "notes_next_77", "unknown"):
+        try:
+            resolved = router.resolve(data)
+        except ValueError:
+            resolved = None
+        if resolved is not None:
+            errors.append(f"{data!r} must not resolve, got {resolved}")
+    return errors
+
+
+async def noop(call, bot=None, **kwargs):
+    return None
+
+
+async def old_handler(call, bot=None):
+    # Прежние обработчики разбирали id сами
+    if call.data[-1].isdigit():
+        int(call.data.split("_")[-1])
+
+
+def build_filters_bot() -> AsyncTeleBot:
+    bot = AsyncTeleBot(BENCH_TOKEN)
+    for func in OLD_FILTERS:
+        bot.register_callback_query_handler(old_handler, func=func, pass_bot=True)
+    return bot
+
+
+def build_router_bot() -> AsyncTeleBot:
+    bot = AsyncTeleBot(BENCH_TOKEN)
+    router = CallbackRouter(bot)
+    for action in (VIEW_NOTE, EDIT_NOTE, DELETE_NOTE, NOTES_LIST, CANCEL_PURCHASE, HIDE_READ):
+        router.register(action, noop)
+    router.install()
+    return bot
+
+
+async def measure(bot: AsyncTeleBot, data: str, updates: int) -> float:
+    update = types.Update.de_json(dumps(callback_update(1, USER_ID, data)))
+    started = time.perf_counter()
+    for _ in range(updates):
+        await bot.process_new_updates([update])
+    return (time.perf_counter() - started) / updates * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000)
+    args = parser.parse_args()
+    silence_logs()
+
+    errors = check_codec()
+    for error in errors:
+        print(f"MISMATCH {error}")
+
+    filters_bot = build_filters_bot()
+    router_bot = build_router_bot()
+    print(f"\n{'button':<20} {'filters':>12} {'router':>12}")
+    for action, values, legacy in CASES:
+        old_cost = await measure(filters_bot, legacy, args.updates)
+        new_cost = await measure(router_bot, action.pack(**values), args.updates)
+        print(f"{legacy:<20} {old_cost:>9.1f} us {new_cost:>9.1f} us")
+
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+"""
+Микробенчмарк записи посланий: старый путь (SELECT + DELETE + INSERT,
+два коммита) против INSERT ... ON CONFLICT в crud.create_note.
+
+Половина записей перезаписывает уже существующие послания,
+как это бывает, когда автор правит послание через /note.
+
+Запуск из корня репозитория:
+    python -m bench.create_note --notes 2000
+"""
+import argparse
+import asyncio
+import time
+
+from bench.env import prepare_env, silence_logs
+
+prepare_env()
+
+from sqlalchemy import delete
+
+from db import crud
+from db.database import init_models, AsyncSessionLocal
+from db.models import Note
+
+
+AUTHOR_ID = 1
+
+
+async def run(create, notes: int, recipients: int) -> float:
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(Note))
+        await db.commit()
+
+        started = time.perf_counter()
+        for i in range(notes):
+            await create(db, for_user_id=10_000 + i % recipients, text=f"note {i}", created_by_user_id=AUTHOR_ID)
+        return notes / (time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=2000)
+    parser.add_argument("--recipients", type=int, default=None, help="по умолчанию notes/2")
+    args = parser.parse_args()
+    recipients = args.recipients or max(1, args.notes // 2)
+
+    silence_logs()
+    await init_models()
+    async with AsyncSessionLocal() as db:
+        await crud.add_user(db, AUTHOR_ID, "author", "Author", None)
+
+    before = await run(crud._create_note_without_upsert, args.notes, recipients)
+    after = await run(crud.create_note, args.notes, recipients)
+    print(f"delete+insert: {before:.0f} notes/s")
+    print(f"upsert:        {after:.0f} notes/s  (x{after / before:.2f})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,34 @@
+import logging
+import os
+import tempfile
+
+
+BENCH_TOKEN = "123456:BENCH-TOKEN"
+BENCH_ADMIN_ID = 1
+
+
+def prepare_env(database_url: str | None = None) -> str:
+    """
+    Заполняет переменные окружения, которые требует config.py.
+    Вызывать до импорта модулей бота. Если DATABASE_URL не задан,
+    используется временная SQLite-база. Возвращает итоговый DATABASE_URL.
+    """
+    if database_url is None:
+        database_url = os.getenv("BENCH_DATABASE_URL")
+    if database_url is None:
+        path = os.path.join(tempfile.mkdtemp(prefix="messages_bot_bench_"), "bench.db")
+        database_url = f"sqlite+aiosqlite:///{path}"
+
+    os.environ["TELEGRAM_TOKEN"] = BENCH_TOKEN
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["ADMIN_ID"] = str(BENCH_ADMIN_ID)
+    os.environ.setdefault("UPDATES_MODE", "polling")
+    return database_url
+
+
+def silence_logs() -> None:
+    """
+    Глушит логи бота и telebot, чтобы запись в bot.log не искажала замеры.
+    """
+    logging.getLogger("bot").setLevel(logging.WARNING)
+    logging.getLogger("TeleBot").setLevel(logging.WARNING)
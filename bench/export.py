@@ -0,0 +1,163 @@
+"""
+Выгрузка /export: память и скорость на таблицах разного размера.
+
+В базу добавляются авторы, получатели, --notes посланий и --notes / 10
+платежей, затем db.export.export_tables выгружает таблицы в CSV и JSONL
+сначала на десятой части данных, потом на всех. Для каждого прогона
+выводятся строки в секунду, размер архива и пик памяти Python (tracemalloc):
+при потоковой выгрузке пик не должен расти вместе с таблицами.
+Архивы распаковываются и сверяются с базой по числу строк. В конце /export
+прогоняется через настоящий обработчик и фейковый Bot API.
+
+Если число строк не сошлось, пик памяти вырос больше чем вдвое
+или документ не дошёл до Telegram, код выхода 1.
+
+Запуск из корня репозитория:
+    python -m bench.export --notes 100000
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+from bench.env import prepare_env, silence_logs, BENCH_TOKEN, BENCH_ADMIN_ID
+
+prepare_env()
+
+from sqlalchemy import func, insert, select, delete
+from telebot import types
+
+from bench.fake_telegram import FakeTelegramServer, message_update, dumps
+from bot.handlers import register_handlers
+from bot.sender import RateLimitedTeleBot, OutboundSender
+from db import crud
+from db.database import init_models, AsyncSessionLocal
+from db.export import export_tables, EXPORT_TABLES
+from db.models import User, Note, Payment
+from db.registrations import new_user_values
+
+
+AUTHORS = 100
+READER_BASE = 1_000_000
+
+
+async def fill(notes: int) -> None:
+    async with AsyncSessionLocal() as db:
+        for table in (Payment, Note, User):
+            await db.execute(delete(table))
+        await db.execute(insert(User), [new_user_values(user_id, None, f"Author {user_id}", None) for user_id in range(1, AUTHORS + 1)])
+        for start in range(0, notes, 10_000):
+            numbers = range(start, min(start + 10_000, notes))
+            await db.execute(insert(User), [new_user_values(READER_BASE + number, f"reader{number}", "Reader", None) for number in numbers])
+            await db.execute(insert(Note), [
+                {"for_user_id": READER_BASE + number, "created_by_user_id": number % AUTHORS + 1,
+                 "text": f"Послание номер {number}, \"с кавычками\", запятыми и\nпереводом строки"}
+                for number in numbers
+            ])
+            await db.execute(insert(Payment), [
+                {"telegram_payment_charge_id": f"charge-{number}", "user_id": READER_BASE + number, "quantity": 1, "total_amount": 100}
+                for number in numbers if number % 10 == 0
+            ])
+        await db.commit()
+
+
+def count_exported(path: str, file_format: str) -> dict:
+    counts = {}
+    with zipfile.ZipFile(path) as archive:
+        for name in EXPORT_TABLES:
+            with archive.open(f"{name}.{file_format}") as member:
+                text = io.TextIOWrapper(member, encoding="utf-8", newline="")
+                if file_format == "csv":
+                    counts[name] = sum(1 for _ in csv.reader(text)) - 1
+                else:
+                    counts[name] = sum(1 for line in text if json.loads(line))
+    return counts
+
+
+async def run_export(file_format: str) -> dict:
+    path = os.path.join(tempfile.mkdtemp(prefix="messages_bot_export_"), f"export.{file_format}.zip")
+    started = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        counts = await export_tables(db, path, file_format)
+    elapsed = time.perf_counter() - started
+    # Память - отдельным прогоном: tracemalloc в разы замедляет выгрузку
+    tracemalloc.start()
+    async with AsyncSessionLocal() as db:
+        await export_tables(db, path, file_format)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"counts": counts, "elapsed": elapsed, "peak": peak, "size": os.path.getsize(path),
+            "archived": count_exported(path, file_format)}
+
+
+async def table_counts() -> dict:
+    async with AsyncSessionLocal() as db:
+        return {name: (await db.execute(select(func.count()).select_from(table))).scalar_one()
+                for name, table in EXPORT_TABLES.items()}
+
+
+async def export_via_bot(api_port: int) -> list[str]:
+    async with AsyncSessionLocal() as db:
+        await crud.initiate_creation_of_admin_panel(db, BENCH_ADMIN_ID, 0, 0)
+    api = FakeTelegramServer(port=api_port)
+    await api.start()
+    bot = RateLimitedTeleBot(BENCH_TOKEN, parse_mode='HTML', sender=OutboundSender(global_rate=1000, chat_rate=100, chat_burst=100))
+    register_handlers(bot)
+    try:
+        await bot.process_new_updates([types.Update.de_json(dumps(message_update(1, BENCH_ADMIN_ID, "/export jsonl")))])
+        await bot.sender.stop()
+    finally:
+        await bot.close_session()
+        await api.stop()
+
+    documents = [sent for sent in api.sent if sent["method"] == "sendDocument"]
+    if not documents:
+        return ["/export did not send a document"]
+    document = documents[0]["document"]
+    print(f"/export jsonl: sent {document.filename}, caption «{documents[0].get('caption')}»")
+    return []
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=100_000)
+    parser.add_argument("--api-port", type=int, default=8088)
+    args = parser.parse_args()
+
+    silence_logs()
+    await init_models()
+    errors = []
+    peaks = {}
+    for notes in (args.notes // 10, args.notes):
+        await fill(notes)
+        expected = await table_counts()
+        for file_format in ("csv", "jsonl"):
+            result = await run_export(file_format)
+            rows = sum(result["counts"].values())
+            peaks.setdefault(file_format, []).append(result["peak"])
+            print(f"{file_format:<5} {rows:>8} rows in {result['elapsed']:.2f}s ({rows / result['elapsed']:.0f} rows/s), "
+                  f"archive {result['size'] / 1024 / 1024:.1f} MB, peak memory {result['peak'] / 1024 / 1024:.1f} MB")
+            if result["counts"] != expected or result["archived"] != expected:
+                errors.append(f"{file_format} export counted {result['counts']}, archive has {result['archived']}, expected {expected}")
+
+    for file_format, (small, large) in peaks.items():
+        if large > 2 * small:
+            errors.append(f"{file_format} peak memory grew from {small} to {large} bytes with 10x more rows")
+
+    errors += await export_via_bot(args.api_port)
+    for error in errors:
+        print(f"FAIL {error}")
+    if errors:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
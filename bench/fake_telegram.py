@@ -0,0 +1,227 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, deque
+from typing import Optional
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+from telebot import asyncio_helper
+
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "BenchBot", "username": "bench_bot"}
+
+
+class FakeTelegramServer:
+    """
+    Локальная подделка Telegram Bot API.
+    Отвечает на методы, которые вызывает бот, считает вызовы
+    и может имитировать сетевую задержку через latency (в секундах).
+    global_limit и chat_limit включают флуд-контроль: больше стольких сообщений
+    за секунду на весь бот или в один чат получают 429 с retry_after.
+    Апдейты, положенные через push_update, отдаются боту через getUpdates
+    (с long polling, как у Telegram).
+    """
+
+    # Методы, на которые распространяется флуд-контроль
+    FLOOD_METHODS = ("sendMessage", "editMessageText", "sendInvoice", "sendDocument")
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8082, latency: float = 0.0,
+                 global_limit: Optional[int] = None, chat_limit: Optional[int] = None, retry_after: int = 1):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.flooded: Counter = Counter()
+        self.sent: list[dict] = []
+        # chat_id -> параметры последнего отправленного в чат сообщения
+        self.last_sent: dict[int, dict] = {}
+        self._updates: deque = deque()
+        self._updates_ready = asyncio.Event()
+        self._global_window: deque = deque()
+        self._chat_windows: dict[int, deque] = {}
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def api_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot{{0}}/{{1}}"
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    def _result(self, method: str, params: dict):
+        if method in ("sendMessage", "editMessageText", "sendInvoice", "sendDocument"):
+            self.sent.append({"method": method, **params})
+            self.last_sent[int(params.get("chat_id") or 0)] = params
+            return self._message(params)
+        if method == "getMe":
+            return BOT_USER
+        return True
+
+    def push_update(self, update: dict) -> None:
+        """
+        Кладёт апдейт в очередь getUpdates. update_id должны возрастать.
+        """
+        self._updates.append(update)
+        self._updates_ready.set()
+
+    async def _get_updates(self, params: dict) -> list:
+        # Апдейты до offset бот уже получил
+        offset = int(params.get("offset") or 0)
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        timeout = float(params.get("timeout") or 0)
+        if not self._updates and timeout:
+            self._updates_ready.clear()
+            try:
+                await asyncio.wait_for(self._updates_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, int(params.get("limit") or 100)))
+
+    @staticmethod
+    def _over_limit(window: deque, limit: Optional[int], now: float) -> bool:
+        while window and window[0] <= now - 1:
+            window.popleft()
+        return limit is not None and len(window) >= limit
+
+    def _flood(self, method: str, params: dict) -> bool:
+        if method not in self.FLOOD_METHODS:
+            return False
+        now = time.monotonic()
+        chat_window = self._chat_windows.setdefault(int(params.get("chat_id") or 0), deque())
+        if self._over_limit(self._global_window, self.global_limit, now) or self._over_limit(chat_window, self.chat_limit, now):
+            return True
+        self._global_window.append(now)
+        chat_window.append(now)
+        return False
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.method == "POST":
+            params.update(await request.post())
+        elif request.can_read_body:
+            # telebot шлёт getUpdates и прочие GET-запросы с параметрами в теле
+            params.update(parse_qsl(await request.text()))
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._flood(method, params):
+            self.flooded[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def start(self) -> None:
+        # Документы (выгрузка /export) больше 1 МБ, которые aiohttp принимает по умолчанию
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        # Все запросы AsyncTeleBot теперь идут в локальный сервер
+        asyncio_helper.API_URL = self.api_url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    """
+    Апдейт с текстовым сообщением от пользователя user_id в личном чате.
+    Команды (/start и т.п.) размечаются entity bot_command, как это делает Telegram.
+    """
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> dict:
+    """
+    Апдейт с нажатием inline-кнопки с callback_data=data.
+    """
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "",
+            },
+        },
+    }
+
+
+def pre_checkout_update(update_id: int, user_id: int, payload: str, total_amount: int) -> dict:
+    """
+    Апдейт с pre_checkout_query перед оплатой счёта в звёздах.
+    """
+    return {
+        "update_id": update_id,
+        "pre_checkout_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "currency": "XTR",
+            "total_amount": total_amount,
+            "invoice_payload": payload,
+        },
+    }
+
+
+def payment_update(update_id: int, user_id: int, payload: str, total_amount: int, charge_id: str) -> dict:
+    """
+    Апдейт с сообщением successful_payment после оплаты счёта в звёздах.
+    """
+    update = message_update(update_id, user_id, "")
+    del update["message"]["text"]
+    update["message"]["successful_payment"] = {
+        "currency": "XTR",
+        "total_amount": total_amount,
+        "invoice_payload": payload,
+        "telegram_payment_charge_id": charge_id,
+        "provider_payment_charge_id": charge_id,
+    }
+    return update
+
+
+def dumps(update: dict) -> str:
+    return json.dumps(update, ensure_ascii=False)
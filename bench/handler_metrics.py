@@ -0,0 +1,110 @@
+"""
+Проверка метрик обработчиков: прогоняет через настоящие обработчики переходы
+по ссылке /myref и нажатия кнопок, затем забирает /metrics с сервера метрик
+и сводку из /admin.
+
+Проверяется, что у каждого вызова обработчика посчитаны время, SQL-запросы
+(из событий engine) и время запросов к Telegram (из трассировки aiohttp,
+включая запросы, отправленные через очередь OutboundSender). Если что-то
+не сошлось - код выхода 1.
+
+Запуск из корня репозитория:
+    python -m bench.handler_metrics --readers 200 --clicks 50
+"""
+import argparse
+import asyncio
+import re
+import sys
+
+from bench.env import prepare_env, silence_logs, BENCH_TOKEN, BENCH_ADMIN_ID
+
+prepare_env()
+
+import aiohttp
+from telebot import types
+
+from bench.fake_telegram import FakeTelegramServer, message_update, callback_update, dumps
+from bot import metrics
+from bot.handlers import register_handlers, NOTES_LIST
+from bot.sender import RateLimitedTeleBot, OutboundSender
+from db import crud
+from db.database import init_models, AsyncSessionLocal, engine
+
+
+CREATOR_ID = 500
+
+
+async def prepare() -> str:
+    async with AsyncSessionLocal() as db:
+        await crud.initiate_creation_of_admin_panel(db, BENCH_ADMIN_ID, 0, 0)
+        await crud.create_or_update_user(db, user_id=CREATOR_ID, username="creator", first_name="Creator")
+        return await crud.create_new_ref_code(db, CREATOR_ID)
+
+
+def sample(text: str, name: str, label: str) -> float:
+    match = re.search(rf'^{name}{{[^}}]*="{label}"}} (\S+)$', text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=200)
+    parser.add_argument("--clicks", type=int, default=50)
+    parser.add_argument("--api-latency", type=float, default=0.01)
+    parser.add_argument("--api-port", type=int, default=8085)
+    parser.add_argument("--metrics-port", type=int, default=9102)
+    args = parser.parse_args()
+
+    silence_logs()
+    metrics.instrument_engine(engine.sync_engine)
+    metrics.instrument_telegram()
+    await init_models()
+    ref_code = await prepare()
+
+    api = FakeTelegramServer(port=args.api_port, latency=args.api_latency)
+    await api.start()
+    runner = await metrics.start_metrics_server("127.0.0.1", args.metrics_port)
+    bot = RateLimitedTeleBot(BENCH_TOKEN, parse_mode='HTML', sender=OutboundSender(global_rate=1000, chat_rate=100, chat_burst=100))
+    register_handlers(bot)
+
+    async def process(update: dict) -> None:
+        await bot.process_new_updates([types.Update.de_json(dumps(update))])
+
+    try:
+        await asyncio.gather(
+            *(process(message_update(number, 10000 + number, f"/start {ref_code}")) for number in range(args.readers)),
+            *(process(callback_update(20000 + number, 30000 + number, NOTES_LIST.pack())) for number in range(args.clicks)),
+        )
+        await process(message_update(99999, BENCH_ADMIN_ID, "/admin"))
+        await bot.sender.stop()
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{args.metrics_port}/metrics") as response:
+                exposition = await response.text()
+    finally:
+        await bot.close_session()
+        await runner.cleanup()
+        await api.stop()
+
+    expected = {"handle_start": args.readers, "handle_back_to_notes_callback": args.clicks, "handle_admin": 1}
+    failed = False
+    for handler, calls in expected.items():
+        count = sample(exposition, "bot_handler_seconds_count", handler)
+        statements = sample(exposition, "bot_handler_sql_statements_sum", handler)
+        telegram = sample(exposition, "bot_handler_telegram_seconds_sum", handler)
+        ok = count == calls and statements > 0 and telegram > 0
+        failed = failed or not ok
+        print(f"{handler:<32} calls={count:>5.0f}/{calls:<5} statements/call={statements / max(count, 1):>5.2f}  "
+              f"telegram/call={telegram / max(count, 1) * 1000:>6.1f} ms  {'ok' if ok else 'MISMATCH'}")
+
+    api_calls = sample(exposition, "bot_telegram_api_seconds_count", "sendMessage")
+    print(f"sendMessage requests timed: {api_calls:.0f}, sent by fake API: {api.calls['sendMessage']}")
+    failed = failed or api_calls != api.calls["sendMessage"]
+
+    admin_reply = next(message["text"] for message in api.sent if int(message["chat_id"]) == BENCH_ADMIN_ID)
+    print("\n/admin:\n" + admin_reply[admin_reply.find("⏱"):])
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""
+Сколько стоит одна запись в лог для потока event loop:
+прежняя схема (FileHandler и StreamHandler пишут прямо в вызывающем потоке)
+против очереди global_logger (в потоке loop только подстановка аргументов).
+Отдельно - стоимость отключённого уровня с f-строкой и с %-аргументами.
+
+Логи пишутся во временный файл, консоль заменена на /dev/null.
+--disk-latency добавляет задержку к каждой записи в файл, как у медленного
+или сетевого диска: при прежней схеме её целиком ждёт event loop.
+
+Запуск из корня репозитория:
+    python -m bench.logging_overhead --records 20000
+    python -m bench.logging_overhead --records 2000 --disk-latency 0.0005
+"""
+import argparse
+import logging
+import logging.handlers
+import os
+import queue
+import tempfile
+import time
+
+from bench.env import prepare_env
+
+prepare_env()
+
+from global_logger import LoopQueueHandler, ContextFilter
+
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class SlowFileHandler(logging.FileHandler):
+    latency = 0.0
+
+    def emit(self, record):
+        super().emit(record)
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def sync_logger(path: str, devnull) -> logging.Logger:
+    logger = logging.getLogger("bench.sync")
+    logger.propagate = False
+    formatter = logging.Formatter(FORMAT, datefmt='%H:%M:%S')
+    for handler in (SlowFileHandler(path, encoding='utf-8'), logging.StreamHandler(devnull)):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def queued_logger(path: str, devnull) -> tuple[logging.Logger, logging.handlers.QueueListener]:
+    logger = logging.getLogger("bench.queued")
+    logger.propagate = False
+    formatter = logging.Formatter(FORMAT, datefmt='%H:%M:%S')
+    handlers = [SlowFileHandler(path, encoding='utf-8'), logging.StreamHandler(devnull)]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = LoopQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    logger.addHandler(queue_handler)
+    logger.setLevel(logging.INFO)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return logger, listener
+
+
+def measure(call, records: int) -> float:
+    started = time.perf_counter()
+    for number in range(records):
+        call(number)
+    return (time.perf_counter() - started) / records * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--disk-latency", type=float, default=0.0, help="задержка записи в файл, сек")
+    args = parser.parse_args()
+    SlowFileHandler.latency = args.disk_latency
+
+    directory = tempfile.mkdtemp(prefix="messages_bot_logs_")
+    with open(os.devnull, "w") as devnull:
+        old = sync_logger(os.path.join(directory, "sync.log"), devnull)
+        new, listener = queued_logger(os.path.join(directory, "queued.log"), devnull)
+        note = {"id": 42, "text": "x" * 200}
+
+        results = {
+            "sync handlers, info": measure(lambda n: old.info(f"User {n} viewing note {note['id']}"), args.records),
+            "queue, info": measure(lambda n: new.info("User %s viewing note %s", n, note['id']), args.records),
+            "disabled debug, f-string": measure(lambda n: new.debug(f"User {n} note {note}"), args.records),
+            "disabled debug, %-args": measure(lambda n: new.debug("User %s note %s", n, note), args.records),
+        }
+        listener.stop()
+
+    for name, cost in results.items():
+        print(f"{name:<28} {cost:>7.2f} us per call on the loop thread")
+
+
+if __name__ == "__main__":
+    main()
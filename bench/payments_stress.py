@@ -0,0 +1,97 @@
+"""
+Стресс-проверка обработки платежей: сотни одновременных successful_payment,
+часть из которых приходит повторно с тем же telegram_payment_charge_id.
+
+Каждый платеж обрабатывается в своей сессии, как отдельный апдейт.
+В конце сверяются балансы пользователей и статистика админ-панели:
+повторы не должны начисляться, а параллельные начисления не должны теряться.
+При расхождении скрипт завершается с кодом 1.
+
+Запуск из корня репозитория:
+    python -m bench.payments_stress --payments 300 --duplicates 2
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from bench.env import prepare_env, silence_logs, BENCH_ADMIN_ID
+
+prepare_env()
+
+from sqlalchemy import func, select
+
+from db import crud
+from db.database import init_models, AsyncSessionLocal
+from db.models import Payment
+
+
+QUANTITY = 3
+COST = 10
+
+
+async def pay(user_id: int, charge_id: str) -> bool:
+    async with AsyncSessionLocal() as db:
+        _, _, credited = await crud.process_payment(db, user_id, QUANTITY, QUANTITY * COST, charge_id)
+        return credited
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payments", type=int, default=300, help="уникальных платежей")
+    parser.add_argument("--duplicates", type=int, default=2, help="сколько раз приходит каждый платеж")
+    parser.add_argument("--users", type=int, default=20)
+    args = parser.parse_args()
+
+    silence_logs()
+    await init_models()
+    user_ids = [10_000 + i for i in range(args.users)]
+    async with AsyncSessionLocal() as db:
+        await crud.add_user(db, BENCH_ADMIN_ID, "admin", "Admin", None)
+        await crud.initiate_creation_of_admin_panel(db, BENCH_ADMIN_ID)
+        for user_id in user_ids:
+            await crud.add_user(db, user_id, None, f"User{user_id}", None)
+        before_users = {user_id: (await crud.get_user_by_id(db, user_id)).count_read_cancel for user_id in user_ids}
+        before_panel = await crud.get_admin_panel(db)
+        before_earnings, before_sold = before_panel.total_earnings, before_panel.total_read_cancels_sold
+
+    payments = [(user_ids[i % args.users], f"bench-{time.time_ns()}-{i}") for i in range(args.payments)]
+    calls = [payment for payment in payments for _ in range(args.duplicates)]
+    random.shuffle(calls)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(pay(user_id, charge_id) for user_id, charge_id in calls))
+    elapsed = time.perf_counter() - started
+
+    expected_per_user = {user_id: 0 for user_id in user_ids}
+    for user_id, _ in payments:
+        expected_per_user[user_id] += QUANTITY
+
+    errors = []
+    async with AsyncSessionLocal() as db:
+        for user_id in user_ids:
+            user = await crud.get_user_by_id(db, user_id)
+            gained = user.count_read_cancel - before_users[user_id]
+            if gained != expected_per_user[user_id]:
+                errors.append(f"user {user_id}: +{gained}, expected +{expected_per_user[user_id]}")
+        panel = await crud.get_admin_panel(db)
+        if panel.total_earnings - before_earnings != args.payments * QUANTITY * COST:
+            errors.append(f"total_earnings: +{panel.total_earnings - before_earnings}, expected +{args.payments * QUANTITY * COST}")
+        if panel.total_read_cancels_sold - before_sold != args.payments * QUANTITY:
+            errors.append(f"total_read_cancels_sold: +{panel.total_read_cancels_sold - before_sold}, expected +{args.payments * QUANTITY}")
+        recorded = (await db.execute(select(func.count()).select_from(Payment).where(Payment.telegram_payment_charge_id.like("bench-%")))).scalar_one()
+
+    print(f"{len(calls)} successful_payment updates in {elapsed:.2f}s ({len(calls) / elapsed:.0f}/s), "
+          f"credited {sum(results)}, ignored as duplicates {len(results) - sum(results)}, payments rows {recorded}")
+    if sum(results) != args.payments:
+        errors.append(f"credited {sum(results)} payments, expected {args.payments}")
+    for error in errors:
+        print(f"FAIL {error}")
+    if errors:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+"""
+Проверка количества SQL-запросов, которые выполняет каждая функция db/crud.py.
+
+Сценарии запускаются с пустыми кэшами пользователей и посланий, кроме помеченных
+как cached: перед ними кэш заполняется тем же вызовом.
+Для каждого сценария указано ожидаемое число запросов; если фактическое
+отличается, скрипт печатает расхождения и завершается с кодом 1, так что
+его можно запускать в CI как регрессионную проверку.
+
+Запуск из корня репозитория:
+    python -m bench.query_counts
+"""
+import asyncio
+import sys
+
+from bench.env import prepare_env, silence_logs
+
+prepare_env()
+
+from sqlalchemy import event
+
+from db import crud
+from db.cache import users_cache, ref_codes_cache, notes_cache
+from db.database import init_models, AsyncSessionLocal, engine
+from db.rollups import rollups
+
+
+class StatementCounter:
+    """
+    Считает SQL-запросы, которые engine отправляет в базу.
+    """
+
+    def __init__(self, sync_engine):
+        self.count = 0
+        self.statements: list[str] = []
+        event.listen(sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def reset(self) -> None:
+        self.count = 0
+        self.statements.clear()
+
+
+AUTHOR_ID = 1
+READER_ID = 2
+
+
+async def main():
+    silence_logs()
+    await init_models()
+    counter = StatementCounter(engine.sync_engine)
+    # Счётчики /stats пишутся в фоне; здесь - только явно, в своём сценарии
+    rollups.interval = 3600
+
+    async with AsyncSessionLocal() as db:
+        await crud.initiate_creation_of_admin_panel(db, AUTHOR_ID)
+        author = await crud.add_user(db, AUTHOR_ID, "author", "Author", None)
+        await crud.add_user(db, READER_ID, "reader", "Reader", None)
+        note = await crud.create_note(db, READER_ID, "hello", AUTHOR_ID)
+        reader = await crud.get_user_by_id(db, READER_ID)
+
+        async def read_by_link():
+            # То же, что делает handle_start при переходе по ссылке
+            await crud.create_or_update_user(db, READER_ID, "reader", "Reader", "Renamed")
+            creator = await crud.get_user_by_ref_code(db, author.ref_code)
+            note = await crud.get_note_for_reader(db, READER_ID, creator.user_id)
+            await crud.mark_note_as_read(db, note)
+
+        # (название, вызов, ожидаемое число запросов)
+        scenarios = [
+            ("get_user_by_id", lambda: crud.get_user_by_id(db, READER_ID), 1),
+            ("get_user_by_id (cached)", lambda: crud.get_user_by_id(db, READER_ID), 0),
+            ("add_user (new)", lambda: crud.add_user(db, 100, "new", "New", None), 2),
+            ("add_user (existing)", lambda: crud.add_user(db, READER_ID, "reader", "Reader", None), 1),
+            ("create_or_update_user (unchanged)", lambda: crud.create_or_update_user(db, READER_ID, "reader", "Reader", None), 1),
+            ("create_or_update_user (unchanged, cached)", lambda: crud.create_or_update_user(db, READER_ID, "reader", "Reader", None), 0),
+            ("create_or_update_user (renamed)", lambda: crud.create_or_update_user(db, READER_ID, "reader", "Reader", "Renamed"), 2),
+            ("create_or_update_user (new)", lambda: crud.create_or_update_user(db, 101, "new", "New", None), 2),
+            ("get_user_by_ref_code", lambda: crud.get_user_by_ref_code(db, reader.ref_code), 1),
+            ("get_user_by_ref_code (cached)", lambda: crud.get_user_by_ref_code(db, reader.ref_code), 0),
+            ("create_new_ref_code", lambda: crud.create_new_ref_code(db, READER_ID), 2),
+            ("create_note", lambda: crud.create_note(db, READER_ID, "hello again", AUTHOR_ID), 1),
+            ("get_note_id", lambda: crud.get_note_id(db, AUTHOR_ID, READER_ID), 1),
+            ("get_note_by_id", lambda: crud.get_note_by_id(db, note.id), 1),
+            ("get_note_by_user_id_and_creator_id", lambda: crud.get_note_by_user_id_and_creator_id(db, READER_ID, AUTHOR_ID), 1),
+            ("update_note_text", lambda: crud.update_note_text(db, note.id, "edited"), 1),
+            ("mark_note_as_read", lambda: crud.mark_note_as_read(db, note), 1),
+            ("mark_note_as_read (already read)", lambda: crud.mark_note_as_read(db, note), 0),
+            ("get_note_for_reader", lambda: crud.get_note_for_reader(db, READER_ID, AUTHOR_ID), 1),
+            ("get_note_for_reader (cached)", lambda: crud.get_note_for_reader(db, READER_ID, AUTHOR_ID), 0),
+            ("get_note_for_reader (no note, cached)", lambda: crud.get_note_for_reader(db, AUTHOR_ID, READER_ID), 0),
+            ("read by link", read_by_link, 3),
+            ("read by link (cached)", read_by_link, 0),
+            ("count_notes_by_user_id", lambda: crud.count_notes_by_user_id(db, AUTHOR_ID), 1),
+            ("get_notes_page", lambda: crud.get_notes_page(db, AUTHOR_ID, 10), 1),
+            ("get_admin_panel", lambda: crud.get_admin_panel(db), 1),
+            ("update_user_balance", lambda: crud.update_user_balance(db, READER_ID, 1), 1),
+            ("update_admin_panel", lambda: crud.update_admin_panel(db, 10, 1), 1),
+            ("process_payment", lambda: crud.process_payment(db, READER_ID, 1, 10, "charge-1"), 3),
+            ("process_payment (duplicate)", lambda: crud.process_payment(db, READER_ID, 1, 10, "charge-1"), 3),
+            ("spend_read_cancel", lambda: crud.spend_read_cancel(db, READER_ID, note.id), 2),
+            ("spend_read_cancel (already hidden)", lambda: crud.spend_read_cancel(db, READER_ID, note.id), 1),
+            ("mark_note_as_read (after hiding)", lambda: crud.mark_note_as_read(db, note), 1),
+            ("spend_read_cancel (no cancels)", lambda: crud.spend_read_cancel(db, AUTHOR_ID, note.id), 1),
+            ("get_daily_stats (with pending counters)", lambda: crud.get_daily_stats(db, 30), 3),
+            ("get_daily_stats", lambda: crud.get_daily_stats(db, 30), 1),
+            ("get_top_creators", lambda: crud.get_top_creators(db, 5), 1),
+            ("delete_note_by_id", lambda: crud.delete_note_by_id(db, note.id), 1),
+            ("get_note_for_reader (deleted, cached)", lambda: crud.get_note_for_reader(db, READER_ID, AUTHOR_ID), 0),
+        ]
+
+        failures = []
+        for name, call, expected in scenarios:
+            if "cached" in name:
+                await call()
+            else:
+                users_cache.clear()
+                ref_codes_cache.clear()
+                notes_cache.clear()
+            counter.reset()
+            await call()
+            mark = "ok" if counter.count == expected else "FAIL"
+            print(f"{mark:>4}  {name:<42} {counter.count} (expected {expected})")
+            if counter.count != expected:
+                failures.append((name, list(counter.statements)))
+
+    for name, statements in failures:
+        print(f"\n{name}:")
+        for statement in statements:
+            print(f"    {' '.join(statement.split())}")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
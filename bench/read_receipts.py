@@ -0,0 +1,97 @@
+"""
+Отметки о прочтении во время всплеска переходов по ссылкам:
+READ_RECEIPTS_MODE=sync (коммит на каждое прочтение) против buffered
+(отметки копятся и пишутся одним UPDATE на пачку).
+
+Каждый читатель в своей сессии делает то же, что handle_start:
+находит послание и помечает его прочитанным. После остановки буфера
+проверяется, что в базе прочитаны все послания; если нет - код выхода 1.
+
+Запуск из корня репозитория:
+    python -m bench.read_receipts --readers 2000 --concurrency 100
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from bench.env import prepare_env, silence_logs
+
+prepare_env()
+
+from sqlalchemy import event, func, select, update
+
+from db import crud
+from db.cache import notes_cache
+from db.database import init_models, AsyncSessionLocal, engine
+from db.models import Note
+from db.read_receipts import read_receipts
+
+
+AUTHOR_ID = 1
+
+
+async def prepare(readers: int) -> None:
+    async with AsyncSessionLocal() as db:
+        await crud.add_user(db, AUTHOR_ID, "author", "Author", None)
+        for number in range(readers):
+            await crud.create_note(db, 10_000 + number, f"note {number}", AUTHOR_ID)
+
+
+async def run(buffered: bool, readers: int, concurrency: int) -> dict:
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(Note).values(is_read=False, fake_is_read=False))
+        await db.commit()
+    notes_cache.clear()
+    read_receipts.enabled = buffered
+
+    updates = 0
+
+    def count_updates(conn, cursor, statement, parameters, context, executemany):
+        nonlocal updates
+        if statement.lstrip().upper().startswith("UPDATE"):
+            updates += 1
+
+    event.listen(engine.sync_engine, "before_cursor_execute", count_updates)
+    limiter = asyncio.Semaphore(concurrency)
+
+    async def read(number: int):
+        async with limiter:
+            async with AsyncSessionLocal() as db:
+                note = await crud.get_note_for_reader(db, 10_000 + number, AUTHOR_ID)
+                await crud.mark_note_as_read(db, note)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(read(number) for number in range(readers)))
+    served = time.perf_counter() - started
+    await read_receipts.stop()
+    elapsed = time.perf_counter() - started
+    event.remove(engine.sync_engine, "before_cursor_execute", count_updates)
+
+    async with AsyncSessionLocal() as db:
+        unread = (await db.execute(select(func.count()).select_from(Note).where(Note.is_read == False))).scalar_one()
+    return {"served": served, "elapsed": elapsed, "updates": updates, "unread": unread}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременно обрабатываемых переходов")
+    args = parser.parse_args()
+
+    silence_logs()
+    await init_models()
+    await prepare(args.readers)
+
+    failed = False
+    for mode, buffered in (("sync", False), ("buffered", True)):
+        result = await run(buffered, args.readers, args.concurrency)
+        print(f"{mode:<9} {args.readers / result['served']:>8.0f} reads/s  UPDATE statements={result['updates']:>5}  "
+              f"total with final flush={result['elapsed']:.2f}s  unread after stop={result['unread']}")
+        failed = failed or result["unread"] > 0
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,264 @@
+"""
+Регистрация пользователей и реферальные коды.
+
+1. Кодирование: скорость id_to_ref_code, обратимость и отсутствие
+   коллизий на --codes случайных user_id.
+2. Регистрация: --users новых пользователей нажимают /start, каждый в своей
+   сессии (как handle_start). Тот же поток проходит через прежнюю схему
+   (MD5 от user_id и SELECT по ref_code перед каждой вставкой), через
+   REGISTRATIONS_MODE=sync и через buffered (многострочный INSERT на пачку).
+   Выводятся регистрации в секунду, SQL-запросов и коммитов на регистрацию.
+3. Перевыпуск: часть пользователей получает старые MD5-коды, затем
+   db.ref_codes.rewrite_ref_codes заменяет только их, а --rotate - все.
+4. Импорт: db.import_users загружает выгрузки CSV и JSONL, в которых часть
+   пользователей уже есть в базе, а часть записей неполная. Коды и балансы
+   из выгрузки должны сохраниться, а пачка больше предела параметров
+   одного INSERT - разбиться на несколько.
+
+При коллизии, неверной расшифровке, потерянной регистрации, неполном
+перевыпуске или неверных счётчиках импорта код выхода 1.
+
+Запуск из корня репозитория:
+    python -m bench.registration --users 5000 --concurrency 8
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from bench.env import prepare_env, silence_logs
+
+prepare_env()
+
+from sqlalchemy import event, func, select, update
+
+from db import crud
+from db.cache import users_cache, ref_codes_cache
+from db.database import init_models, AsyncSessionLocal, engine
+from db.import_users import import_users
+from db.models import User
+from db.ref_codes import rewrite_ref_codes
+from db.registrations import registrations
+from db.utils import USER_ID_BITS, id_to_ref_code, ref_code_to_id
+
+
+# Telegram user_id бывают и маленькими, и близкими к 2 ** 52
+USER_BASE = 7_000_000_000
+
+
+def legacy_ref_code(user_id: int) -> str:
+    return hashlib.md5(str(user_id).encode()).hexdigest()[:8].upper()
+
+
+async def legacy_insert(db, user_id: int, first_name: str) -> User:
+    """
+    Прежняя регистрация: SELECT по ref_code на каждую попытку, затем INSERT
+    """
+    probe = user_id
+    ref_code = legacy_ref_code(probe)
+    while (await db.execute(select(User).where(User.ref_code == ref_code))).scalars().first():
+        probe += 1
+        ref_code = legacy_ref_code(probe)
+    user = User(user_id=user_id, first_name=first_name, ref_code=ref_code)
+    db.add(user)
+    await db.commit()
+    return user
+
+
+def check_codes(count: int) -> list[str]:
+    errors = []
+    user_ids = [random.randrange(1 << USER_ID_BITS) for _ in range(count)]
+    started = time.perf_counter()
+    codes = [id_to_ref_code(user_id) for user_id in user_ids]
+    elapsed = time.perf_counter() - started
+    decoded = [ref_code_to_id(code) for code in codes]
+
+    if len(set(codes)) != len(set(user_ids)):
+        errors.append(f"{len(set(user_ids)) - len(set(codes))} ref_code collisions")
+    wrong = sum(1 for user_id, result in zip(user_ids, decoded) if result != (user_id, 0))
+    if wrong:
+        errors.append(f"{wrong} codes decoded to a different user_id")
+    rotated = {id_to_ref_code(user_ids[0], generation) for generation in range(100)}
+    if len(rotated) != 100:
+        errors.append("codes of different generations collide")
+    if ref_code_to_id(legacy_ref_code(user_ids[0])) is not None:
+        errors.append("legacy MD5 code decoded as a current one")
+    print(f"codes: {count} in {elapsed:.3f}s ({count / elapsed:.0f}/s), e.g. {codes[0]}, "
+          f"unique={len(set(codes))}, wrong decodes={wrong}")
+    return errors
+
+
+async def register(users: int, concurrency: int, first_id: int, mode: str) -> dict:
+    statements = 0
+    commits = 0
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        nonlocal statements
+        statements += 1
+
+    def count_commit(conn):
+        nonlocal commits
+        commits += 1
+
+    limiter = asyncio.Semaphore(concurrency)
+    registrations.enabled = mode == "buffered"
+
+    async def start(user_id: int):
+        async with limiter:
+            async with AsyncSessionLocal() as db:
+                if mode == "legacy":
+                    if not await crud.get_user_by_id(db, user_id):
+                        await legacy_insert(db, user_id, "User")
+                else:
+                    await crud.create_or_update_user(db, user_id, None, "User", None)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", count)
+    event.listen(engine.sync_engine, "commit", count_commit)
+    started = time.perf_counter()
+    await asyncio.gather(*(start(first_id + number) for number in range(users)))
+    # Регистрация не закончена, пока буфер не записан
+    await registrations.stop()
+    elapsed = time.perf_counter() - started
+    event.remove(engine.sync_engine, "before_cursor_execute", count)
+    event.remove(engine.sync_engine, "commit", count_commit)
+    registrations.enabled = False
+
+    async with AsyncSessionLocal() as db:
+        stored = (await db.execute(
+            select(func.count()).select_from(User).where(User.user_id >= first_id, User.user_id < first_id + users)
+        )).scalar_one()
+    return {"rate": users / elapsed, "statements": statements / users, "commits": commits / users, "lost": users - stored}
+
+
+async def check_rewrite(first_id: int, users: int) -> list[str]:
+    """
+    Каждому третьему из users пользователей с first_id возвращает MD5-код,
+    затем перевыпускает устаревшие коды и поворачивает все
+    """
+    errors = []
+    legacy_ids = list(range(first_id, first_id + users, 3))
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(User), [{"user_id": user_id, "ref_code": legacy_ref_code(user_id)} for user_id in legacy_ids])
+        await db.commit()
+        codes = (await db.execute(select(User.ref_code))).scalars().all()
+    # Старые коды и у части новых пользователей, и у всех, кто прошёл через прежнюю схему
+    outdated = sum(1 for code in codes if ref_code_to_id(code) is None)
+
+    checked, changed = await rewrite_ref_codes(batch_size=500)
+    if changed != outdated:
+        errors.append(f"backfill changed {changed} codes, expected {outdated}")
+    _, rotated = await rewrite_ref_codes(rotate=True, batch_size=500)
+    if rotated != checked:
+        errors.append(f"rotation changed {rotated} of {checked} codes")
+
+    users_cache.clear()
+    ref_codes_cache.clear()
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(select(User.user_id, User.ref_code))).all()
+        wrong = [user_id for user_id, code in rows if ref_code_to_id(code) != (user_id, 1)]
+        found = await crud.get_user_by_ref_code(db, rows[0].ref_code)
+    if wrong:
+        errors.append(f"{len(wrong)} users have unexpected codes after rotation, e.g. {wrong[0]}")
+    if found is None or found.user_id != rows[0].user_id:
+        errors.append("get_user_by_ref_code did not find a rotated code")
+    print(f"rewrite: checked {checked}, backfilled {changed} outdated codes, rotated {rotated}, "
+          f"distinct codes={len({code for _, code in rows})}")
+    return errors
+
+
+async def check_import(first_id: int, users: int) -> list[str]:
+    """
+    Выгрузка из users записей с first_id (первая половина уже в базе)
+    и трёх неполных или некорректных записей, в CSV и в JSONL
+    """
+    errors = []
+    directory = tempfile.mkdtemp(prefix="messages_bot_import_")
+    start = first_id - users // 2
+    records = [{"user_id": start + number, "username": f"user{number}", "first_name": "Imported", "last_name": ""}
+               for number in range(users)]
+    broken = [{"user_id": "", "first_name": "NoId"}, {"user_id": start + users, "first_name": ""},
+              {"user_id": -1, "first_name": "Negative"}]
+
+    csv_path = os.path.join(directory, "users.csv")
+    with open(csv_path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=["user_id", "username", "first_name", "last_name"])
+        writer.writeheader()
+        writer.writerows(records[:users // 2] + broken)
+    # Новые пользователи в JSONL - как в выгрузке /export: со своим кодом и балансом
+    restored = {}
+    for number, record in enumerate(records[users // 2:]):
+        record.update(ref_code=f"restored-{number}", count_read_cancel=number % 5)
+        restored[record["user_id"]] = (record["ref_code"], record["count_read_cancel"])
+    # Чужой реферальный код: запись пропускается и считается отдельно, а не как уже существующий пользователь
+    thief = {"user_id": start + users + 1, "first_name": "Thief", "ref_code": "restored-0"}
+    jsonl_path = os.path.join(directory, "users.jsonl")
+    with open(jsonl_path, "w", encoding="utf-8") as file:
+        for record in records + [thief]:
+            file.write(json.dumps(record) + "\n")
+
+    started = time.perf_counter()
+    from_csv = await import_users(csv_path, "csv", batch_size=500)
+    from_jsonl = await import_users(jsonl_path, "jsonl", batch_size=500)
+    elapsed = time.perf_counter() - started
+    # Пачка больше предела параметров PostgreSQL/SQLite в одном INSERT
+    repeated = await import_users(jsonl_path, "jsonl", batch_size=100_000)
+
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(
+            select(User.user_id, User.ref_code, User.count_read_cancel).where(User.user_id.in_(list(restored)))
+        )).all()
+    changed = [user_id for user_id, ref_code, balance in rows if restored[user_id] != (ref_code, balance)]
+    if len(rows) != len(restored) or changed:
+        errors.append(f"{len(changed)} of {len(restored)} imported users lost their ref_code or balance")
+    if repeated["existing"] != users or repeated["taken_ref_codes"] != 1:
+        errors.append(f"repeated import with a large batch counted {repeated}, expected {users} existing and 1 taken ref_code")
+
+    expected_csv = {"read": users // 2 + len(broken), "inserted": 0, "existing": users // 2, "skipped": len(broken),
+                    "taken_ref_codes": 0}
+    expected_jsonl = {"read": users + 1, "inserted": users - users // 2, "existing": users // 2, "skipped": 0,
+                      "taken_ref_codes": 1}
+    if from_csv != expected_csv:
+        errors.append(f"csv import counters {from_csv}, expected {expected_csv}")
+    if from_jsonl != expected_jsonl:
+        errors.append(f"jsonl import counters {from_jsonl}, expected {expected_jsonl}")
+    print(f"import: csv {from_csv}, jsonl {from_jsonl} in {elapsed:.2f}s")
+    return errors
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=8, help="одновременных регистраций (как UPDATE_WORKERS)")
+    parser.add_argument("--codes", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    silence_logs()
+    await init_models()
+    errors = check_codes(args.codes)
+
+    for number, (name, mode) in enumerate((("md5 + probe", "legacy"), ("sync", "sync"), ("buffered", "buffered"))):
+        result = await register(args.users, args.concurrency, USER_BASE + number * args.users, mode)
+        print(f"register {name:<12} {result['rate']:>8.0f} users/s  SQL/registration={result['statements']:.2f}  "
+              f"commits/registration={result['commits']:.3f}  lost={result['lost']}")
+        if result["lost"]:
+            errors.append(f"{result['lost']} registrations lost in {name} mode")
+
+    errors += await check_rewrite(USER_BASE + args.users, args.users)
+    errors += await check_import(USER_BASE + 3 * args.users, args.users)
+    for error in errors:
+        print(f"FAIL {error}")
+    if errors:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
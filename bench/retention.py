@@ -0,0 +1,176 @@
+"""
+Чистка по сроку хранения: корректность и влияние на запись посланий.
+
+В notes добавляется --notes посланий с датами за два года и отметки
+daily_active_users за десять дней. Для каждого прогона (dry run, archive
+пачками по --batch-size, delete одним DELETE на все устаревшие послания)
+база заполняется заново, и пока идёт NotesRetention.run_once, параллельно
+пишутся новые послания через crud.create_note. Выводятся время прохода и
+задержки этой записи: чем больше пачка, тем дольше запись ждёт блокировку
+SQLite.
+
+Проверяется, что dry run ничего не меняет и насчитал столько же, сколько
+потом убрано; что в notes остались только свежие послания, а в archived_notes
+лежат все перенесённые; что кэш не отдаёт удалённое послание; что остались
+отметки активности только за два последних дня; что остановка фоновой
+чистки не обрывает пачку. Если что-то не сошлось, код выхода 1.
+
+Запуск из корня репозитория:
+    python -m bench.retention --notes 100000 --batch-size 500
+"""
+import argparse
+import asyncio
+import datetime
+import statistics
+import sys
+import time
+
+from bench.env import prepare_env, silence_logs
+
+prepare_env()
+
+from sqlalchemy import delete, func, insert, select
+
+from db import crud
+from db.cache import notes_cache
+from db.database import init_models, AsyncSessionLocal
+from db.models import Note, ArchivedNote, DailyActiveUser
+from db.retention import NotesRetention
+from db.rollups import rollups, today
+
+
+AUTHORS = 100
+READER_BASE = 1_000_000
+WRITER_BASE = 2_000_000
+RETENTION_DAYS = 365
+
+
+async def fill(notes: int) -> int:
+    """
+    Заполняет notes и daily_active_users. Возвращает, сколько посланий старше срока хранения.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    async with AsyncSessionLocal() as db:
+        for table in (Note, ArchivedNote, DailyActiveUser):
+            await db.execute(delete(table))
+        old = 0
+        for start in range(0, notes, 10_000):
+            rows = []
+            for number in range(start, min(start + 10_000, notes)):
+                # Равномерно за 730 дней, самые старые - первыми; сдвиг на полшага, чтобы ни одно не попало ровно на границу
+                created_at = now - datetime.timedelta(days=730) + datetime.timedelta(seconds=(2 * number + 1) * 730 * 86400 // (2 * notes))
+                old += created_at < now - datetime.timedelta(days=RETENTION_DAYS)
+                rows.append({"for_user_id": READER_BASE + number, "created_by_user_id": number % AUTHORS + 1,
+                             "text": f"Послание {number}", "created_at": created_at, "is_read": number % 2 == 0})
+            await db.execute(insert(Note), rows)
+        await db.execute(insert(DailyActiveUser), [
+            {"day": today() - datetime.timedelta(days=days_ago), "user_id": user_id}
+            for days_ago in range(10) for user_id in range(1, 101)
+        ])
+        await db.commit()
+    # Прошлый прогон мог запомнить, что послания нет
+    notes_cache.invalidate((1, READER_BASE))
+    return old
+
+
+async def write_notes(writer: int, stop: asyncio.Event, latencies: list) -> None:
+    number = 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        async with AsyncSessionLocal() as db:
+            await crud.create_note(db, WRITER_BASE + writer * 100_000 + number, "Свежее послание", 1)
+        latencies.append(time.perf_counter() - started)
+        number += 1
+
+
+async def run_with_writers(job: NotesRetention) -> tuple[dict, list]:
+    stop = asyncio.Event()
+    latencies = []
+    writers = [asyncio.create_task(write_notes(writer, stop, latencies)) for writer in range(4)]
+    await asyncio.sleep(0.2)
+    run = await job.run_once()
+    stop.set()
+    await asyncio.gather(*writers)
+    return run, latencies
+
+
+async def counts() -> dict:
+    async with AsyncSessionLocal() as db:
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=RETENTION_DAYS)
+        return {
+            "notes": (await db.execute(select(func.count()).select_from(Note))).scalar_one(),
+            "old_notes": (await db.execute(select(func.count()).where(Note.created_at < cutoff))).scalar_one(),
+            "archived": (await db.execute(select(func.count()).select_from(ArchivedNote))).scalar_one(),
+            "active_users": (await db.execute(select(func.count()).select_from(DailyActiveUser))).scalar_one(),
+        }
+
+
+def report(name: str, run: dict, latencies: list) -> None:
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    print(f"{name:<22} {run['notes']:>7} notes, {run['active_users']:>4} activity rows, {run['batches']:>4} batches "
+          f"in {run['seconds']:.2f}s; concurrent create_note: {len(latencies)} writes, "
+          f"p50 {statistics.median(latencies) * 1000 if latencies else 0:.1f} ms, "
+          f"p99 {p99 * 1000:.1f} ms, max {(latencies[-1] if latencies else 0) * 1000:.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=100_000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    silence_logs()
+    await init_models()
+    errors = []
+
+    old = await fill(args.notes)
+    before = await counts()
+    run, latencies = await run_with_writers(NotesRetention(retention_days=RETENTION_DAYS, dry_run=True))
+    report("dry run", run, latencies)
+    after = await counts()
+    if run["notes"] != old or run["active_users"] != 800:
+        errors.append(f"dry run counted {run['notes']} notes and {run['active_users']} activity rows, expected {old} and 800")
+    if after["old_notes"] != before["old_notes"] or after["archived"] or after["active_users"] != before["active_users"]:
+        errors.append(f"dry run changed data: {before} -> {after}")
+
+    for name, mode, batch_size in (("archive, batched", "archive", args.batch_size), ("delete, one statement", "delete", args.notes)):
+        old = await fill(args.notes)
+        async with AsyncSessionLocal() as db:
+            # Самое старое послание попадает в кэш до чистки
+            cached = await crud.get_note_for_reader(db, READER_BASE, 1)
+        run, latencies = await run_with_writers(NotesRetention(retention_days=RETENTION_DAYS, mode=mode, batch_size=batch_size))
+        report(name, run, latencies)
+        after = await counts()
+        archived = old if mode == "archive" else 0
+        if run["notes"] != old or after["old_notes"] or after["archived"] != archived:
+            errors.append(f"{name}: purged {run['notes']} of {old} old notes, left {after['old_notes']}, archived {after['archived']}")
+        if after["notes"] != args.notes - old + len(latencies):
+            errors.append(f"{name}: {after['notes']} notes left, expected {args.notes - old + len(latencies)}")
+        if after["active_users"] != 200:
+            errors.append(f"{name}: {after['active_users']} activity rows left, expected 200 for two days")
+        async with AsyncSessionLocal() as db:
+            if cached is None or await crud.get_note_for_reader(db, READER_BASE, 1) is not None:
+                errors.append(f"{name}: purged note is still served from cache")
+
+    # Фоновая чистка: остановка сразу после запуска дожидается текущей пачки
+    old = await fill(args.notes)
+    job = NotesRetention(retention_days=RETENTION_DAYS, batch_size=args.batch_size)
+    job.start()
+    await asyncio.sleep(0.1)
+    await job.stop()
+    after = await counts()
+    print(f"stopped background job after {job.purged_notes} of {old} old notes")
+    if after["archived"] != job.purged_notes or after["notes"] != args.notes - job.purged_notes:
+        errors.append(f"background job purged {job.purged_notes}, but archived_notes has {after['archived']} and notes has {after['notes']}")
+
+    await rollups.stop()
+    for error in errors:
+        print(f"FAIL {error}")
+    if errors:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+"""
+Всплеск исходящих сообщений: популярную ссылку /myref одновременно открывают
+сотни пользователей, а в это время другие пользователи жмут inline-кнопки.
+
+Фейковый Bot API включает флуд-контроль как у Telegram (лимит сообщений
+в секунду на бота и на чат, ответ 429 с retry_after). Сравниваются обычный
+AsyncTeleBot, у которого ответы сверх лимита теряются, и RateLimitedTeleBot
+с очередью отправки: сколько ответов дошло, сколько было 429 и как быстро
+получили ответ нажатия кнопок на фоне всплеска.
+
+Запуск из корня репозитория:
+    python -m bench.send_rate --readers 300 --clicks 20
+"""
+import argparse
+import asyncio
+import time
+
+from bench.env import prepare_env, silence_logs, BENCH_TOKEN
+
+prepare_env()
+
+import logging
+
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+from bench.fake_telegram import FakeTelegramServer, message_update, callback_update, dumps
+from bot.handlers import register_handlers, NOTES_LIST
+from bot.sender import RateLimitedTeleBot, OutboundSender
+from db import crud
+from db.database import init_models, AsyncSessionLocal
+
+
+CREATOR_ID = 500
+
+
+async def create_ref_code() -> str:
+    async with AsyncSessionLocal() as db:
+        await crud.create_or_update_user(db, user_id=CREATOR_ID, username="creator", first_name="Creator")
+        return await crud.create_new_ref_code(db, CREATOR_ID)
+
+
+async def run_once(bot: AsyncTeleBot, api: FakeTelegramServer, ref_code: str, readers: int, clicks: int) -> dict:
+    register_handlers(bot)
+    api.sent.clear()
+    api.flooded.clear()
+
+    async def process(update: dict) -> float:
+        started = time.perf_counter()
+        await bot.process_new_updates([types.Update.de_json(dumps(update))])
+        return time.perf_counter() - started
+
+    async def click(number: int) -> float:
+        # Нажатия приходят, когда всплеск уже в очереди
+        await asyncio.sleep(0.2 + number * 0.05)
+        return await process(callback_update(20000 + number, 100000 + number, NOTES_LIST.pack()))
+
+    started = time.perf_counter()
+    reads = [process(message_update(number, 10000 + number, f"/start {ref_code}")) for number in range(readers)]
+    results = await asyncio.gather(*reads, *(click(number) for number in range(clicks)))
+    if isinstance(bot, RateLimitedTeleBot):
+        await bot.sender.stop()
+    elapsed = time.perf_counter() - started
+    await bot.close_session()
+
+    click_latencies = sorted(results[readers:])
+    return {
+        "delivered": len(api.sent),
+        "expected": readers + clicks,
+        "flooded": sum(api.flooded.values()),
+        "elapsed": elapsed,
+        "click_p50": click_latencies[len(click_latencies) // 2] if click_latencies else 0.0,
+        "click_max": click_latencies[-1] if click_latencies else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=300, help="пользователей, одновременно открывших ссылку")
+    parser.add_argument("--clicks", type=int, default=20, help="нажатий inline-кнопок на фоне всплеска")
+    parser.add_argument("--global-limit", type=int, default=30, help="лимит фейкового Bot API, сообщений в секунду")
+    parser.add_argument("--chat-limit", type=int, default=3, help="лимит фейкового Bot API на один чат в секунду")
+    parser.add_argument("--send-rate", type=float, default=28, help="SEND_GLOBAL_RATE бота: чуть ниже лимита, чтобы джиттер сети не давал 429")
+    parser.add_argument("--api-latency", type=float, default=0.02)
+    parser.add_argument("--api-port", type=int, default=8084)
+    args = parser.parse_args()
+
+    silence_logs()
+    # Потерянные ответы обычного бота логируются как ошибки обработчиков
+    logging.getLogger("TeleBot").setLevel(logging.CRITICAL)
+    await init_models()
+    ref_code = await create_ref_code()
+    api = FakeTelegramServer(port=args.api_port, latency=args.api_latency,
+                             global_limit=args.global_limit, chat_limit=args.chat_limit)
+    await api.start()
+
+    bots = {
+        "AsyncTeleBot": lambda: AsyncTeleBot(BENCH_TOKEN, parse_mode='HTML'),
+        "RateLimitedTeleBot": lambda: RateLimitedTeleBot(BENCH_TOKEN, parse_mode='HTML', sender=OutboundSender(global_rate=args.send_rate)),
+    }
+    try:
+        for name, build in bots.items():
+            result = await run_once(build(), api, ref_code, args.readers, args.clicks)
+            print(f"{name:<20} delivered={result['delivered']:>4}/{result['expected']:<4} 429={result['flooded']:>4}  "
+                  f"elapsed={result['elapsed']:.2f}s  click p50={result['click_p50'] * 1000:.0f} ms max={result['click_max'] * 1000:.0f} ms")
+    finally:
+        await api.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,124 @@
+"""
+Стоимость маршрутизации текстового сообщения по состоянию пользователя:
+прежняя схема (отдельный фильтр на каждое состояние,
+каждый читает состояние) против StateRouter (одно чтение и словарь).
+
+Обработчики заменены пустыми, чтобы мерить только выбор обработчика.
+С --storage sql каждое чтение состояния - запрос в базу, как при STATE_STORAGE=sql.
+
+Запуск из корня репозитория:
+    python -m bench.state_dispatch --updates 20000
+    python -m bench.state_dispatch --updates 2000 --storage sql
+"""
+import argparse
+import asyncio
+import time
+
+from bench.env import prepare_env, silence_logs, BENCH_TOKEN
+
+prepare_env()
+
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_storage import StateMemoryStorage
+
+from bench.fake_telegram import message_update, dumps
+from bot.handlers import NoteStates
+from bot.router import StateRouter
+from bot.state_storage import SQLStateStorage
+from db.database import init_models
+
+
+# Порядок, в котором состояния проверялись старыми фильтрами
+STATES = [
+    NoteStates.waiting_for_unread_quantity,
+    NoteStates.waiting_for_user_id,
+    NoteStates.waiting_for_note_text,
+    NoteStates.waiting_for_update_note_text,
+]
+USER_ID = 42
+
+
+class CountingStorage:
+    """
+    Обёртка над хранилищем состояний, считающая чтения состояния.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.reads = 0
+
+    async def get_state(self, *args, **kwargs):
+        self.reads += 1
+        return await self.storage.get_state(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+
+async def noop(message, bot=None):
+    return None
+
+
+def create_state_filter(required_state, bot_instance: AsyncTeleBot):
+    """
+    Фильтр прежней схемы: читает состояние пользователя при каждой проверке
+    """
+    async def state_checker(message: types.Message):
+        current_state = await bot_instance.get_state(message.from_user.id, message.chat.id)
+        return current_state == required_state.name
+    return state_checker
+
+
+def build_filters_bot(storage) -> AsyncTeleBot:
+    bot = AsyncTeleBot(BENCH_TOKEN, state_storage=storage)
+    for state in STATES:
+        bot.register_message_handler(noop, func=create_state_filter(state, bot), pass_bot=True, content_types=['text'])
+    return bot
+
+
+def build_router_bot(storage) -> AsyncTeleBot:
+    bot = AsyncTeleBot(BENCH_TOKEN, state_storage=storage)
+    router = StateRouter(bot)
+    for state in STATES:
+        router.register(state, noop)
+    router.install()
+    return bot
+
+
+async def measure(build, make_storage, state, updates: int) -> tuple[float, float]:
+    storage = CountingStorage(make_storage())
+    bot = build(storage)
+    if state is not None:
+        await bot.set_state(USER_ID, state, USER_ID)
+    update = types.Update.de_json(dumps(message_update(1, USER_ID, "some text")))
+
+    started = time.perf_counter()
+    for _ in range(updates):
+        await bot.process_new_updates([update])
+    elapsed = time.perf_counter() - started
+    return elapsed / updates * 1e6, storage.reads / updates
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--storage", choices=["memory", "sql"], default="memory")
+    args = parser.parse_args()
+    silence_logs()
+
+    make_storage = StateMemoryStorage
+    if args.storage == "sql":
+        await init_models()
+        make_storage = SQLStateStorage
+
+    print(f"{'state':<40} {'filters':>22} {'router':>22}")
+    for state in STATES + [None]:
+        old_cost, old_reads = await measure(build_filters_bot, make_storage, state, args.updates)
+        new_cost, new_reads = await measure(build_router_bot, make_storage, state, args.updates)
+        name = state.name if state else "(no state)"
+        print(f"{name:<40} {old_cost:>8.1f} us {old_reads:>4.1f} reads {new_cost:>8.1f} us {new_reads:>4.1f} reads")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+"""
+Проверка и замер хранилищ состояний FSM: memory, sql и redis
+(через локальную заглушку Redis, без сервера).
+
+Для каждого хранилища проверяется, что состояние и данные диалога
+переживают "перезапуск" (новый экземпляр хранилища), что брошенное
+состояние истекает по TTL, и замеряется скорость get_state.
+
+Запуск из корня репозитория:
+    python -m bench.state_storage --ops 2000
+"""
+import argparse
+import asyncio
+import time
+
+from bench.env import prepare_env, silence_logs
+
+prepare_env()
+
+from telebot.asyncio_storage import StateMemoryStorage
+
+from bot.handlers import NoteStates
+from bot.state_storage import SQLStateStorage, RedisStateStorage
+from db.database import init_models
+
+
+class FakeRedis:
+    """
+    Заглушка асинхронного клиента Redis: get/set с ex/delete в памяти процесса.
+    """
+
+    def __init__(self):
+        self.values: dict[str, tuple[str, float]] = {}
+
+    async def get(self, key):
+        value = self.values.get(key)
+        if value is None or value[1] <= time.time():
+            self.values.pop(key, None)
+            return None
+        return value[0]
+
+    async def set(self, key, value, ex=None):
+        self.values[key] = (value, time.time() + ex if ex else float("inf"))
+        return True
+
+    async def delete(self, key):
+        return 1 if self.values.pop(key, None) is not None else 0
+
+
+CHAT_ID = USER_ID = 42
+
+
+async def check(name: str, make_storage, ops: int) -> None:
+    storage = make_storage(ttl=60)
+    await storage.set_state(CHAT_ID, USER_ID, NoteStates.waiting_for_note_text)
+    async with storage.get_interactive_data(CHAT_ID, USER_ID) as data:
+        data["user_id"] = 777
+
+    restarted = make_storage(ttl=60)
+    state = await restarted.get_state(CHAT_ID, USER_ID)
+    data = await restarted.get_data(CHAT_ID, USER_ID)
+    survived = state == NoteStates.waiting_for_note_text.name and data.get("user_id") == 777
+
+    started = time.perf_counter()
+    for _ in range(ops):
+        await restarted.get_state(CHAT_ID, USER_ID)
+    rate = ops / (time.perf_counter() - started)
+
+    short = make_storage(ttl=1)
+    await short.set_state(CHAT_ID, USER_ID + 1, NoteStates.waiting_for_user_id)
+    await asyncio.sleep(1.1)
+    expired = await short.get_state(CHAT_ID, USER_ID + 1) is None
+
+    await restarted.delete_state(CHAT_ID, USER_ID)
+    deleted = await restarted.get_state(CHAT_ID, USER_ID) is None
+
+    print(f"{name:<7} survives restart: {'yes' if survived else 'no':<3}  expires by TTL: {'yes' if expired else 'no':<3}  "
+          f"delete: {'ok' if deleted else 'FAIL'}  get_state: {rate:.0f} ops/s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ops", type=int, default=2000)
+    args = parser.parse_args()
+
+    silence_logs()
+    await init_models()
+
+    fake_redis = FakeRedis()
+    # Состояния в памяти живут только внутри экземпляра, поэтому "перезапуск" их теряет
+    await check("memory", lambda ttl: StateMemoryStorage(), args.ops)
+    await check("sql", lambda ttl: SQLStateStorage(ttl=ttl), args.ops)
+    await check("redis", lambda ttl: RedisStateStorage(client=fake_redis, ttl=ttl), args.ops)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
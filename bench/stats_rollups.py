@@ -0,0 +1,214 @@
+"""
+/stats: сверка агрегатов с таблицами и скорость против запросов по сырым данным.
+
+Сначала через crud проходят --users регистраций, по посланию от каждого
+пользователя следующему, прочтения половины посланий, оплаты, скрытия
+прочтений и повторные прочтения после скрытия, а db_handler-отметки
+активности (rollups.touch). После записи накопленных приращений daily_stats
+и creator_stats сверяются с COUNT/SUM по users, notes и payments.
+
+Затем в notes напрямую добавляется --notes посланий за --days дней
+(агрегаты пересчитываются с нуля той же функцией, что при миграции), и сравнивается
+время get_daily_stats + get_top_creators с теми же отчётами, посчитанными
+GROUP BY по notes. В конце /stats прогоняется через настоящий обработчик
+и фейковый Bot API.
+
+Если агрегаты разошлись с таблицами или /stats не ответил, код выхода 1.
+
+Запуск из корня репозитория:
+    python -m bench.stats_rollups --users 500 --notes 200000
+"""
+import argparse
+import asyncio
+import datetime
+import sys
+import time
+
+from bench.env import prepare_env, silence_logs, BENCH_TOKEN, BENCH_ADMIN_ID
+
+prepare_env()
+
+from sqlalchemy import case, delete, func, insert, select
+from telebot import types
+
+from bench.fake_telegram import FakeTelegramServer, message_update, dumps
+from bot.handlers import register_handlers
+from bot.sender import RateLimitedTeleBot, OutboundSender
+from db import crud
+from db.database import init_models, engine, AsyncSessionLocal
+from db.migrations import _backfill_rollups
+from db.models import User, Note, Payment, DailyStats, CreatorStats
+from db.rollups import rollups, today
+
+
+READER_BASE = 1_000_000
+REPEATS = 20
+
+
+async def simulate(users: int) -> dict:
+    """
+    События через crud. Возвращает то, что нельзя восстановить по таблицам:
+    число первых прочтений, скрытий и активных пользователей.
+    """
+    expected = {"notes_read": 0, "read_cancels_spent": 0, "active_users": set()}
+    user_ids = list(range(2, users + 2))
+    async with AsyncSessionLocal() as db:
+        await crud.initiate_creation_of_admin_panel(db, BENCH_ADMIN_ID, 0, 0)
+        for user_id in user_ids:
+            rollups.touch(user_id)
+            # Повторная активность за день не должна считаться дважды
+            rollups.touch(user_id)
+            expected["active_users"].add(user_id)
+            await crud.create_or_update_user(db, user_id, f"user{user_id}", f"User {user_id}", None)
+
+        notes = []
+        for author, reader in zip(user_ids, user_ids[1:] + user_ids[:1]):
+            notes.append(await crud.create_note(db, reader, f"Послание от {author}", author))
+
+        for note in notes[::2]:
+            note = await crud.get_note_for_reader(db, note.for_user_id, note.created_by_user_id)
+            if await crud.mark_note_as_read(db, note):
+                expected["notes_read"] += 1
+            # Повторный переход по ссылке - не новое прочтение
+            await crud.mark_note_as_read(db, note)
+
+        for number, note in enumerate(notes[::4]):
+            await crud.process_payment(db, note.for_user_id, 2, 100, f"charge-{number}")
+            if await crud.spend_read_cancel(db, note.for_user_id, note.id) is not None:
+                expected["read_cancels_spent"] += 1
+            # Прочтение после скрытия тоже не считается новым
+            note = await crud.get_note_for_reader(db, note.for_user_id, note.created_by_user_id)
+            await crud.mark_note_as_read(db, note)
+    return expected
+
+
+async def check(expected: dict) -> list[str]:
+    errors = []
+    async with AsyncSessionLocal() as db:
+        days = await crud.get_daily_stats(db, 1)
+        actual = days[0] if days else DailyStats(day=today())
+        truth = {
+            "new_users": (await db.execute(select(func.count()).select_from(User))).scalar_one(),
+            "active_users": len(expected["active_users"]),
+            "notes_created": (await db.execute(select(func.count()).select_from(Note))).scalar_one(),
+            "notes_read": expected["notes_read"],
+            "payments": (await db.execute(select(func.count()).select_from(Payment))).scalar_one(),
+            "earnings": (await db.execute(select(func.coalesce(func.sum(Payment.total_amount), 0)))).scalar_one(),
+            "read_cancels_sold": (await db.execute(select(func.coalesce(func.sum(Payment.quantity), 0)))).scalar_one(),
+            "read_cancels_spent": expected["read_cancels_spent"],
+        }
+        for name, value in truth.items():
+            if (getattr(actual, name) or 0) != value:
+                errors.append(f"daily_stats.{name} = {getattr(actual, name)}, expected {value}")
+
+        created = dict((await db.execute(select(Note.created_by_user_id, func.count()).group_by(Note.created_by_user_id))).all())
+        rollup = {row.user_id: row for row in (await db.execute(select(CreatorStats))).scalars()}
+        if set(created) != set(rollup):
+            errors.append(f"creator_stats has {len(rollup)} authors, notes has {len(created)}")
+        mismatched = [user_id for user_id, count in created.items() if user_id in rollup and rollup[user_id].notes_created != count]
+        if mismatched:
+            errors.append(f"creator_stats.notes_created differs for {len(mismatched)} authors")
+        read = sum(row.notes_read for row in rollup.values())
+        if read != expected["notes_read"]:
+            errors.append(f"creator_stats.notes_read sums to {read}, expected {expected['notes_read']}")
+    print(f"rollups after {rollups.flushes} flushes: " + ", ".join(f"{name}={getattr(actual, name)}" for name in truth))
+    return errors
+
+
+async def fill(notes: int, days: int) -> None:
+    """
+    Старые послания в обход crud; агрегаты пересчитываются миграцией с нуля
+    """
+    authors = 100
+    start = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(days=days)
+    async with AsyncSessionLocal() as db:
+        for offset in range(0, notes, 10_000):
+            numbers = range(offset, min(offset + 10_000, notes))
+            await db.execute(insert(Note), [
+                {"for_user_id": READER_BASE + number, "created_by_user_id": number % authors + 2,
+                 "text": f"Старое послание {number}", "is_read": number % 3 == 0,
+                 "created_at": start + datetime.timedelta(seconds=number * days * 86400 // notes)}
+                for number in numbers
+            ])
+        await db.execute(delete(DailyStats))
+        await db.execute(delete(CreatorStats))
+        await db.commit()
+    async with engine.begin() as conn:
+        await conn.run_sync(_backfill_rollups)
+
+
+async def timed(report) -> float:
+    started = time.perf_counter()
+    for _ in range(REPEATS):
+        async with AsyncSessionLocal() as db:
+            await report(db)
+    return (time.perf_counter() - started) / REPEATS
+
+
+async def rollup_report(db) -> None:
+    await crud.get_daily_stats(db, 30)
+    await crud.get_top_creators(db, 5)
+
+
+async def raw_report(db) -> None:
+    since = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(days=30)
+    read = func.sum(case((Note.is_read == True, 1), else_=0))
+    (await db.execute(
+        select(func.date(Note.created_at), func.count(), read)
+        .where(Note.created_at >= since).group_by(func.date(Note.created_at))
+    )).all()
+    (await db.execute(
+        select(Note.created_by_user_id, func.count(), read)
+        .group_by(Note.created_by_user_id).order_by(read.desc()).limit(5)
+    )).all()
+
+
+async def stats_via_bot(api_port: int) -> list[str]:
+    api = FakeTelegramServer(port=api_port)
+    await api.start()
+    bot = RateLimitedTeleBot(BENCH_TOKEN, parse_mode='HTML', sender=OutboundSender(global_rate=1000, chat_rate=100, chat_burst=100))
+    register_handlers(bot)
+    try:
+        await bot.process_new_updates([types.Update.de_json(dumps(message_update(1, BENCH_ADMIN_ID, "/stats")))])
+        await bot.sender.stop()
+    finally:
+        await bot.close_session()
+        await api.stop()
+
+    replies = [sent for sent in api.sent if sent["method"] == "sendMessage" and "📊" in sent.get("text", "")]
+    if not replies:
+        return ["/stats did not reply"]
+    print(f"/stats replied with {len(replies[0]['text'])} characters")
+    return []
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--notes", type=int, default=200_000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--api-port", type=int, default=8089)
+    args = parser.parse_args()
+
+    silence_logs()
+    await init_models()
+    expected = await simulate(args.users)
+    errors = await check(expected)
+
+    await fill(args.notes, args.days)
+    rollup_time = await timed(rollup_report)
+    raw_time = await timed(raw_report)
+    print(f"{args.notes} notes over {args.days} days: rollups {rollup_time * 1000:.2f} ms, "
+          f"GROUP BY over notes {raw_time * 1000:.2f} ms ({raw_time / rollup_time:.0f}x)")
+
+    errors += await stats_via_bot(args.api_port)
+    await rollups.stop()
+    for error in errors:
+        print(f"FAIL {error}")
+    if errors:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
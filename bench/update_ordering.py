@@ -0,0 +1,190 @@
+"""
+Проверка UpdateDispatcher: апдейты одного пользователя обрабатываются
+по одному и в порядке поступления, разных пользователей - параллельно.
+
+1. Синтетическая нагрузка: --users пользователей шлют по --per-user апдейтов
+   (сообщения и нажатия кнопок вперемешку), апдейты разных пользователей
+   перемешаны. Обработчик спит случайное время и проверяет, что у пользователя
+   нет второго апдейта в работе и что номера идут по порядку. Очередь меньше
+   числа апдейтов, так что заодно проверяется ожидание свободного места
+   и то, что после разбора у диспетчера не остаётся очередей пользователей.
+2. Настоящий обработчик: пользователь с одной отменой прочтения
+   много раз подряд жмёт «Скрыть прочтение». И при одновременной обработке
+   (как в bot.polling), и через диспетчер баланс должен стать ровно 0:
+   списание - условный UPDATE (crud.spend_read_cancel).
+
+При нарушении порядка или неверном балансе код выхода 1.
+
+Запуск из корня репозитория:
+    python -m bench.update_ordering --users 500 --per-user 20 --workers 32
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from collections import defaultdict
+
+from bench.env import prepare_env, silence_logs, BENCH_TOKEN
+
+prepare_env()
+
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+from bench.fake_telegram import FakeTelegramServer, message_update, callback_update, dumps
+from bot.dispatcher import UpdateDispatcher
+from bot.handlers import register_handlers, HIDE_READ
+from db import crud
+from db.cache import users_cache
+from db.database import init_models, AsyncSessionLocal
+
+
+class OrderCheckingBot:
+    """
+    Вместо обработчиков бота: записывает порядок апдейтов и ловит параллельную
+    обработку апдейтов одного пользователя
+    """
+
+    def __init__(self, max_delay: float):
+        self.max_delay = max_delay
+        self.seen: dict[int, list[int]] = defaultdict(list)
+        self.in_flight: set[int] = set()
+        self.overlaps = 0
+        self.running = 0
+        self.max_running = 0
+        self.max_users = 0
+        self.dispatcher: UpdateDispatcher | None = None
+
+    async def process_new_updates(self, updates: list[types.Update]) -> None:
+        update = updates[0]
+        source = update.message or update.callback_query
+        user_id = source.from_user.id
+        if user_id in self.in_flight:
+            self.overlaps += 1
+        self.in_flight.add(user_id)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.max_users = max(self.max_users, len(self.dispatcher._users))
+        try:
+            await asyncio.sleep(random.random() * self.max_delay)
+            # Номер апдейта пользователя лежит в тексте или callback_data
+            self.seen[user_id].append(int(update.message.text if update.message else update.callback_query.data))
+        finally:
+            self.running -= 1
+            self.in_flight.discard(user_id)
+
+
+def synthetic_updates(users: int, per_user: int) -> list[types.Update]:
+    """
+    Апдейты всех пользователей вперемешку, у каждого пользователя - по возрастанию номера
+    """
+    streams = [[(user, seq) for seq in range(per_user)] for user in range(users)]
+    order = [user for user in range(users) for _ in range(per_user)]
+    random.shuffle(order)
+    updates = []
+    for update_id, user in enumerate(order, start=1):
+        _, seq = streams[user].pop(0)
+        build = message_update if seq % 2 else callback_update
+        updates.append(types.Update.de_json(dumps(build(update_id, 10_000 + user, str(seq)))))
+    return updates
+
+
+async def check_ordering(args) -> list[str]:
+    bot = OrderCheckingBot(args.max_delay)
+    dispatcher = UpdateDispatcher(bot, args.queue_size, args.workers)
+    bot.dispatcher = dispatcher
+    updates = synthetic_updates(args.users, args.per_user)
+
+    dispatcher.start()
+    started = time.perf_counter()
+    for update in updates:
+        await dispatcher.put(update)
+    await dispatcher.join()
+    elapsed = time.perf_counter() - started
+    await dispatcher.stop()
+
+    errors = []
+    unordered = [user for user, seqs in bot.seen.items() if seqs != list(range(args.per_user))]
+    if unordered:
+        errors.append(f"{len(unordered)} users got updates out of order, e.g. {unordered[0]}: {bot.seen[unordered[0]]}")
+    if bot.overlaps:
+        errors.append(f"{bot.overlaps} updates ran while another update of the same user was in flight")
+    if dispatcher.stats()["users"]:
+        errors.append(f"{dispatcher.stats()['users']} user queues left after drain")
+    print(f"ordering: {len(updates)} updates from {args.users} users in {elapsed:.2f}s ({len(updates) / elapsed:.0f}/s), "
+          f"max concurrent={bot.max_running}/{args.workers}, max user queues={bot.max_users} (queue_size={args.queue_size}), "
+          f"overlaps={bot.overlaps}, out of order users={len(unordered)}")
+    return errors
+
+
+async def double_tap(bot: AsyncTeleBot, taps: int, ordered: bool, user_id: int, note_id: int) -> int:
+    async with AsyncSessionLocal() as db:
+        await crud.update_user_balance(db, user_id, 1 - (await crud.get_user_by_id(db, user_id)).count_read_cancel)
+        await crud.mark_note_as_read(db, await crud.get_note_by_id(db, note_id))
+    updates = [types.Update.de_json(dumps(callback_update(number, user_id, HIDE_READ.pack(note_id=note_id))))
+               for number in range(1, taps + 1)]
+    if ordered:
+        dispatcher = UpdateDispatcher(bot, taps, taps)
+        dispatcher.start()
+        for update in updates:
+            dispatcher.submit(update)
+        await dispatcher.stop()
+    else:
+        # Как bot.polling: каждая пачка апдейтов в своей задаче
+        await asyncio.gather(*(bot.process_new_updates([update]) for update in updates))
+    users_cache.clear()
+    async with AsyncSessionLocal() as db:
+        return (await crud.get_user_by_id(db, user_id)).count_read_cancel
+
+
+async def check_double_tap(args) -> list[str]:
+    await init_models()
+    reader_id, author_id = 777, 778
+    async with AsyncSessionLocal() as db:
+        await crud.add_user(db, author_id, None, "Author", None)
+        await crud.add_user(db, reader_id, None, "Reader", None)
+        note = await crud.create_note(db, reader_id, "hello there", author_id)
+
+    api = FakeTelegramServer(port=args.api_port, latency=args.api_latency)
+    await api.start()
+    bot = AsyncTeleBot(BENCH_TOKEN, parse_mode='HTML')
+    register_handlers(bot)
+    try:
+        concurrent = await double_tap(bot, args.taps, False, reader_id, note.id)
+        ordered = await double_tap(bot, args.taps, True, reader_id, note.id)
+    finally:
+        await bot.close_session()
+        await api.stop()
+
+    print(f"double tap x{args.taps} with balance 1: concurrent processing -> balance {concurrent}, UpdateDispatcher -> balance {ordered}")
+    return [f"balance after {mode} taps is {balance}, expected 0"
+            for mode, balance in (("concurrent", concurrent), ("ordered", ordered)) if balance != 0]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--per-user", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--max-delay", type=float, default=0.002, help="наибольшее время обработки апдейта, сек")
+    parser.add_argument("--taps", type=int, default=5, help="нажатий «Скрыть прочтение» подряд")
+    parser.add_argument("--api-latency", type=float, default=0.01)
+    parser.add_argument("--api-port", type=int, default=8087)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    silence_logs()
+    errors = await check_ordering(args)
+    errors += await check_double_tap(args)
+    for error in errors:
+        print(f"FAIL {error}")
+    if errors:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+"""
+Замер пропускной способности webhook-режима без выхода в сеть.
+
+Поднимает фейковый Bot API и webhook-сервер бота, отправляет пачку
+апдейтов (/start и /help от разных пользователей) и считает,
+сколько апдейтов в секунду успевают разобрать воркеры.
+
+Запуск из корня репозитория:
+    python -m bench.webhook_throughput --updates 2000 --workers 1 8 32 --api-latency 0.05
+"""
+import argparse
+import asyncio
+import time
+
+from bench.env import prepare_env, silence_logs, BENCH_TOKEN
+
+prepare_env()
+
+import aiohttp
+from telebot.async_telebot import AsyncTeleBot
+
+from bench.fake_telegram import FakeTelegramServer, message_update, dumps
+from bot.handlers import register_handlers
+from bot.webhook import start_webhook_server, stop_webhook_server
+from db.database import init_models
+
+
+WEBHOOK_PATH = "/webhook"
+
+
+def build_updates(count: int, users: int) -> list[str]:
+    updates = []
+    for update_id in range(1, count + 1):
+        user_id = 1000 + update_id % users
+        text = "/start" if update_id % 3 else "/help"
+        updates.append(dumps(message_update(update_id, user_id, text)))
+    return updates
+
+
+async def run_once(updates: list[str], workers: int, queue_size: int, port: int, concurrency: int) -> dict:
+    bot = AsyncTeleBot(BENCH_TOKEN, parse_mode='HTML')
+    register_handlers(bot)
+    runner, dispatcher = await start_webhook_server(bot, "127.0.0.1", port, WEBHOOK_PATH, None, queue_size, workers)
+
+    url = f"http://127.0.0.1:{port}{WEBHOOK_PATH}"
+    limiter = asyncio.Semaphore(concurrency)
+    statuses: dict[int, int] = {}
+
+    async with aiohttp.ClientSession() as session:
+        async def post(body: str):
+            async with limiter:
+                async with session.post(url, data=body, headers={"Content-Type": "application/json"}) as resp:
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(body) for body in updates))
+        await dispatcher.join()
+        elapsed = time.perf_counter() - started
+
+    await stop_webhook_server(runner, dispatcher)
+    await bot.close_session()
+    return {
+        "workers": workers,
+        "elapsed": elapsed,
+        "processed": dispatcher.processed,
+        "rejected": dispatcher.rejected,
+        "statuses": statuses,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--queue-size", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=64, help="одновременных POST-запросов к вебхуку")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="задержка фейкового Bot API, сек")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--api-port", type=int, default=8082)
+    args = parser.parse_args()
+
+    silence_logs()
+    await init_models()
+    api = FakeTelegramServer(port=args.api_port, latency=args.api_latency)
+    await api.start()
+
+    updates = build_updates(args.updates, args.users)
+    try:
+        for workers in args.workers:
+            result = await run_once(updates, workers, args.queue_size, args.port, args.concurrency)
+            rate = result["processed"] / result["elapsed"]
+            print(f"workers={workers:>3}  processed={result['processed']:>6}  rejected={result['rejected']:>5}  "
+                  f"elapsed={result['elapsed']:.2f}s  {rate:.1f} updates/s  http={result['statuses']}")
+    finally:
+        await api.stop()
+    print(f"Bot API calls: {dict(api.calls)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+from typing import Any, Dict, Optional, Tuple
+
+
+# Версия формата callback_data. Меняется, если старые кнопки нельзя разобрать новым кодом
+VERSION = "1"
+SEPARATOR = ":"
+# Ограничение Telegram на длину callback_data в байтах
+MAX_LENGTH = 64
+
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _encode_int(value: int) -> str:
+    if value < 0:
+        return "-" + _encode_int(-value)
+    encoded = ""
+    while True:
+        value, digit = divmod(value, 36)
+        encoded = _DIGITS[digit] + encoded
+        if not value:
+            return encoded
+
+
+class CallbackAction:
+    """
+    Тип inline-кнопки: короткий код действия и типизированные поля.
+    Кнопка упаковывается в строку вида "1v:2n9c" — версия формата, код действия
+    и значения полей через двоеточие (int в base36, None — пустое значение).
+    legacy задаёт старые форматы кнопок, которые ещё могут прийти из уже отправленных
+    сообщений: {префикс: имя поля для числа после последнего "_" или None для точного совпадения}.
+    """
+
+    def __init__(self, code: str, *fields: Tuple[str, type], legacy: Optional[Dict[str, Optional[str]]] = None):
+        if SEPARATOR in code:
+            raise ValueError(f"Callback action code must not contain '{SEPARATOR}': {code!r}")
+        self.code = code
+        self.fields = fields
+        self.legacy = legacy or {}
+
+    @property
+    def header(self) -> str:
+        return VERSION + self.code
+
+    def pack(self, **values: Any) -> str:
+        parts = [self.header]
+        for name, field_type in self.fields:
+            value = values.get(name)
+            if value is None:
+                parts.append("")
+            elif field_type is int:
+                parts.append(_encode_int(int(value)))
+            else:
+                value = str(value)
+                if SEPARATOR in value:
+                    raise ValueError(f"Callback field {name} must not contain '{SEPARATOR}'")
+                parts.append(value)
+        data = SEPARATOR.join(parts).rstrip(SEPARATOR)
+        if len(data.encode()) > MAX_LENGTH:
+            raise ValueError(f"callback_data is longer than {MAX_LENGTH} bytes: {data!r}")
+        return data
+
+    def unpack(self, payload: str) -> Dict[str, Any]:
+        """
+        Разбирает поля после заголовка. Недостающие в конце поля равны None
+        """
+        raw = payload.split(SEPARATOR) if payload else []
+        if len(raw) > len(self.fields):
+            raise ValueError(f"Too many fields for callback action {self.code!r}")
+        values = {}
+        for index, (name, field_type) in enumerate(self.fields):
+            value = raw[index] if index < len(raw) else ""
+            if value == "":
+                values[name] = None
+            elif field_type is int:
+                values[name] = int(value, 36)
+            else:
+                values[name] = field_type(value)
+        return values
+
+    def unpack_legacy(self, field: Optional[str], value: Optional[str]) -> Dict[str, Any]:
+        values = {name: None for name, _ in self.fields}
+        if field is not None:
+            values[field] = int(value)
+        return values
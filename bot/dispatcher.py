@@ -0,0 +1,144 @@
+import asyncio
+from collections import deque
+from typing import Dict, Hashable, List
+
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+from global_logger import logger
+
+
+# Поля апдейта, в которых лежит объект с from_user
+USER_FIELDS = (
+    "message", "edited_message", "callback_query", "pre_checkout_query", "shipping_query",
+    "inline_query", "chosen_inline_result", "my_chat_member", "chat_member", "chat_join_request",
+    "business_message", "edited_business_message", "purchased_paid_media",
+)
+
+
+def update_user_key(update: types.Update) -> Hashable:
+    """
+    Ключ очереди апдейта: id пользователя, от которого он пришёл.
+    Апдейты без пользователя (посты в каналах и т.п.) ни с чем не упорядочиваются.
+    """
+    for field in USER_FIELDS:
+        from_user = getattr(getattr(update, field, None), "from_user", None)
+        if from_user is not None:
+            return from_user.id
+    return ("update", update.update_id)
+
+
+class UpdateDispatcher:
+    """
+    Ограниченная очередь апдейтов и пул воркеров.
+    Апдейты одного пользователя обрабатываются строго по очереди и в порядке
+    поступления, апдейты разных пользователей - параллельно, до workers сразу.
+    Так двойное нажатие кнопки не выполняет обработчик дважды одновременно.
+
+    У каждого пользователя с необработанными апдейтами своя очередь, а воркеры
+    берут пользователей из общей очереди готовых: после одного апдейта
+    пользователь с оставшимися апдейтами встаёт в её конец, чтобы частые
+    апдейты одного пользователя не занимали воркера целиком. Очередь пользователя
+    удаляется, как только опустеет, поэтому память зависит только от числа
+    необработанных апдейтов (не больше queue_size), а не от числа пользователей.
+    """
+
+    def __init__(self, bot: AsyncTeleBot, queue_size: int, workers: int):
+        self.bot = bot
+        self.queue_size = queue_size
+        self.workers = workers
+        self.processed = 0
+        self.rejected = 0
+        # Принятые, но ещё не обработанные апдейты
+        self.pending = 0
+        # пользователь -> его апдейты, включая обрабатываемый сейчас
+        self._users: Dict[Hashable, deque] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        for number in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(number)))
+
+    def submit(self, update: types.Update) -> bool:
+        """
+        Кладёт апдейт в очередь его пользователя.
+        Возвращает False, если очередь переполнена.
+        """
+        if self.pending >= self.queue_size:
+            self.rejected += 1
+            return False
+        self._accept(update)
+        return True
+
+    async def put(self, update: types.Update) -> None:
+        """
+        Как submit, но при переполнении ждёт, пока освободится место
+        """
+        while self.pending >= self.queue_size:
+            self._space.clear()
+            await self._space.wait()
+        self._accept(update)
+
+    def _accept(self, update: types.Update) -> None:
+        self.pending += 1
+        self._idle.clear()
+        key = update_user_key(update)
+        updates = self._users.get(key)
+        if updates is None:
+            self._users[key] = deque((update,))
+            self._ready.put_nowait(key)
+        else:
+            # Пользователь уже в очереди готовых или обрабатывается, его апдейт подождёт
+            updates.append(update)
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            key = await self._ready.get()
+            updates = self._users[key]
+            update = updates[0]
+            try:
+                await self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error("Worker %s failed to process update %s: %s", number, update.update_id, e)
+            finally:
+                updates.popleft()
+                if updates:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._users[key]
+                self.processed += 1
+                self.pending -= 1
+                self._space.set()
+                if not self.pending:
+                    self._idle.set()
+
+    async def join(self) -> None:
+        """
+        Ждёт, пока будут обработаны все принятые апдейты
+        """
+        await self._idle.wait()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "users": len(self._users),
+            "processed": self.processed,
+            "rejected": self.rejected,
+        }
+
+    async def stop(self, drain: bool = True) -> None:
+        """
+        Останавливает воркеров. При drain=True сначала дожидается,
+        пока будут обработаны все принятые апдейты.
+        """
+        if drain:
+            await self.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
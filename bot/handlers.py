@@ -1,13 +1,26 @@
+import datetime
+import os
+import tempfile
+
 from telebot.async_telebot import AsyncTeleBot 
-from db.database import get_async_db
+from db.database import release_connection
 from db import crud
+from db.export import export_tables, EXPORT_FORMATS
+from db.read_receipts import read_receipts
+from db.registrations import registrations
+from db.retention import retention
+from db.rollups import today
 
-from config import ADMIN_ID, COST
+from config import ADMIN_ID, COST, NOTES_PAGE_SIZE
 
 from sqlalchemy.ext.asyncio import AsyncSession
 from telebot import types
 
-from bot.utils import escape_html, create_user_link, db_handler, create_state_filter, update_data, get_data
+from bot.utils import escape_html, create_user_link, db_handler, update_data, get_data
+from bot.router import StateRouter, CallbackRouter
+from bot.callback_data import CallbackAction
+from bot.sender import Priority, with_priority
+from bot import metrics
 
 from telebot.async_telebot import AsyncTeleBot
 from telebot.asyncio_handler_backends import State, StatesGroup
@@ -23,6 +36,24 @@ class NoteStates(StatesGroup):
     waiting_for_unread_quantity = State()
 
 
+# Inline-кнопки бота. legacy — форматы кнопок, отправленных до введения CallbackAction.
+# Кнопки послания несут курсор страницы списка, с которой его открыли, чтобы «Назад» вернул на неё
+NOTES_CURSOR = (("after_note_id", int), ("before_note_id", int))
+VIEW_NOTE = CallbackAction("v", ("note_id", int), *NOTES_CURSOR, legacy={"view_note": "note_id"})
+EDIT_NOTE = CallbackAction("e", ("note_id", int), *NOTES_CURSOR, legacy={"edit_note": "note_id"})
+DELETE_NOTE = CallbackAction("d", ("note_id", int), *NOTES_CURSOR, legacy={"delete_note": "note_id"})
+HIDE_READ = CallbackAction("h", ("note_id", int), legacy={"hide_read": "note_id"})
+NOTES_LIST = CallbackAction("l", *NOTES_CURSOR, legacy={"back_to_notes": None})
+CANCEL_PURCHASE = CallbackAction("c", legacy={"cancel_purchase": None})
+
+# Telegram принимает от бота документы до 50 МБ
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+# /stats: по дням за STATS_DAYS дней, итоги за STATS_TOTAL_DAYS, топ STATS_TOP_CREATORS авторов
+STATS_DAYS = 7
+STATS_TOTAL_DAYS = 30
+STATS_TOP_CREATORS = 5
+
+
 async def debug_state(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
     state = await bot.get_state(message.from_user.id, message.chat.id)
     await bot.send_message(message.chat.id, f"Ваше текущее состояние: {state}")
@@ -48,7 +79,6 @@ async def start_note_creation(message: types.Message, bot: AsyncTeleBot, db: Asy
 
 
 async def process_user_id(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
-    state = await bot.get_state(message.from_user.id, message.chat.id)
     user_id_text = message.text.strip()
     if not user_id_text.isdigit():
         await bot.send_message(message.chat.id, "❌ Пожалуйста, введите корректный числовой ID пользователя.")
@@ -67,7 +97,7 @@ async def process_note_text(message: types.Message, bot: AsyncTeleBot, db: Async
 
     if not (5 <= len(note_text) <= 2000):
         await bot.send_message(message.chat.id, "Ваше сообщение не должно превышать 2000 символов или быть короче 5.")
-        logger.warning(f"Note text is too long/short: {len(note_text)} total chars")
+        logger.warning("Note text is too long/short: %s total chars", len(note_text))
         return
 
     note = await crud.create_note(
@@ -100,19 +130,19 @@ async def handle_start(message: types.Message, bot: AsyncTeleBot, db: AsyncSessi
         if ref_user:
             if ref_user.user_id == user.user_id:
                 await bot.send_message(message.chat.id, "Вы не можете воспользоваться собственной ссылкой")
-                logger.warning(f"User {message.from_user.id} attempted to read a note to themselves")
+                logger.warning("User %s attempted to read a note to themselves", message.from_user.id)
                 return
-            creator_user = await crud.get_user_by_ref_code(db, ref_code)
-            note = await crud.get_note_by_user_id_and_creator_id(db, user.user_id, creator_user.user_id)
+            creator_user = ref_user
+            note = await crud.get_note_for_reader(db, user.user_id, creator_user.user_id)
             if note is None:
                 await bot.send_message(message.chat.id,  "📭 Тебе пока ничего не написали...\n\nНо ты можешь оставить своё послание первым командой /note")
                 return
             message_text = f"Вам письмо от {creator_user.first_name}:\n\n"\
                            f"{escape_html(note.text)}"
             markup = types.InlineKeyboardMarkup()
-            button = types.InlineKeyboardButton("Скрыть прочтение", callback_data=f"hide_read_{note.id}")
+            button = types.InlineKeyboardButton("Скрыть прочтение", callback_data=HIDE_READ.pack(note_id=note.id))
             markup.add(button)
-            await crud.set_note_as_read(db, note_id=note.id)
+            await crud.mark_note_as_read(db, note)
             await bot.send_message(message.chat.id, message_text, reply_markup=markup)
 
 
@@ -127,20 +157,15 @@ async def get_my_ref_link(message: types.Message, bot: AsyncTeleBot, db: AsyncSe
             first_name=message.from_user.first_name,
             last_name=message.from_user.last_name
         )
-    if not user.ref_code:
-        ref_code = await crud.generate_unique_ref_code(db, user)
-        user.ref_code = ref_code
-        db.add(user)
-        await db.commit()
-        await db.refresh(user)
-    ref_link = f"https://t.me/ToUserBot?start={user.ref_code}"
+    ref_code = user.ref_code or await crud.create_new_ref_code(db, user.user_id)
+    ref_link = f"https://t.me/ToUserBot?start={ref_code}"
     await bot.send_message(message.chat.id, f"Ваша реферальная ссылка:\n{ref_link}")
 
 
 async def handle_user_shared(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
     if not message.user_shared:
         await bot.send_message(message.chat.id, "❌ Не удалось получить пользователя.")
-        logger.error(f"Failed to get shared user data from user {message.from_user.id}")
+        logger.error("Failed to get shared user data from user %s", message.from_user.id)
         return
 
     for_user_id = message.user_shared.users[0].user_id
@@ -150,86 +175,94 @@ async def handle_user_shared(message: types.Message, bot: AsyncTeleBot, db: Asyn
     await update_data(bot, message.from_user.id, message.chat.id, user_id=int(for_user_id))
 
 
-async def handle_get_my_notes(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
-    user_id = message.from_user.id
-    notes = await crud.get_notes_by_user_id(db, user_id)
-    
-    if not notes:
-        logger.info(f"User {user_id} has no notes yet")
-        await bot.send_message(message.chat.id, "Вы ещё никому не оставляли посланий. Используйте команду /note чтобы создать новое послание")
-        return
-    
-    logger.info(f"User {user_id} requested their notes list - {len(notes)} notes found")
-    
-    top_message = f"Вы оставили {len(notes)} послание(ий):\n\n"
+def render_notes_list(notes: list, total: int, has_prev: bool, has_next: bool,
+                      after_note_id: int | None = None, before_note_id: int | None = None) -> tuple[str, types.InlineKeyboardMarkup]:
+    """
+    Собирает текст и клавиатуру одной страницы списка посланий из результата crud.get_notes_page.
+    after_note_id и before_note_id - курсор, которым получена страница
+    """
+    top_message = f"📒 Вы оставили {total} послание(ий):\n\n"
 
     markup = types.InlineKeyboardMarkup()
 
     for note in notes:
-        for_who = await crud.get_user_by_id(db, note.for_user_id)
-        if for_who:
-            for_who = escape_html(for_who.first_name)
-        else:
-            for_who = str(note.for_user_id)
+        for_who = escape_html(note.first_name) if note.first_name else str(note.for_user_id)
 
         read_status = "✅" if note.fake_is_read else "❌"
         top_message += f"{read_status} Для `{for_who}` в {note.created_at.strftime('%Y-%m-%d %H:%M:%S')}\n"
-        
+
         button = types.InlineKeyboardButton(
             text=f"{read_status} Послание для {for_who}",
-            callback_data=f"view_note_{note.id}"
+            callback_data=VIEW_NOTE.pack(note_id=note.id, after_note_id=after_note_id, before_note_id=before_note_id)
         )
         markup.add(button)
+
+    navigation = []
+    if has_prev and notes:
+        navigation.append(types.InlineKeyboardButton(text="⬅️", callback_data=NOTES_LIST.pack(before_note_id=notes[0].id)))
+    if has_next and notes:
+        navigation.append(types.InlineKeyboardButton(text="➡️", callback_data=NOTES_LIST.pack(after_note_id=notes[-1].id)))
+    if navigation:
+        markup.row(*navigation)
+
+    return top_message, markup
+
+
+async def handle_get_my_notes(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
+    user_id = message.from_user.id
+    total = await crud.count_notes_by_user_id(db, user_id)
+    
+    if not total:
+        logger.info("User %s has no notes yet", user_id)
+        await bot.send_message(message.chat.id, "Вы ещё никому не оставляли посланий. Используйте команду /note чтобы создать новое послание")
+        return
     
+    logger.info("User %s requested their notes list - %s notes found", user_id, total)
+    
+    notes, has_prev, has_next = await crud.get_notes_page(db, user_id, NOTES_PAGE_SIZE)
+    top_message, markup = render_notes_list(notes, total, has_prev, has_next)
     await bot.send_message(message.chat.id, top_message, reply_markup=markup, parse_mode='Markdown')
 
 
 async def handle_buy_unread(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
     chat_id = message.chat.id
     user_id = message.from_user.id
-    logger.info(f"User {user_id} initiated purchase of unread cancels")
+    logger.info("User %s initiated purchase of unread cancels", user_id)
     
     markup = types.InlineKeyboardMarkup()
     button = types.InlineKeyboardButton(
         text="Отменить покупку",
-        callback_data="cancel_purchase"
+        callback_data=CANCEL_PURCHASE.pack()
     )
     markup.add(button)
     await bot.send_message(chat_id, f"Одна отмена прочтения стоит {COST} звёзд. Отправьте количество отмен, которое хотите купить:", reply_markup=markup)
     await bot.set_state(user_id, NoteStates.waiting_for_unread_quantity, chat_id)
 
 
-async def handle_hide_read_callback(call: types.CallbackQuery, bot: AsyncTeleBot, db: AsyncSession):
-    data = call.data
+async def handle_hide_read_callback(call: types.CallbackQuery, bot: AsyncTeleBot, db: AsyncSession, note_id: int):
     user_id = call.from_user.id
     message_id = call.message.message_id
     chat_id = call.message.chat.id
 
-    if not data.startswith("hide_read_"):
-        return
-    
-    note_id = int(data.split("_")[-1])
-    note = await crud.get_note_by_id(db, note_id)
-    if not note:
-        logger.warning(f"User {user_id} tried to hide read for non-existent note {note_id}")
-        await bot.answer_callback_query(call.id, "Послание не найдено")
-        return
-    
-    if note.for_user_id != user_id:
-        logger.warning(f"User {user_id} attempted to hide read for someone else's note {note_id}")
-        await bot.answer_callback_query(call.id, "Кого-то по рукам отшлёпать?")
+    balance = await crud.spend_read_cancel(db, user_id, note_id)
+    if balance is None:
+        # Ничего не списано - выясняем почему, это уже не горячий путь
+        note = await crud.get_note_by_id(db, note_id)
+        if not note:
+            logger.warning("User %s tried to hide read for non-existent note %s", user_id, note_id)
+            await bot.answer_callback_query(call.id, "Послание не найдено")
+        elif note.for_user_id != user_id:
+            logger.warning("User %s attempted to hide read for someone else's note %s", user_id, note_id)
+            await bot.answer_callback_query(call.id, "Кого-то по рукам отшлёпать?")
+        elif not note.fake_is_read:
+            logger.info("User %s tried to hide read for note %s that is already hidden", user_id, note_id)
+            await bot.answer_callback_query(call.id, "Прочтение этого послания уже скрыто")
+        else:
+            logger.info("User %s has insufficient read cancels", user_id)
+            await bot.answer_callback_query(call.id, "У вас недостаточно отмен прочтения. Купите их командой /buy_unread")
         return
-    
 
-    user = await crud.get_user_by_id(db, note.for_user_id)
-    if user.count_read_cancel <= 0:
-        logger.info(f"User {user_id} has insufficient read cancels (balance: {user.count_read_cancel})")
-        await bot.answer_callback_query(call.id, "У вас недостаточно отмен прочтения. Купите их командой /buy_unread")
-        return
-    
-    logger.info(f"User {user_id} hiding read for note {note_id}, balance decreased from {user.count_read_cancel} to {user.count_read_cancel - 1}")
-    await crud.set_note_as_unread(db, note_id)
-    await crud.update_user_balance(db, user_id, -1)
+    logger.info("User %s hid read for note %s, balance is now %s", user_id, note_id, balance)
     await bot.edit_message_text("Прочтение этого сообщения скрыто. Перейдите по ссылке пользователя ещё раз, если хотите пометить послание прочитанным", chat_id, message_id)
 
 
@@ -238,7 +271,7 @@ async def handle_cancel_purchase_callback(call: types.CallbackQuery, bot: AsyncT
     chat_id = call.message.chat.id
     user_id = call.from_user.id
 
-    logger.info(f"User {user_id} cancelled purchase process")
+    logger.info("User %s cancelled purchase process", user_id)
     await bot.delete_state(user_id, chat_id)
     await bot.edit_message_text("Покупка отменена.", chat_id, message_id)
 
@@ -246,18 +279,17 @@ async def handle_cancel_purchase_callback(call: types.CallbackQuery, bot: AsyncT
 async def handle_unread_quantity(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
     chat_id = message.chat.id
     user_id = message.from_user.id
-    state = await bot.get_state(user_id, chat_id)
     
     quantity_text = message.text.strip()
     if not quantity_text.isdigit() or int(quantity_text) <= 0:
-        logger.warning(f"User {user_id} entered invalid quantity: {quantity_text}")
+        logger.warning("User %s entered invalid quantity: %s", user_id, quantity_text)
         await bot.send_message(chat_id, "Пожалуйста, введите корректное число")
         return
 
     quantity = int(quantity_text)
     total_cost = quantity * COST
 
-    logger.info(f"User {user_id} purchasing {quantity} read cancels for {total_cost} stars")
+    logger.info("User %s purchasing %s read cancels for %s stars", user_id, quantity, total_cost)
     await bot.delete_state(user_id, chat_id)
     await bot.send_invoice(
         chat_id,
@@ -271,26 +303,22 @@ async def handle_unread_quantity(message: types.Message, bot: AsyncTeleBot, db:
 
 
 
-async def handle_view_note_callback(call: types.CallbackQuery, bot: AsyncTeleBot, db: AsyncSession):
-    data = call.data
+async def handle_view_note_callback(call: types.CallbackQuery, bot: AsyncTeleBot, db: AsyncSession, note_id: int,
+                                    after_note_id: int | None = None, before_note_id: int | None = None):
     message_id = call.message.message_id
     chat_id = call.message.chat.id
 
-    if not data.startswith("view_note_"):
-        return
-    note_id = int(data.split("_")[-1])
-
     note = await crud.get_note_by_id(db, note_id)
     if not note:
-        logger.warning(f"User {call.from_user.id} tried to view non-existent note {note_id}")
+        logger.warning("User %s tried to view non-existent note %s", call.from_user.id, note_id)
         await bot.answer_callback_query(call.id, "Послание не найдено.")
         return
     if note.created_by_user_id != call.from_user.id:
-        logger.warning(f"User {call.from_user.id} attempted to view note {note_id} created by {note.created_by_user_id}")
+        logger.warning("User %s attempted to view note %s created by %s", call.from_user.id, note_id, note.created_by_user_id)
         await bot.answer_callback_query(call.id, "Вы не можете просматривать это послание.")
         return
     
-    logger.info(f"User {call.from_user.id} viewing note {note_id} for user {note.for_user_id}")
+    logger.info("User %s viewing note %s for user %s", call.from_user.id, note_id, note.for_user_id)
     
     for_who = await crud.get_user_by_id(db, note.for_user_id)
     if for_who:
@@ -305,19 +333,20 @@ async def handle_view_note_callback(call: types.CallbackQuery, bot: AsyncTeleBot
     top_message += f"📅 Создано: {note.created_at.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
     top_message += f"💬 Текст:\n{escape_html(note.text)}"
 
+    page = {"after_note_id": after_note_id, "before_note_id": before_note_id}
     markup = types.InlineKeyboardMarkup()
     button_edit = types.InlineKeyboardButton(
         text="✏️ Редактировать",
-        callback_data=f"edit_note_{note.id}"
+        callback_data=EDIT_NOTE.pack(note_id=note.id, **page)
     )
     button_delete = types.InlineKeyboardButton(
         text="🗑️ Удалить",
-        callback_data=f"delete_note_{note.id}"
+        callback_data=DELETE_NOTE.pack(note_id=note.id, **page)
     )
     
     button_back = types.InlineKeyboardButton(
         text="⬅️ Назад",
-        callback_data="back_to_notes"
+        callback_data=NOTES_LIST.pack(**page)
     )
     
     markup.add(button_edit, button_delete)
@@ -326,132 +355,113 @@ async def handle_view_note_callback(call: types.CallbackQuery, bot: AsyncTeleBot
     await bot.edit_message_text(top_message, chat_id, message_id, parse_mode='HTML', reply_markup=markup)
 
 
-async def handle_edit_note_callback(call: types.CallbackQuery, bot: AsyncTeleBot, db: AsyncSession):
-    data = call.data
+async def handle_edit_note_callback(call: types.CallbackQuery, bot: AsyncTeleBot, db: AsyncSession, note_id: int,
+                                    after_note_id: int | None = None, before_note_id: int | None = None):
     message_id = call.message.message_id
     chat_id = call.message.chat.id
     user_id = call.from_user.id
 
-    if not data.startswith("edit_note_"):
-        return
-    
-    note_id = int(data.split("_")[-1])
     note = await crud.get_note_by_id(db, note_id)
     if not note:
-        logger.warning(f"User {user_id} tried to edit non-existent note {note_id}")
+        logger.warning("User %s tried to edit non-existent note %s", user_id, note_id)
         await bot.answer_callback_query(call.id, "Послание не найдено")
         return
     
     if note.created_by_user_id != call.from_user.id:
-        logger.warning(f"User {user_id} attempted to edit note {note_id} created by {note.created_by_user_id}")
+        logger.warning("User %s attempted to edit note %s created by %s", user_id, note_id, note.created_by_user_id)
         await bot.answer_callback_query(call.id, "Кого-то по рукам отшлёпать?")
         return
 
-    logger.info(f"User {user_id} starting edit of note {note_id}")
+    logger.info("User %s starting edit of note %s", user_id, note_id)
     top_message = f"Отправьте новый текст посания:"
 
     await bot.set_state(user_id, NoteStates.waiting_for_update_note_text, chat_id)
-    await update_data(bot, user_id, chat_id, note_id=note_id)
+    await update_data(bot, user_id, chat_id, note_id=note_id,
+                      notes_page={"after_note_id": after_note_id, "before_note_id": before_note_id})
     await bot.edit_message_text(top_message, chat_id, message_id)
 
 async def handle_update_note_text(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
     user_id = message.from_user.id
     chat_id = message.chat.id
-    state = await bot.get_state(user_id, chat_id)
     
     note_id: str = await get_data(bot, user_id, chat_id, "note_id")
+    notes_page = await get_data(bot, user_id, chat_id, "notes_page") or {}
 
     note_text = message.text.strip()
     new_note = await crud.update_note_text(db, note_id, note_text)
     if not new_note:
-        logger.warning(f"User {user_id} tried to update non-existent note {note_id}")
+        logger.warning("User %s tried to update non-existent note %s", user_id, note_id)
         await bot.send_message(chat_id, "Этого послания не существует. Вы можете отправить новое командой /note")
         return 
     
-    logger.info(f"User {user_id} successfully updated note {note_id}")
+    logger.info("User %s successfully updated note %s", user_id, note_id)
     
     markup = types.InlineKeyboardMarkup()
     button_back = types.InlineKeyboardButton(
         text="Назад",
-        callback_data="back_to_notes"
+        callback_data=NOTES_LIST.pack(**notes_page)
     )
     markup.add(button_back)
 
     await bot.send_message(chat_id, "Послание успешно обновлено!", reply_markup=markup)
     await bot.delete_state(user_id, chat_id)
     
-async def handle_delete_note_callback(call: types.CallbackQuery, bot: AsyncTeleBot, db: AsyncSession):
-    data = call.data
+async def handle_delete_note_callback(call: types.CallbackQuery, bot: AsyncTeleBot, db: AsyncSession, note_id: int,
+                                      after_note_id: int | None = None, before_note_id: int | None = None):
     message_id = call.message.message_id
     chat_id = call.message.chat.id
 
-    if not data.startswith("delete_note_"):
-        return
-    note_id = int(data.split("_")[-1])
-
     note = await crud.get_note_by_id(db, note_id)
     if not note:
-        logger.warning(f"User {call.from_user.id} tried to delete non-existent note {note_id}")
+        logger.warning("User %s tried to delete non-existent note %s", call.from_user.id, note_id)
         await bot.answer_callback_query(call.id, "Послание не найдено.")
         return
     if note.created_by_user_id != call.from_user.id:
-        logger.warning(f"User {call.from_user.id} attempted to delete note {note_id} created by {note.created_by_user_id}")
+        logger.warning("User %s attempted to delete note %s created by %s", call.from_user.id, note_id, note.created_by_user_id)
         await bot.answer_callback_query(call.id, "Вы не можете удалять это послание.")
         return
     
     markup = types.InlineKeyboardMarkup()
     button_back = types.InlineKeyboardButton(
         text="Назад",
-        callback_data="back_to_notes"
+        callback_data=NOTES_LIST.pack(after_note_id=after_note_id, before_note_id=before_note_id)
     )
     markup.add(button_back)
 
     success = await crud.delete_note_by_id(db, note_id)
     if success:
-        logger.info(f"User {call.from_user.id} successfully deleted note {note_id}")
+        logger.info("User %s successfully deleted note %s", call.from_user.id, note_id)
         await bot.edit_message_text("Послание удалено.", chat_id, message_id, reply_markup=markup)
     else:
-        logger.error(f"User {call.from_user.id} failed to delete note {note_id}")
+        logger.error("User %s failed to delete note %s", call.from_user.id, note_id)
         await bot.answer_callback_query(call.id, "Не удалось удалить послание.")
     
 
-async def handle_back_to_notes_callback(call: types.CallbackQuery, bot: AsyncTeleBot, db: AsyncSession):
+async def handle_back_to_notes_callback(call: types.CallbackQuery, bot: AsyncTeleBot, db: AsyncSession,
+                                        after_note_id: int | None = None, before_note_id: int | None = None):
     message_id = call.message.message_id
     chat_id = call.message.chat.id
     user_id = call.from_user.id
 
-    logger.info(f"User {user_id} navigating back to notes list")
+    logger.info("User %s navigating to notes list (after=%s, before=%s)", user_id, after_note_id, before_note_id)
     await bot.delete_state(user_id, chat_id)
-    notes = await crud.get_notes_by_user_id(db, user_id)
-    if not notes:
+    total = await crud.count_notes_by_user_id(db, user_id)
+    if not total:
         await bot.send_message(chat_id, "Вы ещё никому не оставляли посланий. Используйте команду /note чтобы создать новое послание")
         return
     
-    top_message = f"📒 Вы оставили {len(notes)} послание(ий):\n\n"
-
-    markup = types.InlineKeyboardMarkup()
+    notes, has_prev, has_next = await crud.get_notes_page(db, user_id, NOTES_PAGE_SIZE, after_note_id=after_note_id, before_note_id=before_note_id)
+    if not notes:
+        # Послание-курсор успело удалиться, возвращаемся на первую страницу
+        after_note_id = before_note_id = None
+        notes, has_prev, has_next = await crud.get_notes_page(db, user_id, NOTES_PAGE_SIZE)
 
-    for note in notes:
-        for_who = await crud.get_user_by_id(db, note.for_user_id)
-        if for_who:
-            for_who = escape_html(for_who.first_name)
-        else:
-            for_who = str(note.for_user_id)
-        
-        read_status = "✅" if note.fake_is_read else "❌"
-        top_message += f"{read_status} Для `{for_who}` в {note.created_at.strftime('%Y-%m-%d %H:%M:%S')}\n"
-        
-        button = types.InlineKeyboardButton(
-            text=f"{read_status} Послание для {for_who}",
-            callback_data=f"view_note_{note.id}"
-        )
-        markup.add(button)
-    
+    top_message, markup = render_notes_list(notes, total, has_prev, has_next, after_note_id, before_note_id)
     await bot.edit_message_text(top_message, chat_id, message_id, reply_markup=markup, parse_mode='Markdown')
 
 
 async def handle_pre_checkout_query(pre_checkout_query: types.PreCheckoutQuery, bot: AsyncTeleBot, db: AsyncSession):
-    logger.info(f"Pre-checkout query from user {pre_checkout_query.from_user.id}")
+    logger.info("Pre-checkout query from user %s", pre_checkout_query.from_user.id)
     await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
 
@@ -460,27 +470,31 @@ async def handle_successful_payment(message: types.Message, bot: AsyncTeleBot, d
         payment_info = message.successful_payment
         user_id = message.from_user.id
         
-        logger.info(f"Successful payment from user {user_id}, amount: {payment_info.total_amount}")
+        logger.info("Successful payment from user %s, amount: %s", user_id, payment_info.total_amount)
         
         if not payment_info.invoice_payload.startswith('buy_unread_'):
-            logger.warning(f"Unknown invoice payload from user {user_id}: {payment_info.invoice_payload}")
+            logger.warning("Unknown invoice payload from user %s: %s", user_id, payment_info.invoice_payload)
             return
             
         payload_parts = payment_info.invoice_payload.split('_')
         if len(payload_parts) != 4:
-            logger.warning(f"Invalid payload format from user {user_id}: {payment_info.invoice_payload}")
+            logger.warning("Invalid payload format from user %s: %s", user_id, payment_info.invoice_payload)
             return
             
         quantity = int(payload_parts[-1])  
         
-        user, admin_panel = await crud.process_payment(
+        user, admin_panel, credited = await crud.process_payment(
             db, 
             user_id=user_id,
             quantity=quantity,
-            total_cost=payment_info.total_amount
+            total_cost=payment_info.total_amount,
+            telegram_payment_charge_id=payment_info.telegram_payment_charge_id
         )
         
-        logger.info(f"Payment processed for user {user_id}: {quantity} cancels, new balance: {user.count_read_cancel}")
+        if not credited:
+            logger.warning("Duplicate payment %s from user %s ignored, balance: %s", payment_info.telegram_payment_charge_id, user_id, user.count_read_cancel)
+        else:
+            logger.info("Payment processed for user %s: %s cancels, new balance: %s", user_id, quantity, user.count_read_cancel)
         
         await bot.send_message(
             message.chat.id, 
@@ -488,16 +502,16 @@ async def handle_successful_payment(message: types.Message, bot: AsyncTeleBot, d
             f"💰 Ваш текущий баланс: {user.count_read_cancel} отмен"
         )
     except Exception as e:
-        logger.error(f"Payment processing error for user {message.from_user.id}: {e}")
+        logger.error("Payment processing error for user %s: %s", message.from_user.id, e)
         await bot.send_message(message.chat.id, "❌ Произошла ошибка при обработке платежа")
 
 
 async def handle_admin(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
     if message.from_user.id != ADMIN_ID:
-        logger.warning(f"User {message.from_user.id} attempted to access admin panel")
+        logger.warning("User %s attempted to access admin panel", message.from_user.id)
         return
         
-    logger.info(f"Admin {message.from_user.id} accessed admin panel")
+    logger.info("Admin %s accessed admin panel", message.from_user.id)
     
     admin_panel = await crud.get_admin_panel(db)
     if not admin_panel:
@@ -509,13 +523,117 @@ async def handle_admin(message: types.Message, bot: AsyncTeleBot, db: AsyncSessi
     top_message += f"💰 Общая прибыль: {admin_panel.total_earnings} звёзд\n"
     top_message += f"📖 Куплено отмен прочтения: {admin_panel.total_read_cancels_sold}\n"
     top_message += f"👤 ID Администратора: {admin_panel.admin_user_id}\n\n"
-    top_message += f"Бот работает с {admin_panel.last_restart.strftime('%Y-%m-%d %H:%M:%S')} (МСК)\n"
+    top_message += f"Бот работает с {admin_panel.last_restart.strftime('%Y-%m-%d %H:%M:%S')} (МСК)\n\n"
+
+    cache_stats = crud.get_cache_stats()
+    for name, stats in cache_stats.items():
+        top_message += f"🗄 Кэш {name}: {stats['size']} записей, попаданий {stats['hits']}, промахов {stats['misses']} ({stats['hit_rate']:.0%})\n"
+
+    if read_receipts.enabled:
+        receipts = read_receipts.stats()
+        top_message += f"👁 Отметки о прочтении: ждут записи {receipts['pending']}, записано {receipts['flushed']} за {receipts['flushes']} раз\n"
+
+    if registrations.enabled:
+        registered = registrations.stats()
+        top_message += f"🆕 Регистрации: ждут записи {registered['pending']}, записано {registered['flushed']} за {registered['flushes']} раз\n"
+
+    last_run = retention.last_run
+    if last_run is not None:
+        action = "было бы убрано" if last_run["dry_run"] else ("перенесено в архив" if last_run["mode"] == "archive" else "удалено")
+        top_message += f"🗄 Срок хранения: за последний проход посланий {action} {last_run['notes']} за {last_run['seconds']:.1f} с, "\
+                       f"всего убрано {retention.purged_notes} за {retention.runs} проходов\n"
+
+    sender = getattr(bot, "sender", None)
+    if sender is not None:
+        send_stats = sender.stats()
+        queued = ", ".join(f"{lane} {depth}" for lane, depth in send_stats["queued"].items())
+        top_message += f"📤 Отправка: в очереди {queued}; отправлено {send_stats['sent']}, повторов {send_stats['retried']}, ошибок {send_stats['failed']}; "\
+                       f"задержка p50 {send_stats['latency_p50'] * 1000:.0f} мс, p99 {send_stats['latency_p99'] * 1000:.0f} мс\n"
+
+    handlers = metrics.handlers_summary()
+    if handlers:
+        top_message += "\n⏱ Обработчики (самые медленные первыми):\n"
+        for row in handlers[:10]:
+            top_message += f"{escape_html(row['handler'])}: {row['count']} вызовов, p50 ≤{row['p50'] * 1000:.0f} мс, p95 ≤{row['p95'] * 1000:.0f} мс; "\
+                           f"в среднем {row['statements']:.1f} SQL-запросов, бд {row['db_time'] * 1000:.1f} мс, Telegram {row['telegram_time'] * 1000:.0f} мс\n"
+
+    top_message += "\n📊 Статистика по дням: /stats, выгрузка данных: /export"
+    await bot.send_message(message.chat.id, top_message)
+
+
+async def handle_stats(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
+    if message.from_user.id != ADMIN_ID:
+        logger.warning("User %s attempted to access stats", message.from_user.id)
+        return
+
+    logger.info("Admin %s requested stats", message.from_user.id)
+    # Из агрегатов daily_stats и creator_stats: время зависит от числа дней, а не посланий
+    days = await crud.get_daily_stats(db, STATS_TOTAL_DAYS)
+    top_creators = await crud.get_top_creators(db, STATS_TOP_CREATORS)
+
+    totals = {name: sum(getattr(day, name) for day in days)
+              for name in ("new_users", "notes_created", "notes_read", "payments", "earnings", "read_cancels_sold", "read_cancels_spent")}
+    read_rate = totals["notes_read"] / totals["notes_created"] if totals["notes_created"] else 0
+    top_message = f"📊 За {STATS_TOTAL_DAYS} дней (UTC):\n"
+    top_message += f"👤 Новых пользователей: {totals['new_users']}, активных в среднем за день: {sum(day.active_users for day in days) / STATS_TOTAL_DAYS:.0f}\n"
+    top_message += f"✍️ Посланий: {totals['notes_created']}, 👁 прочтений: {totals['notes_read']} ({read_rate:.0%})\n"
+    top_message += f"💰 Оплат: {totals['payments']} на {totals['earnings']} звёзд, отмен куплено {totals['read_cancels_sold']}, потрачено {totals['read_cancels_spent']}\n"
+
+    top_message += "\n📅 По дням:\n"
+    recent = [day for day in days if day.day > today() - datetime.timedelta(days=STATS_DAYS)]
+    if not recent:
+        top_message += "Пока ничего не произошло\n"
+    for day in recent:
+        top_message += f"{day.day.strftime('%d.%m')}: 👤 +{day.new_users}, активных {day.active_users}; "\
+                       f"✍️ {day.notes_created}, 👁 {day.notes_read}; 💰 {day.payments} ({day.earnings} ⭐), скрыто {day.read_cancels_spent}\n"
+
+    if top_creators:
+        top_message += "\n🏆 Авторы с наибольшим числом прочтений:\n"
+        for number, creator in enumerate(top_creators, start=1):
+            name = create_user_link(creator.user_id, creator.first_name or str(creator.user_id))
+            top_message += f"{number}. {name}: прочитано {creator.notes_read} из {creator.notes_created}\n"
 
     await bot.send_message(message.chat.id, top_message)
 
 
+async def handle_export(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
+    if message.from_user.id != ADMIN_ID:
+        logger.warning("User %s attempted to export data", message.from_user.id)
+        return
+
+    message_parts = message.text.split()
+    file_format = message_parts[1].lower() if len(message_parts) > 1 else "csv"
+    if file_format not in EXPORT_FORMATS:
+        await bot.send_message(message.chat.id, f"Формат выгрузки: {' или '.join(EXPORT_FORMATS)}, например /export jsonl")
+        return
+
+    logger.info("Admin %s started %s export", message.from_user.id, file_format)
+    await bot.send_message(message.chat.id, "⏳ Готовлю выгрузку...")
+    file_name = f"export_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{file_format}.zip"
+    fd, path = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    try:
+        counts = await export_tables(db, path, file_format)
+        # Выгрузка закончена, соединение с базой на время загрузки файла не нужно
+        await release_connection()
+        size = os.path.getsize(path)
+        logger.info("Export of %s finished: %s bytes", counts, size)
+        if size > TELEGRAM_DOCUMENT_LIMIT:
+            await bot.send_message(message.chat.id, f"❌ Архив занимает {size / 1024 / 1024:.1f} МБ, Telegram принимает от бота файлы до 50 МБ")
+            return
+        caption = ", ".join(f"{name}: {count}" for name, count in counts.items())
+        # Мимо очереди отправки: при повторе после 429 файл пришлось бы читать заново
+        with open(path, "rb") as file:
+            await bot.send_document(message.chat.id, types.InputFile(file, file_name), caption=caption)
+    except Exception as e:
+        logger.error("Export failed for admin %s: %s", message.from_user.id, e)
+        await bot.send_message(message.chat.id, "❌ Не удалось сделать выгрузку")
+    finally:
+        os.remove(path)
+
+
 async def handle_help(message: types.Message, bot: AsyncTeleBot, db: AsyncSession):
-    logger.info(f"User {message.from_user.id} requested help")
+    logger.info("User %s requested help", message.from_user.id)
     
     help_text = "📖 Помощь по боту:\n\n" \
     "/start - Запустить бота\n" \
@@ -552,19 +670,27 @@ def register_handlers(bot: AsyncTeleBot):
     bot.register_message_handler(db_handler(handle_help), commands=["help"], pass_bot=True)
 
     bot.register_pre_checkout_query_handler(db_handler(handle_pre_checkout_query), func=lambda query: True, pass_bot=True)
-    bot.register_message_handler(db_handler(handle_successful_payment), content_types=['successful_payment'], pass_bot=True)
+    bot.register_message_handler(with_priority(Priority.PAYMENT, db_handler(handle_successful_payment)), content_types=['successful_payment'], pass_bot=True)
     bot.register_message_handler(db_handler(handle_buy_unread), commands=["buy_unread"], pass_bot=True)
-    bot.register_message_handler(db_handler(handle_unread_quantity), func=create_state_filter(NoteStates.waiting_for_unread_quantity, bot), pass_bot=True, content_types=['text'])
 
     bot.register_message_handler(db_handler(handle_admin), commands=["admin"], pass_bot=True)
-
-    bot.register_callback_query_handler(callback=db_handler(handle_view_note_callback), func=lambda call: call.data and call.data.startswith("view_note_"), pass_bot=True)
-    bot.register_callback_query_handler(callback=db_handler(handle_edit_note_callback), func=lambda call: call.data and call.data.startswith("edit_note_"), pass_bot=True)
-    bot.register_callback_query_handler(callback=db_handler(handle_delete_note_callback), func=lambda call: call.data and call.data.startswith("delete_note_"), pass_bot=True)
-    bot.register_callback_query_handler(callback=db_handler(handle_back_to_notes_callback), func=lambda call: call.data == "back_to_notes", pass_bot=True)
-    bot.register_callback_query_handler(callback=db_handler(handle_cancel_purchase_callback), func=lambda call: call.data == "cancel_purchase", pass_bot=True)
-    bot.register_callback_query_handler(callback=db_handler(handle_hide_read_callback), func=lambda call: call.data and call.data.startswith("hide_read_"), pass_bot=True)
-
-    bot.register_message_handler(db_handler(process_user_id), func=create_state_filter(NoteStates.waiting_for_user_id, bot), pass_bot=True, content_types=['text'])
-    bot.register_message_handler(db_handler(process_note_text), func=create_state_filter(NoteStates.waiting_for_note_text, bot), pass_bot=True, content_types=['text'])
-    bot.register_message_handler(db_handler(handle_update_note_text), func=create_state_filter(NoteStates.waiting_for_update_note_text, bot), pass_bot=True, content_types=['text'])
+    bot.register_message_handler(db_handler(handle_stats), commands=["stats"], pass_bot=True)
+    bot.register_message_handler(db_handler(handle_export), commands=["export"], pass_bot=True)
+
+    # Inline-кнопки: один обработчик, действие выбирается по коду из callback_data
+    callback_router = CallbackRouter(bot)
+    callback_router.register(VIEW_NOTE, db_handler(handle_view_note_callback))
+    callback_router.register(EDIT_NOTE, db_handler(handle_edit_note_callback))
+    callback_router.register(DELETE_NOTE, db_handler(handle_delete_note_callback))
+    callback_router.register(NOTES_LIST, db_handler(handle_back_to_notes_callback))
+    callback_router.register(CANCEL_PURCHASE, db_handler(handle_cancel_purchase_callback))
+    callback_router.register(HIDE_READ, db_handler(handle_hide_read_callback))
+    callback_router.install()
+
+    # Текстовые сообщения внутри диалогов: одно чтение состояния на апдейт вместо фильтра на каждое состояние
+    state_router = StateRouter(bot)
+    state_router.register(NoteStates.waiting_for_user_id, db_handler(process_user_id))
+    state_router.register(NoteStates.waiting_for_note_text, db_handler(process_note_text))
+    state_router.register(NoteStates.waiting_for_update_note_text, db_handler(handle_update_note_text))
+    state_router.register(NoteStates.waiting_for_unread_quantity, db_handler(handle_unread_quantity))
+    state_router.install()
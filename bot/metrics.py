@@ -0,0 +1,228 @@
+import bisect
+import contextvars
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Sequence
+
+import aiohttp
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from telebot import asyncio_helper
+
+from global_logger import logger
+
+
+class Histogram:
+    """
+    Гистограмма в формате Prometheus с одной меткой.
+    Хранит только счётчики по корзинам, сумму и количество наблюдений.
+    """
+
+    def __init__(self, name: str, documentation: str, label: str, buckets: Sequence[float]):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = list(buckets)
+        # значение метки -> [счётчики по корзинам (последняя - +Inf), сумма, количество]
+        self._series: Dict[str, list] = {}
+
+    def observe(self, label_value: str, value: float) -> None:
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def labels(self) -> List[str]:
+        return list(self._series)
+
+    def count(self, label_value: str) -> int:
+        series = self._series.get(label_value)
+        return series[2] if series else 0
+
+    def mean(self, label_value: str) -> float:
+        series = self._series.get(label_value)
+        return series[1] / series[2] if series and series[2] else 0.0
+
+    def quantile(self, label_value: str, q: float) -> float:
+        """
+        Оценка квантиля сверху: граница корзины, в которую он попадает
+        """
+        series = self._series.get(label_value)
+        if not series or not series[2]:
+            return 0.0
+        rank = q * series[2]
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, series[0]):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total, count) in self._series.items():
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 7, 10, 15, 25, 50)
+
+handler_seconds = Histogram("bot_handler_seconds", "Wall time of a handler", "handler", TIME_BUCKETS)
+handler_sql_statements = Histogram("bot_handler_sql_statements", "SQL statements executed by a handler", "handler", COUNT_BUCKETS)
+handler_db_seconds = Histogram("bot_handler_db_seconds", "Time a handler spent in SQL statements", "handler", TIME_BUCKETS)
+handler_telegram_seconds = Histogram("bot_handler_telegram_seconds", "Time a handler spent in Telegram API calls", "handler", TIME_BUCKETS)
+telegram_api_seconds = Histogram("bot_telegram_api_seconds", "Duration of a Telegram Bot API request", "method", TIME_BUCKETS)
+
+HISTOGRAMS = (handler_seconds, handler_sql_statements, handler_db_seconds, handler_telegram_seconds, telegram_api_seconds)
+
+
+class HandlerStats:
+    """
+    Счётчики одного вызова обработчика, которые накапливают события engine и aiohttp
+    """
+    __slots__ = ("statements", "db_time", "telegram_time")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.telegram_time = 0.0
+
+
+current_stats: contextvars.ContextVar[Optional[HandlerStats]] = contextvars.ContextVar("current_stats", default=None)
+
+
+@asynccontextmanager
+async def track_handler(name: str):
+    """
+    Замеряет время обработчика name, его SQL-запросы и запросы к Telegram
+    """
+    stats = HandlerStats()
+    token = current_stats.set(stats)
+    started = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        current_stats.reset(token)
+        handler_seconds.observe(name, time.perf_counter() - started)
+        handler_sql_statements.observe(name, stats.statements)
+        handler_db_seconds.observe(name, stats.db_time)
+        handler_telegram_seconds.observe(name, stats.telegram_time)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    stats = current_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += time.perf_counter() - started
+
+
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_started"):
+        connection.info["query_started"].pop()
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    Подписывается на события engine, чтобы считать запросы и время в базе по обработчикам
+    """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+async def _on_request_start(session, trace_config_ctx, params):
+    trace_config_ctx.started = time.perf_counter()
+
+
+async def _on_request_end(session, trace_config_ctx, params):
+    elapsed = time.perf_counter() - trace_config_ctx.started
+    telegram_api_seconds.observe(params.url.path.rsplit("/", 1)[-1], elapsed)
+    stats = current_stats.get()
+    if stats is not None:
+        stats.telegram_time += elapsed
+
+
+class TracedSessionManager(asyncio_helper.SessionManager):
+    """
+    Сессия aiohttp для запросов telebot с замером времени каждого запроса к Bot API
+    """
+
+    async def create_session(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(_on_request_start)
+        trace_config.on_request_end.append(_on_request_end)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=asyncio_helper.REQUEST_LIMIT,
+            ssl=self.ssl_context
+        ), trace_configs=[trace_config])
+        return self.session
+
+
+def instrument_telegram() -> None:
+    """
+    Подменяет менеджер сессий telebot на замеряющий время запросов
+    """
+    asyncio_helper.session_manager = TracedSessionManager()
+
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
+
+
+def handlers_summary() -> List[dict]:
+    """
+    Сводка по обработчикам для /admin, самые медленные (по p95) первыми
+    """
+    summary = [{
+        "handler": name,
+        "count": handler_seconds.count(name),
+        "p50": handler_seconds.quantile(name, 0.5),
+        "p95": handler_seconds.quantile(name, 0.95),
+        "statements": handler_sql_statements.mean(name),
+        "db_time": handler_db_seconds.mean(name),
+        "telegram_time": handler_telegram_seconds.mean(name),
+    } for name in handler_seconds.labels()]
+    summary.sort(key=lambda row: row["p95"], reverse=True)
+    return summary
+
+
+async def start_metrics_server(host: str, port: int) -> Optional[web.AppRunner]:
+    """
+    Поднимает HTTP-сервер, отдающий метрики на /metrics в формате Prometheus.
+    Если порт занят, бот работает без сервера метрик: возвращается None.
+    """
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        await runner.cleanup()
+        logger.error("Metrics server not started on %s:%s: %s", host, port, e)
+        return None
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+    return runner
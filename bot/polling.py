@@ -0,0 +1,42 @@
+import asyncio
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiException, RequestTimeout
+
+from bot.dispatcher import UpdateDispatcher
+from global_logger import logger
+
+
+# Пауза после ошибки getUpdates растёт вдвое, но не больше MAX_ERROR_INTERVAL секунд
+ERROR_INTERVAL = 0.25
+MAX_ERROR_INTERVAL = 30
+
+
+async def run_polling(bot: AsyncTeleBot, queue_size: int, workers: int, timeout: int = 20) -> None:
+    """
+    Запускает бота в режиме polling и работает до отмены.
+    В отличие от bot.polling, апдейты разбирает UpdateDispatcher: апдейты
+    одного пользователя по очереди, разных пользователей параллельно.
+    Когда очередь полна, следующий getUpdates ждёт, пока она освободится.
+    """
+    dispatcher = UpdateDispatcher(bot, queue_size, workers)
+    dispatcher.start()
+    logger.info("Polling started with %s workers", workers)
+    offset = None
+    error_interval = ERROR_INTERVAL
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=timeout, request_timeout=timeout + 10)
+            except (ApiException, RequestTimeout) as e:
+                logger.error("getUpdates failed, retrying in %ss: %s", error_interval, e)
+                await asyncio.sleep(error_interval)
+                error_interval = min(error_interval * 2, MAX_ERROR_INTERVAL)
+                continue
+            error_interval = ERROR_INTERVAL
+            for update in updates:
+                await dispatcher.put(update)
+                offset = update.update_id + 1
+    finally:
+        await dispatcher.stop()
+        await bot.close_session()
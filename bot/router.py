@@ -0,0 +1,99 @@
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import State
+
+from bot.callback_data import CallbackAction, SEPARATOR
+
+from global_logger import logger
+
+
+MessageHandler = Callable[..., Awaitable[None]]
+
+
+class StateRouter:
+    """
+    Маршрутизатор текстовых сообщений по состоянию пользователя.
+    Состояние читается из хранилища один раз на апдейт, обработчик
+    выбирается по словарю {имя состояния: обработчик}.
+    """
+
+    def __init__(self, bot: AsyncTeleBot):
+        self.bot = bot
+        self.routes: Dict[str, MessageHandler] = {}
+
+    def register(self, state: State, handler: MessageHandler) -> None:
+        self.routes[state.name] = handler
+
+    async def dispatch(self, message: types.Message) -> None:
+        state = await self.bot.get_state(message.from_user.id, message.chat.id)
+        handler = self.routes.get(state)
+        if handler is not None:
+            await handler(message, bot=self.bot)
+
+    def install(self, content_types: list[str] | None = None) -> None:
+        """
+        Регистрирует маршрутизатор в боте одним обработчиком сообщений.
+        Вызывать после регистрации команд, чтобы команды имели приоритет.
+        """
+        self.bot.register_message_handler(self.dispatch, content_types=content_types or ['text'])
+
+
+class CallbackRouter:
+    """
+    Маршрутизатор inline-кнопок по коду действия из callback_data.
+    Обработчик ищется одним обращением к словарю по заголовку кнопки,
+    поля уже разобраны и передаются обработчику именованными аргументами.
+    Кнопки старого формата ("view_note_42", "back_to_notes") из уже
+    отправленных сообщений разбираются по таблице legacy-префиксов.
+    """
+
+    def __init__(self, bot: AsyncTeleBot):
+        self.bot = bot
+        self.routes: Dict[str, Tuple[CallbackAction, MessageHandler]] = {}
+        self.legacy: Dict[str, Tuple[CallbackAction, MessageHandler, Optional[str]]] = {}
+
+    def register(self, action: CallbackAction, handler: MessageHandler) -> None:
+        if action.header in self.routes:
+            raise ValueError(f"Callback action {action.code!r} is already registered")
+        self.routes[action.header] = (action, handler)
+        for prefix, field in action.legacy.items():
+            self.legacy[prefix] = (action, handler, field)
+
+    def resolve(self, data: str) -> Optional[Tuple[MessageHandler, Dict[str, Any]]]:
+        header, _, payload = data.partition(SEPARATOR)
+        route = self.routes.get(header)
+        if route is not None:
+            action, handler = route
+            return handler, action.unpack(payload)
+
+        legacy = self.legacy.get(data)
+        if legacy is not None and legacy[2] is None:
+            action, handler, _ = legacy
+            return handler, action.unpack_legacy(None, None)
+
+        prefix, _, value = data.rpartition("_")
+        legacy = self.legacy.get(prefix)
+        if legacy is not None and legacy[2] is not None and value.isdigit():
+            action, handler, field = legacy
+            return handler, action.unpack_legacy(field, value)
+        return None
+
+    async def dispatch(self, call: types.CallbackQuery) -> None:
+        try:
+            resolved = self.resolve(call.data or "")
+        except ValueError:
+            resolved = None
+        if resolved is None:
+            logger.warning("User %s sent unknown callback data %r", call.from_user.id, call.data)
+            await self.bot.answer_callback_query(call.id)
+            return
+        handler, values = resolved
+        await handler(call, bot=self.bot, **values)
+
+    def install(self) -> None:
+        """
+        Регистрирует маршрутизатор в боте одним обработчиком callback-запросов
+        """
+        self.bot.register_callback_query_handler(self.dispatch, func=lambda call: True)
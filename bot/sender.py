@@ -0,0 +1,283 @@
+import asyncio
+import contextvars
+import itertools
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, List, Optional
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+from config import SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_WORKERS, SEND_MAX_RETRIES
+from db.cache import LRUTTLCache
+
+from global_logger import logger
+
+
+class Priority(IntEnum):
+    """
+    Полосы очереди исходящих запросов: чем меньше значение, тем раньше запрос уйдёт
+    """
+    PAYMENT = 0
+    CALLBACK = 1
+    DEFAULT = 2
+
+
+# Приоритет запросов, отправляемых из текущего обработчика
+current_priority: contextvars.ContextVar[Optional[Priority]] = contextvars.ContextVar("current_priority", default=None)
+
+
+def with_priority(priority: Priority, handler_func):
+    """
+    Оборачивает обработчик так, чтобы все его исходящие запросы шли в полосе priority
+    """
+    async def wrapper(*args, **kwargs):
+        token = current_priority.set(priority)
+        try:
+            return await handler_func(*args, **kwargs)
+        finally:
+            current_priority.reset(token)
+    return wrapper
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate запросов в секунду, до capacity подряд.
+    reserve() всегда забирает токен и возвращает, сколько секунд ждать до отправки,
+    поэтому запросы, занявшие место раньше, уходят раньше.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class _Job:
+    __slots__ = ("chat_id", "priority", "func", "args", "kwargs", "future", "context", "enqueued_at", "attempts", "chat_reserved")
+
+    def __init__(self, chat_id, priority: Priority, func, args, kwargs, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        # Контекст обработчика: запрос логируется и учитывается в метриках от его имени
+        self.context = contextvars.copy_context()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.chat_reserved = False
+
+
+class OutboundSender:
+    """
+    Очередь исходящих запросов к Telegram с ограничением скорости.
+    Общее ведро держит бота в пределах лимита Telegram на все чаты, ведро
+    каждого чата - в пределах лимита на один чат. Запрос, упёршийся в лимит чата,
+    откладывается, не занимая воркера, так что остальные чаты не ждут.
+    На 429 вся отправка приостанавливается на retry_after, запрос повторяется.
+    """
+
+    # Сколько последних задержек отправки хранить для перцентилей
+    LATENCY_WINDOW = 1000
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 chat_burst: int = SEND_CHAT_BURST, workers: int = SEND_WORKERS,
+                 max_retries: int = SEND_MAX_RETRIES, max_chats: int = 10000):
+        # Общий лимит без запаса: запросы идут равномерно, а не пачкой в начале каждой секунды
+        self.global_bucket = TokenBucket(global_rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        # Ведро простаивающего чата восстанавливается за chat_burst / chat_rate секунд, такие вёдра можно забыть
+        self.chat_buckets = LRUTTLCache(max_chats, max(60.0, chat_burst / chat_rate))
+        self.workers = workers
+        self.max_retries = max_retries
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.depth = {priority: 0 for priority in Priority}
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.latencies: deque = deque(maxlen=self.LATENCY_WINDOW)
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._paused_until = 0.0
+        self._sequence = itertools.count()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        for number in range(self.workers):
+            # Воркеры запускаются из первого обработчика, но не должны унаследовать его контекст
+            self._tasks.append(asyncio.create_task(self._worker(number), context=contextvars.Context()))
+
+    async def send(self, chat_id, priority: Priority, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        Ставит вызов func(*args, **kwargs) в очередь и ждёт его результата
+        """
+        if not self._tasks:
+            self.start()
+        job = _Job(chat_id, priority, func, args, kwargs, asyncio.get_running_loop().create_future())
+        self._in_flight += 1
+        self._idle.clear()
+        self._put(job)
+        return await job.future
+
+    def _put(self, job: _Job) -> None:
+        self.depth[job.priority] += 1
+        self.queue.put_nowait((job.priority, next(self._sequence), job))
+
+    def _chat_delay(self, chat_id) -> float:
+        if chat_id is None:
+            return 0.0
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        delay = bucket.reserve()
+        self.chat_buckets.set(chat_id, bucket)
+        return delay
+
+    def _finish(self, job: _Job) -> None:
+        self._in_flight -= 1
+        if not self._in_flight:
+            self._idle.set()
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            _, _, job = await self.queue.get()
+            self.depth[job.priority] -= 1
+            try:
+                await self._process(job)
+            except Exception as e:
+                logger.error("Sender worker %s failed: %s", number, e)
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, job: _Job) -> None:
+        if job.future.done():
+            # Обработчик, ждавший ответа, уже отменён
+            self._finish(job)
+            return
+
+        if not job.chat_reserved:
+            job.chat_reserved = True
+            delay = self._chat_delay(job.chat_id)
+            if delay > 0:
+                asyncio.get_running_loop().call_later(delay, self._put, job)
+                return
+
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        delay = self.global_bucket.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        try:
+            result = await asyncio.create_task(job.func(*job.args, **job.kwargs), context=job.context)
+        except ApiTelegramException as e:
+            if e.error_code == 429 and job.attempts < self.max_retries:
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                logger.warning("Flood limit hit for chat %s, retrying in %ss", job.chat_id, retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                job.attempts += 1
+                self.retried += 1
+                self._put(job)
+                return
+            self._fail(job, e)
+            return
+        except Exception as e:
+            self._fail(job, e)
+            return
+
+        self.sent += 1
+        self.latencies.append(time.monotonic() - job.enqueued_at)
+        if not job.future.done():
+            job.future.set_result(result)
+        self._finish(job)
+
+    def _fail(self, job: _Job, error: Exception) -> None:
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+        self._finish(job)
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+
+        return {
+            "queued": {priority.name.lower(): depth for priority, depth in self.depth.items()},
+            "in_flight": self._in_flight,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "latency_p50": percentile(0.5),
+            "latency_p99": percentile(0.99),
+        }
+
+    async def stop(self, drain: bool = True) -> None:
+        """
+        Останавливает воркеров. При drain=True сначала дожидается отправки
+        всех запросов, включая отложенные лимитом чата.
+        """
+        if drain:
+            await self._idle.wait()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+
+class RateLimitedTeleBot(AsyncTeleBot):
+    """
+    AsyncTeleBot, отправляющий сообщения, правки и счета через OutboundSender.
+    Обработчики продолжают вызывать bot.send_message и т.д. как обычно.
+    Ответы на нажатия кнопок и оплату идут в своих полосах раньше остальных.
+    """
+
+    def __init__(self, *args, sender: Optional[OutboundSender] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sender = sender or OutboundSender()
+
+    @staticmethod
+    def _priority(default: Priority) -> Priority:
+        priority = current_priority.get()
+        return min(priority, default) if priority is not None else default
+
+    async def process_new_callback_query(self, new_callback_queries):
+        token = current_priority.set(Priority.CALLBACK)
+        try:
+            await super().process_new_callback_query(new_callback_queries)
+        finally:
+            current_priority.reset(token)
+
+    async def process_new_pre_checkout_query(self, pre_checkout_queries):
+        token = current_priority.set(Priority.PAYMENT)
+        try:
+            await super().process_new_pre_checkout_query(pre_checkout_queries)
+        finally:
+            current_priority.reset(token)
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        return await self.sender.send(chat_id, self._priority(Priority.DEFAULT),
+                                      super().send_message, chat_id, text, *args, **kwargs)
+
+    async def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        return await self.sender.send(chat_id, self._priority(Priority.CALLBACK),
+                                      super().edit_message_text, text, chat_id, *args, **kwargs)
+
+    async def send_invoice(self, chat_id, *args, **kwargs):
+        return await self.sender.send(chat_id, self._priority(Priority.PAYMENT),
+                                      super().send_invoice, chat_id, *args, **kwargs)
@@ -0,0 +1,194 @@
+import json
+import time
+from typing import Optional, Union
+
+from telebot.asyncio_storage import StateMemoryStorage
+from telebot.asyncio_storage.base_storage import StateStorageBase, StateDataContext
+
+from config import STATE_STORAGE, STATE_TTL, REDIS_URL
+from db import crud
+from db.database import AsyncSessionLocal
+
+from global_logger import logger
+
+
+class SQLStateStorage(StateStorageBase):
+    """
+    Хранилище состояний FSM в таблице bot_states той же базы, что и у бота.
+    Состояния переживают перезапуск и общие для всех процессов бота.
+    Состояние, которое не трогали STATE_TTL секунд, считается брошенным и не читается.
+    """
+
+    # Как часто (в секундах) вычищать брошенные состояния из таблицы
+    PURGE_INTERVAL = 600
+
+    def __init__(self, session_factory=AsyncSessionLocal, ttl: float = STATE_TTL,
+                 prefix: str = "telebot", separator: str = ":") -> None:
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.prefix = prefix
+        self.separator = separator
+        self._last_purge = 0.0
+
+    def _key(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None) -> str:
+        return self._get_key(chat_id, user_id, self.prefix, self.separator,
+                             business_connection_id, message_thread_id, bot_id)
+
+    async def _purge_expired(self, db, now: float) -> None:
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        removed = await crud.delete_expired_bot_states(db, now)
+        if removed:
+            logger.info("Purged %s abandoned FSM states", removed)
+
+    async def set_state(self, chat_id, user_id, state, business_connection_id=None,
+                        message_thread_id=None, bot_id=None) -> bool:
+        if hasattr(state, "name"):
+            state = state.name
+        now = time.time()
+        async with self.session_factory() as db:
+            await crud.set_bot_state(db, self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id),
+                                     state, now + self.ttl, now)
+            await self._purge_expired(db, now)
+        return True
+
+    async def get_state(self, chat_id, user_id, business_connection_id=None,
+                        message_thread_id=None, bot_id=None) -> Optional[str]:
+        async with self.session_factory() as db:
+            record = await crud.get_bot_state(db, self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id), time.time())
+        return record.state if record else None
+
+    async def delete_state(self, chat_id, user_id, business_connection_id=None,
+                           message_thread_id=None, bot_id=None) -> bool:
+        async with self.session_factory() as db:
+            return await crud.delete_bot_state(db, self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id))
+
+    async def get_data(self, chat_id, user_id, business_connection_id=None,
+                       message_thread_id=None, bot_id=None) -> dict:
+        async with self.session_factory() as db:
+            record = await crud.get_bot_state(db, self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id), time.time())
+        return json.loads(record.data) if record else {}
+
+    async def set_data(self, chat_id, user_id, key, value: Union[str, int, float, dict],
+                       business_connection_id=None, message_thread_id=None, bot_id=None) -> bool:
+        data = await self.get_data(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        data[key] = value
+        if not await self.save(chat_id, user_id, data, business_connection_id, message_thread_id, bot_id):
+            raise RuntimeError(f"SQLStateStorage: key {self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)} does not exist.")
+        return True
+
+    async def reset_data(self, chat_id, user_id, business_connection_id=None,
+                         message_thread_id=None, bot_id=None) -> bool:
+        return await self.save(chat_id, user_id, {}, business_connection_id, message_thread_id, bot_id)
+
+    def get_interactive_data(self, chat_id, user_id, business_connection_id=None,
+                             message_thread_id=None, bot_id=None) -> StateDataContext:
+        return StateDataContext(self, chat_id=chat_id, user_id=user_id, business_connection_id=business_connection_id,
+                                message_thread_id=message_thread_id, bot_id=bot_id)
+
+    async def save(self, chat_id, user_id, data: dict, business_connection_id=None,
+                   message_thread_id=None, bot_id=None) -> bool:
+        now = time.time()
+        async with self.session_factory() as db:
+            return await crud.update_bot_state_data(
+                db, self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id),
+                json.dumps(data, ensure_ascii=False), now + self.ttl, now
+            )
+
+
+class RedisStateStorage(StateStorageBase):
+    """
+    Хранилище состояний FSM в Redis. Каждая запись живёт STATE_TTL секунд
+    с последнего изменения, брошенные состояния удаляет сам Redis.
+    Вместо настоящего клиента можно передать любой объект с асинхронными
+    методами get/set(ex=...)/delete, например заглушку для локальной проверки.
+    """
+
+    def __init__(self, client=None, url: Optional[str] = REDIS_URL, ttl: float = STATE_TTL,
+                 prefix: str = "telebot", separator: str = ":") -> None:
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise ImportError("Для STATE_STORAGE=redis установите пакет redis")
+            client = redis.from_url(url)
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self.separator = separator
+
+    def _key(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None) -> str:
+        return self._get_key(chat_id, user_id, self.prefix, self.separator,
+                             business_connection_id, message_thread_id, bot_id)
+
+    async def _load(self, key: str) -> Optional[dict]:
+        raw = await self.client.get(key)
+        return json.loads(raw) if raw else None
+
+    async def _store(self, key: str, record: dict) -> None:
+        await self.client.set(key, json.dumps(record, ensure_ascii=False), ex=self.ttl)
+
+    async def set_state(self, chat_id, user_id, state, business_connection_id=None,
+                        message_thread_id=None, bot_id=None) -> bool:
+        if hasattr(state, "name"):
+            state = state.name
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        record = await self._load(key) or {"state": None, "data": {}}
+        record["state"] = state
+        await self._store(key, record)
+        return True
+
+    async def get_state(self, chat_id, user_id, business_connection_id=None,
+                        message_thread_id=None, bot_id=None) -> Optional[str]:
+        record = await self._load(self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id))
+        return record["state"] if record else None
+
+    async def delete_state(self, chat_id, user_id, business_connection_id=None,
+                           message_thread_id=None, bot_id=None) -> bool:
+        return bool(await self.client.delete(self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)))
+
+    async def get_data(self, chat_id, user_id, business_connection_id=None,
+                       message_thread_id=None, bot_id=None) -> dict:
+        record = await self._load(self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id))
+        return record["data"] if record else {}
+
+    async def set_data(self, chat_id, user_id, key, value: Union[str, int, float, dict],
+                       business_connection_id=None, message_thread_id=None, bot_id=None) -> bool:
+        record_key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        record = await self._load(record_key)
+        if record is None:
+            raise RuntimeError(f"RedisStateStorage: key {record_key} does not exist.")
+        record["data"][key] = value
+        await self._store(record_key, record)
+        return True
+
+    async def reset_data(self, chat_id, user_id, business_connection_id=None,
+                         message_thread_id=None, bot_id=None) -> bool:
+        return await self.save(chat_id, user_id, {}, business_connection_id, message_thread_id, bot_id)
+
+    def get_interactive_data(self, chat_id, user_id, business_connection_id=None,
+                             message_thread_id=None, bot_id=None) -> StateDataContext:
+        return StateDataContext(self, chat_id=chat_id, user_id=user_id, business_connection_id=business_connection_id,
+                                message_thread_id=message_thread_id, bot_id=bot_id)
+
+    async def save(self, chat_id, user_id, data: dict, business_connection_id=None,
+                   message_thread_id=None, bot_id=None) -> bool:
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        record = await self._load(key)
+        if record is None:
+            return False
+        record["data"] = data
+        await self._store(key, record)
+        return True
+
+
+def create_state_storage() -> StateStorageBase:
+    """
+    Создаёт хранилище состояний FSM по настройке STATE_STORAGE из config.py
+    """
+    if STATE_STORAGE == "sql":
+        return SQLStateStorage()
+    if STATE_STORAGE == "redis":
+        return RedisStateStorage()
+    return StateMemoryStorage()
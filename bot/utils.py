@@ -1,11 +1,12 @@
 import html
 from typing import List
 
-from db.database import get_async_db
+from bot.metrics import track_handler
+from db.database import session_scope
+from db.rollups import rollups
+from global_logger import log_context
 
-from telebot import types
 from telebot.async_telebot import AsyncTeleBot
-from telebot.asyncio_handler_backends import State
 
 def escape_html(text: str) -> str:
     escaped_text = html.escape(text, quote=True)
@@ -22,21 +23,23 @@ def create_user_link(user_id: int, user_name: str, username: str | None = None)
 
 def db_handler(handler_func):
     async def wrapper(*args, **kwargs):
-        session = await anext(get_async_db())
+        # Все записи лога внутри обработчика помечаются пользователем и именем обработчика
+        from_user = getattr(args[0], "from_user", None) if args else None
+        token = log_context.set({"user_id": getattr(from_user, "id", None), "handler": handler_func.__name__})
+        if from_user is not None:
+            # Активные за день пользователи для /stats
+            rollups.touch(from_user.id)
         try:
-            return await handler_func(*args, db=session, **kwargs)
+            # Время обработчика, его SQL-запросы и запросы к Telegram попадают в метрики
+            async with track_handler(handler_func.__name__):
+                # Сессия создаётся, только если обработчик действительно обратится к db
+                async with session_scope() as session:
+                    return await handler_func(*args, db=session, **kwargs)
         finally:
-            await session.close()
+            log_context.reset(token)
     return wrapper
 
 
-def create_state_filter(required_state: State, bot_instance: AsyncTeleBot):
-    async def state_checker(message: types.Message):
-        current_state = await bot_instance.get_state(message.from_user.id, message.chat.id)
-        return current_state == required_state.name
-    return state_checker
-
-
 async def update_data(bot: AsyncTeleBot, tg_user_id: int, tg_chat_id: int, **kwargs):
     async with bot.retrieve_data(tg_user_id, tg_chat_id) as data:
         data.update(kwargs)
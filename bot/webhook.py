@@ -0,0 +1,71 @@
+import asyncio
+from typing import Optional
+
+from aiohttp import web
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+from bot.dispatcher import UpdateDispatcher
+from global_logger import logger
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def create_webhook_app(dispatcher: UpdateDispatcher, path: str, secret_token: Optional[str] = None) -> web.Application:
+    """
+    Создаёт aiohttp-приложение, которое принимает апдейты от Telegram
+    и складывает их в очередь диспетчера.
+    """
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+            logger.warning("Webhook request with invalid secret token from %s", request.remote)
+            return web.Response(status=403)
+
+        update = types.Update.de_json(await request.text())
+        if not dispatcher.submit(update):
+            # Telegram повторит доставку апдейта, если ответить не 2xx
+            logger.warning("Update queue is full, update %s rejected", update.update_id)
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def start_webhook_server(bot: AsyncTeleBot, host: str, port: int, path: str, secret_token: Optional[str],
+                               queue_size: int, workers: int) -> tuple[web.AppRunner, UpdateDispatcher]:
+    """
+    Поднимает webhook-сервер и воркеров, не регистрируя вебхук в Telegram.
+    Возвращает кортеж (runner, диспетчер) для последующей остановки.
+    """
+    dispatcher = UpdateDispatcher(bot, queue_size, workers)
+    app = create_webhook_app(dispatcher, path, secret_token)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    dispatcher.start()
+    logger.info("Webhook server listening on %s:%s%s with %s workers", host, port, path, workers)
+    return runner, dispatcher
+
+
+async def stop_webhook_server(runner: web.AppRunner, dispatcher: UpdateDispatcher) -> None:
+    await runner.cleanup()
+    await dispatcher.stop()
+
+
+async def run_webhook(bot: AsyncTeleBot, url: str, host: str, port: int, path: str, secret_token: Optional[str],
+                      queue_size: int, workers: int) -> None:
+    """
+    Запускает бота в режиме вебхука и работает до отмены.
+    """
+    runner, dispatcher = await start_webhook_server(bot, host, port, path, secret_token, queue_size, workers)
+    try:
+        await bot.set_webhook(url=url, secret_token=secret_token)
+        logger.info("Webhook set to %s", url)
+        await asyncio.Event().wait()
+    finally:
+        await stop_webhook_server(runner, dispatcher)
+        await bot.close_session()
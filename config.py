@@ -7,6 +7,23 @@ BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 COST = int(os.getenv("QUANTITY", 10))
+# Сколько посланий показывать на одной странице /mynotes
+NOTES_PAGE_SIZE = int(os.getenv("NOTES_PAGE_SIZE", 10))
+# Кэш пользователей в памяти процесса: максимум записей и время жизни записи в секундах (0 - кэш выключен)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 300))
+# Время жизни посланий и запомненного отсутствия послания в кэше, в секундах. Кэш у каждого процесса свой:
+# если ботов несколько, послание, записанное или перезаписанное в другом процессе, видно с задержкой до этого срока
+NOTES_CACHE_TTL = float(os.getenv("NOTES_CACHE_TTL", 10))
+
+# Логи: уровень, формат (text или json), файл и его ротация (size - по LOG_MAX_BYTES, time - по LOG_ROTATE_WHEN)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_ROTATION = os.getenv("LOG_ROTATION", "size")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 7))
 
 if not BOT_TOKEN:
     raise ValueError("TELEGRAM_TOKEN не найден")
@@ -15,4 +32,121 @@ if not DATABASE_URL:
 if not ADMIN_ID:
     raise ValueError("ADMIN_ID не найден")
 if not COST:
-    raise ValueError("COST не найден")
\ No newline at end of file
+    raise ValueError("COST не найден")
+
+# Пул соединений с базой
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Настройки SQLite, применяются к каждому новому соединению
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))
+# Отметки о прочтении: sync - коммит на каждое прочтение, buffered - копятся в памяти и пишутся
+# одним UPDATE раз в READ_RECEIPTS_FLUSH_MS мс или по READ_RECEIPTS_BATCH штук
+# (при аварийном завершении процесса теряются отметки за последний интервал)
+READ_RECEIPTS_MODE = os.getenv("READ_RECEIPTS_MODE", "sync")
+READ_RECEIPTS_FLUSH_MS = int(os.getenv("READ_RECEIPTS_FLUSH_MS", 500))
+READ_RECEIPTS_BATCH = int(os.getenv("READ_RECEIPTS_BATCH", 500))
+# Регистрация новых пользователей: sync - INSERT и коммит на каждого, buffered - новые пользователи
+# копятся в памяти и пишутся многострочным INSERT раз в REGISTRATIONS_FLUSH_MS мс или по REGISTRATIONS_BATCH штук
+# (при аварийном завершении процесса теряются регистрации за последний интервал, они повторятся при следующем апдейте)
+REGISTRATIONS_MODE = os.getenv("REGISTRATIONS_MODE", "sync")
+REGISTRATIONS_FLUSH_MS = int(os.getenv("REGISTRATIONS_FLUSH_MS", 200))
+REGISTRATIONS_BATCH = int(os.getenv("REGISTRATIONS_BATCH", 500))
+
+# Где хранить состояния диалогов (/note и т.п.): memory, sql (таблица в DATABASE_URL) или redis
+STATE_STORAGE = os.getenv("STATE_STORAGE", "memory")
+# Через сколько секунд без действий состояние считается брошенным
+STATE_TTL = int(os.getenv("STATE_TTL", 86400))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Режим получения апдейтов: polling (getUpdates) или webhook (aiohttp-сервер)
+UPDATES_MODE = os.getenv("UPDATES_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Размер очереди апдейтов и количество воркеров, которые её разбирают
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+
+# Исходящие запросы к Telegram: сообщений в секунду на весь бот и на один чат (с запасом до SEND_CHAT_BURST подряд)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 3))
+# Сколько запросов отправляется одновременно и сколько раз повторять запрос после 429
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", 8))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 3))
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics, 0 (по умолчанию) - не поднимать сервер
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# Счётчики /stats копятся в памяти и пишутся в бд раз в STATS_FLUSH_MS мс
+STATS_FLUSH_MS = int(os.getenv("STATS_FLUSH_MS", 10000))
+
+# Срок хранения посланий: раз в RETENTION_INTERVAL секунд послания старше NOTES_RETENTION_DAYS дней
+# (0 - хранить всегда) переносятся в archived_notes (RETENTION_MODE=archive) или удаляются (delete)
+# пачками по RETENTION_BATCH; RETENTION_DRY_RUN - только посчитать, сколько было бы перенесено
+NOTES_RETENTION_DAYS = int(os.getenv("NOTES_RETENTION_DAYS", 0))
+RETENTION_MODE = os.getenv("RETENTION_MODE", "archive")
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", 3600))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", 500))
+RETENTION_DRY_RUN = os.getenv("RETENTION_DRY_RUN", "false").lower() in ("1", "true", "yes")
+
+# Выгрузка /export: сколько строк читать из базы за раз
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+
+# Реферальные коды: ключ шифрования user_id (по умолчанию токен бота) и версия формата.
+# После смены ключа нужно увеличить REF_CODE_VERSION и перевыпустить коды: python -m db.ref_codes
+REF_CODE_SECRET = os.getenv("REF_CODE_SECRET") or BOT_TOKEN
+REF_CODE_VERSION = int(os.getenv("REF_CODE_VERSION", 1))
+
+if USER_CACHE_TTL < 0 or NOTES_CACHE_TTL < 0:
+    raise ValueError("USER_CACHE_TTL и NOTES_CACHE_TTL не могут быть отрицательными")
+if NOTES_PAGE_SIZE <= 0:
+    raise ValueError("NOTES_PAGE_SIZE должен быть больше нуля")
+if LOG_FORMAT not in ("text", "json"):
+    raise ValueError("LOG_FORMAT должен быть text или json")
+if LOG_ROTATION not in ("size", "time"):
+    raise ValueError("LOG_ROTATION должен быть size или time")
+if READ_RECEIPTS_MODE not in ("sync", "buffered"):
+    raise ValueError("READ_RECEIPTS_MODE должен быть sync или buffered")
+if READ_RECEIPTS_FLUSH_MS <= 0 or READ_RECEIPTS_BATCH <= 0:
+    raise ValueError("READ_RECEIPTS_FLUSH_MS и READ_RECEIPTS_BATCH должны быть больше нуля")
+if REGISTRATIONS_MODE not in ("sync", "buffered"):
+    raise ValueError("REGISTRATIONS_MODE должен быть sync или buffered")
+if REGISTRATIONS_FLUSH_MS <= 0 or REGISTRATIONS_BATCH <= 0:
+    raise ValueError("REGISTRATIONS_FLUSH_MS и REGISTRATIONS_BATCH должны быть больше нуля")
+if STATE_STORAGE not in ("memory", "sql", "redis"):
+    raise ValueError("STATE_STORAGE должен быть memory, sql или redis")
+if STATE_TTL <= 0:
+    raise ValueError("STATE_TTL должен быть больше нуля")
+if UPDATES_MODE not in ("polling", "webhook"):
+    raise ValueError("UPDATES_MODE должен быть polling или webhook")
+if UPDATES_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("WEBHOOK_URL не найден")
+if UPDATE_QUEUE_SIZE <= 0 or UPDATE_WORKERS <= 0:
+    raise ValueError("UPDATE_QUEUE_SIZE и UPDATE_WORKERS должны быть больше нуля")
+if SEND_GLOBAL_RATE <= 0 or SEND_CHAT_RATE <= 0 or SEND_CHAT_BURST <= 0 or SEND_WORKERS <= 0:
+    raise ValueError("SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST и SEND_WORKERS должны быть больше нуля")
+if SEND_MAX_RETRIES < 0:
+    raise ValueError("SEND_MAX_RETRIES не может быть отрицательным")
+if not 0 <= METRICS_PORT <= 65535:
+    raise ValueError("METRICS_PORT должен быть от 0 до 65535")
+if not 1 <= REF_CODE_VERSION <= 255:
+    raise ValueError("REF_CODE_VERSION должен быть от 1 до 255")
+if EXPORT_BATCH_SIZE <= 0:
+    raise ValueError("EXPORT_BATCH_SIZE должен быть больше нуля")
+if STATS_FLUSH_MS <= 0:
+    raise ValueError("STATS_FLUSH_MS должен быть больше нуля")
+if NOTES_RETENTION_DAYS < 0:
+    raise ValueError("NOTES_RETENTION_DAYS не может быть отрицательным")
+if RETENTION_MODE not in ("archive", "delete"):
+    raise ValueError("RETENTION_MODE должен быть archive или delete")
+if RETENTION_INTERVAL <= 0 or RETENTION_BATCH <= 0:
+    raise ValueError("RETENTION_INTERVAL и RETENTION_BATCH должны быть больше нуля")
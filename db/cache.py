@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from config import USER_CACHE_SIZE, USER_CACHE_TTL, NOTES_CACHE_TTL
+
+
+class LRUTTLCache:
+    """
+    Ограниченный по размеру LRU-кэш с временем жизни записей.
+    Не потокобезопасен: рассчитан на один event loop.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        # Нулевой размер или срок жизни выключает кэш
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# user_id -> значения колонок User
+users_cache = LRUTTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# ref_code -> user_id
+ref_codes_cache = LRUTTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# (created_by_user_id, for_user_id) -> значения колонок Note или NO_NOTE.
+# Короткий срок жизни: послание может записать или перезаписать другой процесс бота
+notes_cache = LRUTTLCache(USER_CACHE_SIZE, NOTES_CACHE_TTL)
+# Запомненное отсутствие послания: по ссылке чаще всего переходят те, кому ничего не написали
+NO_NOTE = object()
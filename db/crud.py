@@ -1,20 +1,85 @@
+import datetime
+
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import func
-from sqlalchemy import select, delete
+from sqlalchemy import select, update, delete, and_, or_, case
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from db.database import UPSERT_DIALECTS
+from db.models import AdminPanel, User, Note, Payment, BotState, DailyStats, CreatorStats
+from db.utils import next_ref_code, ref_code_to_id
+from db.cache import users_cache, ref_codes_cache, notes_cache, NO_NOTE
+from db.read_receipts import read_receipts
+from db.registrations import registrations, new_user_values
+from db.rollups import rollups, today
+
+from typing import Optional, List, Tuple
+
+async def _update_returning(db: AsyncSession, model, where_clause, commit: bool = True, **values):
+    """
+    UPDATE одной строки модели model (с коммитом, если commit=True).
+    Если диалект поддерживает UPDATE ... RETURNING, обновлённая строка возвращается
+    тем же запросом, иначе перечитывается отдельным SELECT.
+    Возвращает обновлённый объект или None, если строка не найдена.
+    """
+    stmt = update(model).where(where_clause).values(**values).execution_options(synchronize_session=False)
+    if db.bind.dialect.update_returning:
+        result = await db.execute(stmt.returning(model), execution_options={"populate_existing": True})
+        obj = result.scalars().first()
+    else:
+        result = await db.execute(stmt)
+        obj = None
+        if result.rowcount:
+            result = await db.execute(select(model).where(where_clause), execution_options={"populate_existing": True})
+            obj = result.scalars().first()
+    if commit:
+        await db.commit()
+    return obj
 
-from db.models import AdminPanel, User, Note
-from db.utils import id_to_ref_code
+async def _end_unchanged(db: AsyncSession) -> None:
+    """
+    Завершает транзакцию, в которой ничего не изменилось. Коммит, а не rollback:
+    после rollback загруженные в сессию объекты протухают, и следующее обращение
+    к их атрибутам стало бы лишним запросом.
+    """
+    await db.commit()
+
+def _remember_user(user: User) -> None:
+    """
+    Кладёт актуальные данные пользователя в кэш. Вызывается после коммита любой записи в users.
+    """
+    users_cache.set(user.user_id, {column.key: getattr(user, column.key) for column in User.__table__.columns})
+    ref_codes_cache.set(user.ref_code, user.user_id)
 
-from typing import Optional, List
+async def _cached_user(db: AsyncSession, user_id: int) -> Optional[User]:
+    """
+    Достаёт пользователя из кэша (или из буфера ещё не записанных регистраций)
+    и присоединяет его к сессии без запроса в базу.
+    Возвращает None, если пользователя нет ни там, ни там.
+    """
+    values = users_cache.get(user_id) or registrations.pending(user_id)
+    if values is None:
+        return None
+    user = User(**values)
+    make_transient_to_detached(user)
+    return await db.merge(user, load=False)
 
 async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[User]:
     """
     Получение пользователя по его user_id
+    Сначала ищет в кэше, при промахе читает из базы и кэширует.
     Возвращает объект User, если пользователь найден, иначе None.
     """
+    user = await _cached_user(db, user_id)
+    if user:
+        return user
     result = await db.execute(select(User).where(User.user_id == user_id))
     user = result.scalars().first()
     if user:
+        _remember_user(user)
         return user
     return None
 
@@ -26,95 +91,188 @@ async def add_user(db: AsyncSession, user_id: int, username: Optional[str] = Non
     3. Если не существует, создает нового пользователя с предоставленными данными.
     Возвращает объект пользователя.
     """
-    if await get_user_by_id(db, user_id):
-        return await get_user_by_id(db, user_id)
-    
-    ref_code = id_to_ref_code(user_id)
-    query = select(User).where(User.ref_code == ref_code)
-    result = await db.execute(query)
-    existing_user = result.scalars().first()
-    while existing_user:
-        # Если ref_code уже существует, генерируем новый, увеличивая user_id
-        user_id += 1
-        ref_code = id_to_ref_code(user_id)
-        query = select(User).where(User.ref_code == ref_code)
-        result = await db.execute(query)
-        existing_user = result.scalars().first()
-
-    new_user = User(
-        user_id=user_id,
-        username=username,
-        first_name=first_name,
-        last_name=last_name,
-        ref_code=ref_code
-    )
+    user = await get_user_by_id(db, user_id)
+    if user:
+        return user
+    return await _insert_user(db, user_id, username, first_name, last_name)
+
+async def _insert_user(db: AsyncSession, user_id: int, username: Optional[str], first_name: str, last_name: Optional[str]) -> User:
+    """
+    Вставка нового пользователя с генерацией реферального кода.
+    Код выводится из user_id без коллизий, поэтому проверять его в базе не нужно.
+    При REGISTRATIONS_MODE=buffered пользователь только ставится в очередь registrations.
+    """
+    values = new_user_values(user_id, username, first_name, last_name)
+    if registrations.enabled:
+        registrations.add(values)
+        rollups.count(new_users=1)
+        return User(**values)
+
+    new_user = User(**values)
     db.add(new_user)
     await db.commit()
-    await db.refresh(new_user)
+    rollups.count(new_users=1)
+    _remember_user(new_user)
     return new_user
 
 async def create_or_update_user(db: AsyncSession, user_id: int, username: Optional[str] = None, first_name: str = None, last_name: Optional[str] = None) -> User:
     """
     Создание нового пользователя или обновление существующего
-    1. Проверяет, существует ли пользователь с данным user_id.
-    2. Если существует, обновляет его данные.
-    3. Если не существует, создает нового пользователя с предоставленными данными.
+    1. Проверяет, существует ли пользователь с данным user_id (обычно из кэша, без запроса).
+    2. Если существует и username/first_name/last_name не изменились, ничего не пишет.
+    3. Если изменились, обновляет их одним UPDATE.
+    4. Если не существует, создает нового пользователя с предоставленными данными.
     Возвращает объект пользователя.
     """
     user = await get_user_by_id(db, user_id)
-    if user:
-        user.username = username
-        user.first_name = first_name
-        user.last_name = last_name
-        db.add(user)
-        await db.commit()
-        await db.refresh(user)
+    if not user:
+        return await _insert_user(db, user_id, username, first_name, last_name)
+
+    if (user.username, user.first_name, user.last_name) == (username, first_name, last_name):
         return user
-    else:
-        return await add_user(db, user_id, username, first_name, last_name)
+
+    await registrations.settle((user_id,))
+    user = await _update_returning(
+        db, User, User.user_id == user_id,
+        username=username,
+        first_name=first_name,
+        last_name=last_name
+    )
+    _remember_user(user)
+    return user
 
 async def get_user_by_ref_code(db: AsyncSession, ref_code: str) -> Optional[User]:
     """
     Получение пользователя по его реферальному коду
+    Код текущего формата расшифровывается в user_id без кэша кодов,
+    коды старых форматов ищутся в кэше кодов. При промахе пользователь
+    читается из базы по ref_code и кэшируется.
     Возвращает объект User, если пользователь найден, иначе None.
     """
+    decoded = ref_code_to_id(ref_code)
+    user_id = decoded[0] if decoded else ref_codes_cache.get(ref_code)
+    if user_id is not None:
+        user = await _cached_user(db, user_id)
+        # Код мог смениться, пока запись о пользователе жила в кэше
+        if user and user.ref_code == ref_code:
+            return user
+
     result = await db.execute(select(User).where(User.ref_code == ref_code))
     user = result.scalars().first()
     if user:
+        _remember_user(user)
         return user
     return None
 
 async def create_new_ref_code(db: AsyncSession, user_id: int) -> str:
     """
-    Обновляет реферальный код пользователя на новый случайный,
-    используя функцию id_to_ref_code из utils.py.
+    Выдаёт пользователю новый реферальный код (следующее поколение),
+    старая ссылка перестаёт работать.
     Возвращает новый реферальный код.
     """
-    import random
     user = await get_user_by_id(db, user_id)
     if not user:
         raise ValueError(f"User with id {user_id} not found")
 
-    while True:
-        rand_id = user_id + random.randint(1, 5000) * random.choice([-1, 1])
-        new_code = id_to_ref_code(rand_id)
-        if not await get_user_by_ref_code(db, new_code):
-            user.ref_code = new_code
-            db.add(user)
-            await db.commit()
-            await db.refresh(user)
-            return new_code
+    await registrations.settle((user_id,))
+    old_code = user.ref_code
+    user = await _update_returning(db, User, User.user_id == user_id, ref_code=next_ref_code(user_id, old_code))
+    ref_codes_cache.invalidate(old_code)
+    _remember_user(user)
+    return user.ref_code
+
+async def get_daily_stats(db: AsyncSession, days: int) -> List[DailyStats]:
+    """
+    Счётчики за последние days дней (UTC), начиная с сегодняшнего.
+    Дни без событий в результат не попадают. Сначала дописывает накопленные приращения.
+    """
+    await rollups.flush()
+    since = today() - datetime.timedelta(days=days - 1)
+    result = await db.execute(select(DailyStats).where(DailyStats.day >= since).order_by(DailyStats.day.desc()))
+    return list(result.scalars().all())
+
+async def get_top_creators(db: AsyncSession, limit: int) -> List[Row]:
+    """
+    Авторы с наибольшим числом прочтений их посланий за всё время.
+    Возвращает строки (user_id, first_name, notes_created, notes_read).
+    """
+    await rollups.flush()
+    result = await db.execute(
+        select(CreatorStats.user_id, User.first_name, CreatorStats.notes_created, CreatorStats.notes_read)
+        .outerjoin(User, User.user_id == CreatorStats.user_id)
+        .order_by(CreatorStats.notes_read.desc())
+        .limit(limit)
+    )
+    return list(result.all())
+
+def get_cache_stats() -> dict:
+    """
+    Статистика кэшей пользователей и посланий: размер, попадания, промахи
+    """
+    return {
+        "users": users_cache.stats(),
+        "ref_codes": ref_codes_cache.stats(),
+        "notes": notes_cache.stats(),
+    }
 
 
 
 
+def _remember_note(note: Note) -> None:
+    """
+    Кладёт актуальные данные послания в кэш по паре (автор, получатель).
+    Вызывается после коммита любой записи в notes.
+    """
+    notes_cache.set((note.created_by_user_id, note.for_user_id), {column.key: getattr(note, column.key) for column in Note.__table__.columns})
+
 async def create_note(db: AsyncSession, for_user_id: int, text: str, created_by_user_id: int) -> Note:
     """
     Создание новой заметки
     1. Создает новую заметку с предоставленным текстом для указанного пользователя.
     2. Устанавливает created_by_user_id для отслеживания, кто создал заметку.
+    3. Если у автора уже есть заметка для этого пользователя, она перезаписывается:
+       новый текст, новая дата создания, статус прочтения сбрасывается.
+    На SQLite и PostgreSQL это один INSERT ... ON CONFLICT DO UPDATE и один коммит.
     Возвращает объект созданной заметки.
     """
+    # Отложенная отметка о прочтении старого послания не должна пометить прочитанным новое
+    await read_receipts.settle(pair=(created_by_user_id, for_user_id))
+    await registrations.settle((created_by_user_id,))
+    dialect_insert = UPSERT_DIALECTS.get(db.bind.dialect.name)
+    if dialect_insert is None:
+        return await _create_note_without_upsert(db, for_user_id, text, created_by_user_id)
+
+    stmt = dialect_insert(Note).values(
+        for_user_id=for_user_id,
+        text=text,
+        created_by_user_id=created_by_user_id,
+        is_read=False,
+        fake_is_read=False
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Note.created_by_user_id, Note.for_user_id],
+        set_={
+            "text": stmt.excluded.text,
+            "created_at": func.now(),
+            "is_read": False,
+            "fake_is_read": False
+        }
+    ).returning(Note)
+    result = await db.execute(stmt, execution_options={"populate_existing": True})
+    new_note = result.scalars().one()
+    await db.commit()
+    _remember_note(new_note)
+    _count_note_created(new_note)
+    return new_note
+
+def _count_note_created(note: Note) -> None:
+    rollups.count(notes_created=1)
+    rollups.count_creator(note.created_by_user_id, notes_created=1)
+
+async def _create_note_without_upsert(db: AsyncSession, for_user_id: int, text: str, created_by_user_id: int) -> Note:
+    """
+    Создание заметки для диалектов без ON CONFLICT: удаление старой заметки и вставка новой
+    """
     note_id = await get_note_id(db, created_by_user_id, for_user_id)
     if note_id:
         await delete_note_by_id(db, note_id)
@@ -127,6 +285,8 @@ async def create_note(db: AsyncSession, for_user_id: int, text: str, created_by_
     db.add(new_note)
     await db.commit()
     await db.refresh(new_note)
+    _remember_note(new_note)
+    _count_note_created(new_note)
     return new_note
 
 async def get_note_id(db: AsyncSession, from_user_id: int, for_user_id: int) -> Optional[int]:
@@ -172,6 +332,68 @@ async def get_note_by_user_id_and_creator_id(db: AsyncSession, for_user_id: int,
     
     return note
 
+async def get_note_for_reader(db: AsyncSession, for_user_id: int, created_by_user_id: int) -> Optional[Note]:
+    """
+    Послание автора created_by_user_id для читателя for_user_id при переходе по ссылке.
+    Сначала ищет в кэше (в том числе запомненное отсутствие послания),
+    при промахе читает из базы и кэширует результат.
+    Возвращает объект Note или None.
+    """
+    key = (created_by_user_id, for_user_id)
+    values = notes_cache.get(key)
+    if values is NO_NOTE:
+        return None
+    if values is not None:
+        note = Note(**values)
+        make_transient_to_detached(note)
+        return await db.merge(note, load=False)
+
+    note = await get_note_by_user_id_and_creator_id(db, for_user_id, created_by_user_id)
+    if note:
+        _remember_note(note)
+    else:
+        notes_cache.set(key, NO_NOTE)
+    return note
+
+async def mark_note_as_read(db: AsyncSession, note: Note) -> bool:
+    """
+    Помечает послание прочитанным при переходе по ссылке.
+    Если оно уже прочитано и прочтение не скрыто, в базу ничего не пишет,
+    иначе выполняет один условный UPDATE. При READ_RECEIPTS_MODE=buffered
+    отметка только ставится в очередь read_receipts, а кэш обновляется сразу.
+    Возвращает True, если статус прочтения изменился.
+    """
+    if note.is_read and note.fake_is_read:
+        return False
+    # Повторный переход после скрытия прочтения - не новое прочтение
+    first_read = not note.is_read
+    if read_receipts.enabled:
+        set_committed_value(note, "is_read", True)
+        set_committed_value(note, "fake_is_read", True)
+        _remember_note(note)
+        read_receipts.add(note)
+        if first_read:
+            _count_note_read(note)
+        return True
+    result = await db.execute(
+        update(Note)
+        .where(Note.id == note.id, or_(Note.is_read == False, Note.fake_is_read == False))
+        .values(is_read=True, fake_is_read=True)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    # Объект уже совпадает с базой, сессия не должна считать его изменённым
+    set_committed_value(note, "is_read", True)
+    set_committed_value(note, "fake_is_read", True)
+    _remember_note(note)
+    if first_read and result.rowcount:
+        _count_note_read(note)
+    return result.rowcount > 0
+
+def _count_note_read(note: Note) -> None:
+    rollups.count(notes_read=1)
+    rollups.count_creator(note.created_by_user_id, notes_read=1)
+
 async def update_note_text(db: AsyncSession, note_id: int, new_text: str) -> Optional[Note]:
     """
     Обновление текста заметки по ее ID
@@ -179,69 +401,86 @@ async def update_note_text(db: AsyncSession, note_id: int, new_text: str) -> Opt
     2. Если существует, обновляет ее текст на новый.
     Возвращает обновленный объект Note, если заметка была обновлена, иначе None.
     """
-    note = await get_note_by_id(db, note_id)
+    note = await _update_returning(db, Note, Note.id == note_id, text=new_text)
     if note:
-        note.text = new_text
-        db.add(note)
-        await db.commit()
-        await db.refresh(note)
-        return note
-    return None
+        _remember_note(note)
+    return note
 
 
 
 async def delete_note_by_id(db: AsyncSession, note_id: int) -> bool:
     """
     Удаление заметки по ее ID
-    1. Проверяет, существует ли заметка с данным ID.
-    2. Если существует, удаляет ее из базы данных.
     Возвращает True, если заметка была удалена, иначе False.
     """
-    result = await db.execute(select(Note).where(Note.id == note_id))
-    note = result.scalars().first()
-    if note:
-        await db.delete(note)
-        await db.commit()
-        return True
-    return False
+    stmt = delete(Note).where(Note.id == note_id)
+    # Пара (автор, получатель) нужна, чтобы запомнить в кэше, что послания больше нет
+    if db.bind.dialect.delete_returning:
+        result = await db.execute(stmt.returning(Note.created_by_user_id, Note.for_user_id))
+        keys = result.all()
+    else:
+        result = await db.execute(select(Note.created_by_user_id, Note.for_user_id).where(Note.id == note_id))
+        keys = result.all()
+        await db.execute(stmt)
+    await db.commit()
+    for created_by_user_id, for_user_id in keys:
+        notes_cache.set((created_by_user_id, for_user_id), NO_NOTE)
+    return bool(keys)
 
-async def set_note_as_read(db: AsyncSession, note_id: int) -> Optional[Note]:
+async def count_notes_by_user_id(db: AsyncSession, user_id: int) -> int:
     """
-    Помечает заметку как прочитанную по ее ID
+    Количество заметок, созданных пользователем user_id
     """
-    note = await get_note_by_id(db, note_id)
-    if note:
-        note.is_read = True
-        note.fake_is_read = True
-        db.add(note)
-        await db.commit()
-        await db.refresh(note)
-        return note
-    return None
+    result = await db.execute(select(func.count()).select_from(Note).where(Note.created_by_user_id == user_id))
+    return result.scalar_one()
 
-async def set_note_as_unread(db: AsyncSession, note_id: int) -> Optional[Note]:
+async def get_notes_page(db: AsyncSession, user_id: int, page_size: int, after_note_id: Optional[int] = None, before_note_id: Optional[int] = None) -> Tuple[List[Row], bool, bool]:
     """
-    Помечает заметку как непрочитанную по ее ID
+    Получение одной страницы заметок пользователя user_id для списка /mynotes
+    1. Заметки отсортированы по (created_at, id) от новых к старым, страница выбирается
+       курсором: after_note_id - следующая страница после этой заметки,
+       before_note_id - предыдущая страница перед ней. Без курсора - первая страница.
+    2. Выбираются только поля, нужные для списка (без text), вместе с именем получателя.
+    Возвращает кортеж (строки с полями id, for_user_id, created_at, fake_is_read, first_name,
+    есть ли предыдущая страница, есть ли следующая страница).
     """
-    note = await get_note_by_id(db, note_id)
-    if note:
-        note.fake_is_read = False
-        db.add(note)
-        await db.commit()
-        await db.refresh(note)
-        return note
-    return None
+    anchor = aliased(Note)
+    anchor_id = after_note_id if after_note_id is not None else before_note_id
 
+    query = (
+        select(Note.id, Note.for_user_id, Note.created_at, Note.fake_is_read, User.first_name)
+        .outerjoin(User, User.user_id == Note.for_user_id)
+        .where(Note.created_by_user_id == user_id)
+    )
+    if anchor_id is not None:
+        # Значения курсора берём из самой базы, чтобы сравнение created_at не зависело от формата даты в диалекте
+        anchor_created_at = select(anchor.created_at).where(anchor.id == anchor_id).scalar_subquery()
+        if after_note_id is not None:
+            query = query.where(or_(
+                Note.created_at < anchor_created_at,
+                and_(Note.created_at == anchor_created_at, Note.id < anchor_id)
+            ))
+        else:
+            query = query.where(or_(
+                Note.created_at > anchor_created_at,
+                and_(Note.created_at == anchor_created_at, Note.id > anchor_id)
+            ))
+
+    if before_note_id is not None:
+        query = query.order_by(Note.created_at.asc(), Note.id.asc())
+    else:
+        query = query.order_by(Note.created_at.desc(), Note.id.desc())
 
+    # Берём на одну строку больше, чтобы понять, есть ли страница дальше
+    result = await db.execute(query.limit(page_size + 1))
+    rows = list(result.all())
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
 
-async def get_notes_by_user_id(db: AsyncSession, user_id: int) -> List[Note]:
-    """
-    Получение всех заметок, созданных для пользователя с данным user_id
-    Возвращает список объектов Note.
-    """
-    result = await db.execute(select(Note).where(Note.created_by_user_id == user_id).order_by(Note.created_at.desc()))
-    notes = result.scalars().all()
-    return notes
+    if before_note_id is not None:
+        rows.reverse()
+        return rows, has_more, True
+    return rows, after_note_id is not None, has_more
 
 
 async def initiate_creation_of_admin_panel(db: AsyncSession, admin_user_id: int, total_earnings: int = 0, total_read_cancels_sold: int = 0) -> None:
@@ -258,7 +497,6 @@ async def initiate_creation_of_admin_panel(db: AsyncSession, admin_user_id: int,
         )
         db.add(new_admin_panel)
         await db.commit()
-        await db.refresh(new_admin_panel)
     if admin_panel:
         admin_panel.last_restart = func.now()
         db.add(admin_panel)
@@ -276,42 +514,213 @@ async def get_admin_panel(db: AsyncSession) -> Optional[AdminPanel]:
     return None
 
 
-async def update_user_balance(db: AsyncSession, user_id: int, additional_cancels: int) -> User:
+async def update_user_balance(db: AsyncSession, user_id: int, additional_cancels: int, commit: bool = True) -> User:
     """
     Обновляет баланс отмен прочтения для пользователя
     """
-    user = await get_user_by_id(db, user_id)
+    await registrations.settle((user_id,))
+    user = await _update_returning(
+        db, User, User.user_id == user_id,
+        commit=commit,
+        count_read_cancel=User.count_read_cancel + additional_cancels
+    )
     if not user:
         raise ValueError(f"User with id {user_id} not found")
-    
-    user.count_read_cancel += additional_cancels
-    db.add(user)
-    await db.commit()
-    await db.refresh(user)
+    if commit:
+        _remember_user(user)
+    else:
+        # Значение ещё не закоммичено, кэш обновит вызывающий код после коммита
+        users_cache.invalidate(user_id)
     return user
 
-async def update_admin_panel(db: AsyncSession, additional_earnings: int, additional_cancels_sold: int) -> AdminPanel:
+async def spend_read_cancel(db: AsyncSession, user_id: int, note_id: int) -> Optional[int]:
+    """
+    Скрывает прочтение послания note_id за одну отмену прочтения пользователя user_id.
+    Флаг fake_is_read сбрасывается, только если у пользователя есть отмены, а баланс
+    уменьшается условным UPDATE (count_read_cancel - 1 при count_read_cancel > 0)
+    в той же транзакции, коммит один. Поэтому параллельные нажатия не могут списать
+    больше, чем есть на балансе, а без отмен не меняется ничего.
+    Возвращает новый баланс или None, если ничего не списано: отмен нет, послание
+    не найдено, адресовано другому пользователю или его прочтение уже скрыто.
+    """
+    await read_receipts.settle(note_id=note_id)
+    await registrations.settle((user_id,))
+    has_cancels = select(User.user_id).where(User.user_id == user_id, User.count_read_cancel > 0).exists()
+    hide = (
+        update(Note)
+        .where(Note.id == note_id, Note.for_user_id == user_id, Note.fake_is_read == True, has_cancels)
+        .values(fake_is_read=False)
+        .execution_options(synchronize_session=False)
+    )
+    spend = (
+        update(User)
+        .where(User.user_id == user_id, User.count_read_cancel > 0)
+        .values(count_read_cancel=User.count_read_cancel - 1)
+        .execution_options(synchronize_session=False)
+    )
+    # Условие WHERE после обновления уже не выполняется, поэтому без RETURNING строки перечитываются по ключу
+    returning = db.bind.dialect.update_returning
+    try:
+        if returning:
+            note = (await db.execute(hide.returning(Note), execution_options={"populate_existing": True})).scalars().first()
+        else:
+            note = await db.get(Note, note_id, populate_existing=True) if (await db.execute(hide)).rowcount else None
+        if note is None:
+            await _end_unchanged(db)
+            return None
+
+        if returning:
+            user = (await db.execute(spend.returning(User), execution_options={"populate_existing": True})).scalars().first()
+        else:
+            user = await db.get(User, user_id, populate_existing=True) if (await db.execute(spend)).rowcount else None
+        if user is None:
+            # Отмену успела потратить другая транзакция - не скрываем прочтение бесплатно
+            await db.rollback()
+            return None
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+
+    _remember_user(user)
+    _remember_note(note)
+    rollups.count(read_cancels_spent=1)
+    return user.count_read_cancel
+
+async def update_admin_panel(db: AsyncSession, additional_earnings: int, additional_cancels_sold: int, commit: bool = True) -> AdminPanel:
     """
     Обновляет статистику админ-панели
     """
-    admin_panel = await get_admin_panel(db)
+    admin_panel_id = select(AdminPanel.id).order_by(AdminPanel.id).limit(1).scalar_subquery()
+    admin_panel = await _update_returning(
+        db, AdminPanel, AdminPanel.id == admin_panel_id,
+        commit=commit,
+        total_earnings=AdminPanel.total_earnings + additional_earnings,
+        total_read_cancels_sold=AdminPanel.total_read_cancels_sold + additional_cancels_sold
+    )
     if not admin_panel:
         raise ValueError("Admin panel not found")
-    
-    admin_panel.total_earnings += additional_earnings
-    admin_panel.total_read_cancels_sold += additional_cancels_sold
-    db.add(admin_panel)
-    await db.commit()
-    await db.refresh(admin_panel)
     return admin_panel
 
-async def process_payment(db: AsyncSession, user_id: int, quantity: int, total_cost: int) -> tuple[User, AdminPanel]:
+async def _insert_payment(db: AsyncSession, telegram_payment_charge_id: str, user_id: int, quantity: int, total_amount: int) -> bool:
     """
-    Обрабатывает успешный платеж: обновляет баланс пользователя и статистику админа
-    Возвращает кортеж (обновленный пользователь, обновленная админ-панель)
+    Записывает платеж в таблицу payments, не коммитя транзакцию.
+    Возвращает False, если платеж с таким telegram_payment_charge_id уже записан.
     """
-    user = await update_user_balance(db, user_id, quantity)
-    
-    admin_panel = await update_admin_panel(db, total_cost, quantity)
-    
-    return user, admin_panel
\ No newline at end of file
+    values = dict(
+        telegram_payment_charge_id=telegram_payment_charge_id,
+        user_id=user_id,
+        quantity=quantity,
+        total_amount=total_amount
+    )
+    dialect_insert = UPSERT_DIALECTS.get(db.bind.dialect.name)
+    if dialect_insert is not None:
+        stmt = dialect_insert(Payment).values(**values).on_conflict_do_nothing(
+            index_elements=[Payment.telegram_payment_charge_id]
+        ).returning(Payment.id)
+        result = await db.execute(stmt)
+        return result.scalar() is not None
+
+    try:
+        async with db.begin_nested():
+            db.add(Payment(**values))
+    except IntegrityError:
+        return False
+    return True
+
+async def process_payment(db: AsyncSession, user_id: int, quantity: int, total_cost: int, telegram_payment_charge_id: str) -> tuple[User, AdminPanel, bool]:
+    """
+    Обрабатывает успешный платеж одной транзакцией
+    1. Записывает платеж в payments. Если платеж с таким telegram_payment_charge_id уже есть
+       (Telegram повторно прислал successful_payment), ничего не начисляет.
+    2. Увеличивает баланс пользователя и статистику админа на стороне базы (col = col + :n),
+       поэтому параллельные платежи не теряют начисления.
+    Возвращает кортеж (обновленный пользователь, обновленная админ-панель, был ли платеж зачислен сейчас)
+    """
+    await registrations.settle((user_id,))
+    try:
+        if not await _insert_payment(db, telegram_payment_charge_id, user_id, quantity, total_cost):
+            # Платёж уже записан
+            await _end_unchanged(db)
+            user = await get_user_by_id(db, user_id)
+            admin_panel = await get_admin_panel(db)
+            return user, admin_panel, False
+
+        user = await update_user_balance(db, user_id, quantity, commit=False)
+        admin_panel = await update_admin_panel(db, total_cost, quantity, commit=False)
+        await db.commit()
+        _remember_user(user)
+    except Exception:
+        await db.rollback()
+        raise
+
+    rollups.count(payments=1, earnings=total_cost, read_cancels_sold=quantity)
+    return user, admin_panel, True
+
+
+async def get_bot_state(db: AsyncSession, key: str, now: float) -> Optional[BotState]:
+    """
+    Получение состояния FSM по ключу, если оно ещё не истекло
+    """
+    result = await db.execute(select(BotState).where(BotState.key == key, BotState.expires_at > now))
+    return result.scalars().first()
+
+async def set_bot_state(db: AsyncSession, key: str, state: str, expires_at: float, now: float) -> None:
+    """
+    Устанавливает состояние FSM. Данные существующего состояния сохраняются,
+    у нового или истекшего состояния данные пустые.
+    """
+    dialect_insert = UPSERT_DIALECTS.get(db.bind.dialect.name)
+    if dialect_insert is not None:
+        stmt = dialect_insert(BotState).values(key=key, state=state, data="{}", expires_at=expires_at)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[BotState.key],
+            set_={
+                "state": stmt.excluded.state,
+                # Данные брошенного (истекшего) состояния не должны попасть в новый диалог
+                "data": case((BotState.expires_at > now, BotState.data), else_="{}"),
+                "expires_at": stmt.excluded.expires_at
+            }
+        )
+        await db.execute(stmt)
+    else:
+        record = await db.get(BotState, key)
+        if record is None:
+            db.add(BotState(key=key, state=state, data="{}", expires_at=expires_at))
+        else:
+            if record.expires_at <= now:
+                record.data = "{}"
+            record.state = state
+            record.expires_at = expires_at
+    await db.commit()
+
+async def update_bot_state_data(db: AsyncSession, key: str, data: str, expires_at: float, now: float) -> bool:
+    """
+    Сохраняет данные FSM для существующего неистекшего состояния и продлевает его срок
+    Возвращает False, если состояния нет.
+    """
+    result = await db.execute(
+        update(BotState)
+        .where(BotState.key == key, BotState.expires_at > now)
+        .values(data=data, expires_at=expires_at)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount > 0
+
+async def delete_bot_state(db: AsyncSession, key: str) -> bool:
+    """
+    Удаляет состояние FSM вместе с данными
+    """
+    result = await db.execute(delete(BotState).where(BotState.key == key).execution_options(synchronize_session=False))
+    await db.commit()
+    return result.rowcount > 0
+
+async def delete_expired_bot_states(db: AsyncSession, now: float) -> int:
+    """
+    Удаляет брошенные состояния FSM, срок которых истек
+    Возвращает количество удаленных записей.
+    """
+    result = await db.execute(delete(BotState).where(BotState.expires_at <= now).execution_options(synchronize_session=False))
+    await db.commit()
+    return result.rowcount
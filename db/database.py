@@ -1,34 +1,133 @@
+import contextvars
+from contextlib import asynccontextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.exc import SQLAlchemyError
-from config import DATABASE_URL
-from typing import AsyncGenerator
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from config import (
+    DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+    SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_BUSY_TIMEOUT
+)
+from typing import AsyncIterator
 
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+def _engine_options(url: str) -> dict:
+    """
+    Параметры пула соединений для create_async_engine.
+    SQLite в памяти работает через StaticPool с одним соединением, ему размеры пула не нужны.
+    """
+    options = {"echo": False, "pool_pre_ping": DB_POOL_PRE_PING}
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:"):
+        return options
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE
+    )
+    return options
+
+
+engine = create_async_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
 
 AsyncSessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
 
 Base = declarative_base()
 
+# Диалекты, в которых есть INSERT ... ON CONFLICT
+UPSERT_DIALECTS = {
+    "sqlite": sqlite_insert,
+    "postgresql": postgresql_insert,
+}
+
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """
+        WAL позволяет читать параллельно с записью, synchronous=NORMAL в режиме WAL
+        не теряет целостность и не делает fsync на каждый коммит, а busy_timeout
+        заставляет писателя подождать блокировку вместо ошибки database is locked.
+        """
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        cursor.close()
+
+
+class LazySession:
+    """
+    Обёртка над AsyncSession, которая создаёт сессию только при первом обращении.
+    Обработчики, которые не ходят в базу, не создают и не закрывают сессию вовсе.
+    """
+
+    def __init__(self, factory: async_sessionmaker = AsyncSessionLocal):
+        self._factory = factory
+        self._session: AsyncSession | None = None
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name):
+        if self._session is None:
+            self._session = self._factory()
+        return getattr(self._session, name)
 
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
-async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+
+# Сессия обработчика, который сейчас выполняется в этой задаче
+_current_session: contextvars.ContextVar[LazySession | None] = contextvars.ContextVar("current_session", default=None)
+
+
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[LazySession]:
     """
-    Получение асинхронной сессии базы данных
+    Сессия на один апдейт: открывается лениво и гарантированно закрывается
+    в той же задаче, при ошибке незакоммиченные изменения откатываются.
     """
-    async with AsyncSessionLocal() as session:
-        try:
-            yield session
-        except SQLAlchemyError as e:
-            print(f"Ошибка сессии SQLAlchemy: {e}")
-            raise
+    session = LazySession()
+    token = _current_session.set(session)
+    try:
+        yield session
+    except SQLAlchemyError as e:
+        print(f"Ошибка сессии SQLAlchemy: {e}")
+        raise
+    finally:
+        _current_session.reset(token)
+        await session.close()
+
+
+async def release_connection() -> None:
+    """
+    Завершает открытую транзакцию сессии текущего обработчика и возвращает
+    соединение в пул. Обработчик вызывает её сам, когда работа с базой закончена,
+    а впереди долгое ожидание (например, загрузка архива в /export), чтобы ждущие
+    обработчики не занимали весь пул.
+    Объекты сессии остаются доступны: expire_on_commit=False.
+    """
+    session = _current_session.get()
+    if session is not None and session.opened and session.in_transaction():
+        await session.commit()
+
 
 async def init_models():
     """
     Инициализация моделей базы данных
     """
+    # Модели должны быть зарегистрированы в Base.metadata до create_all
+    import db.models  # noqa: F401
+
     try:
         async with engine.begin() as conn:
             # Для удаления таблиц перед созданием
@@ -38,6 +137,9 @@ async def init_models():
             await conn.run_sync(Base.metadata.create_all)
             print("Создание таблиц успешно завершено")
 
+            from db.migrations import upgrade_schema
+            await conn.run_sync(upgrade_schema)
+
     except SQLAlchemyError as e:
         print(f"Ошибка SQLAlchemy: {e}")
         raise
@@ -0,0 +1,89 @@
+import asyncio
+import csv
+import datetime
+import io
+import json
+import zipfile
+from typing import Dict, Iterable, List, Sequence
+
+from sqlalchemy import Table, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import EXPORT_BATCH_SIZE
+from db.models import User, Note, Payment
+
+
+# Что выгружается командой /export: имя файла в архиве -> таблица
+EXPORT_TABLES: Dict[str, Table] = {
+    "users": User.__table__,
+    "notes": Note.__table__,
+    "payments": Payment.__table__,
+}
+EXPORT_FORMATS = ("csv", "jsonl")
+
+
+def _plain(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def _isoformat(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+_json = json.JSONEncoder(ensure_ascii=False, default=_isoformat)
+
+
+def _write_rows(out: io.TextIOWrapper, file_format: str, columns: List[str], rows: Sequence[tuple]) -> None:
+    if file_format == "csv":
+        csv.writer(out).writerows([_plain(value) for value in row] for row in rows)
+    else:
+        out.write("".join(_json.encode(dict(zip(columns, row))) + "\n" for row in rows))
+
+
+def _write_header(out: io.TextIOWrapper, file_format: str, columns: List[str]) -> None:
+    if file_format == "csv":
+        csv.writer(out).writerow(columns)
+
+
+async def export_tables(db: AsyncSession, path: str, file_format: str, tables: Iterable[str] = EXPORT_TABLES,
+                        batch_size: int = EXPORT_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Выгружает таблицы в ZIP-архив path (по файлу <таблица>.<формат> на таблицу, deflate).
+    Строки читаются курсором пачками по batch_size (stream + yield_per, на PostgreSQL -
+    серверный курсор) как кортежи столбцов, без ORM-объектов, и каждая пачка сразу
+    сжимается и пишется в файл в отдельном потоке, пока читается следующая. Поэтому
+    память не зависит от размера таблиц, а event loop не ждёт диска и сжатия.
+    Все таблицы читаются в одной транзакции.
+    Возвращает количество выгруженных строк по таблицам.
+    """
+    counts = {}
+    archive = await asyncio.to_thread(zipfile.ZipFile, path, "w", zipfile.ZIP_DEFLATED)
+    try:
+        for name in tables:
+            table = EXPORT_TABLES[name]
+            columns = [column.key for column in table.columns]
+            member = await asyncio.to_thread(archive.open, f"{name}.{file_format}", "w", force_zip64=True)
+            out = io.TextIOWrapper(member, encoding="utf-8", newline="")
+            try:
+                await asyncio.to_thread(_write_header, out, file_format, columns)
+                result = await db.stream(select(*table.columns).order_by(*table.primary_key.columns)
+                                         .execution_options(yield_per=batch_size))
+                counts[name] = 0
+                # Пока пачка пишется в потоке, из базы читается следующая
+                writing = None
+                async for rows in result.partitions():
+                    if writing is not None:
+                        await writing
+                    writing = asyncio.ensure_future(asyncio.to_thread(_write_rows, out, file_format, columns, rows))
+                    counts[name] += len(rows)
+                if writing is not None:
+                    await writing
+            finally:
+                await asyncio.to_thread(out.close)
+    finally:
+        await asyncio.to_thread(archive.close)
+    return counts
@@ -0,0 +1,131 @@
+"""
+Массовый импорт пользователей из выгрузки CSV или JSONL.
+
+Поля: user_id (или id), first_name, username, last_name, а также ref_code
+и count_read_cancel, если они есть (выгрузка /export): код и баланс
+сохраняются, иначе пользователь получает новый код и нулевой баланс.
+В CSV - строка заголовков. Строки без user_id или first_name (или с
+некорректным user_id или балансом) пропускаются, как и пользователи, чей
+ref_code уже занят другим пользователем (они считаются отдельно). Пользователи
+пишутся тем же путём, что и буферизованная регистрация (insert_users):
+многострочный INSERT ... ON CONFLICT DO NOTHING, одна транзакция на пачку,
+поэтому уже существующие пользователи не меняются и импорт можно повторять.
+
+Запуск из корня репозитория:
+    python -m db.import_users users.csv [--format csv|jsonl] [--batch-size 1000]
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+from typing import Iterator, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.database import AsyncSessionLocal, init_models
+from db.models import User
+from db.registrations import MAX_BIND_PARAMS, insert_users, new_user_values
+
+
+def _read_rows(path: str, file_format: str) -> Iterator[dict]:
+    with open(path, newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _user_values(row: dict) -> Optional[dict]:
+    """
+    Строка new_user_values из записи выгрузки или None, если запись неполная или некорректная.
+    Реферальный код и баланс отмен прочтения из выгрузки /export сохраняются:
+    иначе после восстановления перестали бы работать ссылки и пропали бы купленные отмены.
+    """
+    user_id = row.get("user_id", row.get("id"))
+    first_name = row.get("first_name")
+    if not first_name:
+        return None
+    try:
+        count_read_cancel = int(row.get("count_read_cancel") or 0)
+        # Отрицательный или слишком большой user_id не превращается в ref_code (ValueError)
+        values = new_user_values(int(user_id), row.get("username") or None, first_name, row.get("last_name") or None)
+    except (TypeError, ValueError):
+        return None
+    if count_read_cancel < 0:
+        return None
+    if row.get("ref_code"):
+        values["ref_code"] = row["ref_code"]
+    values["count_read_cancel"] = count_read_cancel
+    return values
+
+
+async def _drop_taken_ref_codes(db: AsyncSession, batch: dict) -> int:
+    """
+    Убирает из пачки пользователей, чей ref_code уже принадлежит другому
+    пользователю - в базе или раньше в этой же пачке. Возвращает, сколько убрано.
+    """
+    codes = list({values["ref_code"] for values in batch.values()})
+    owners = {}
+    for start in range(0, len(codes), MAX_BIND_PARAMS):
+        owners.update((await db.execute(
+            select(User.ref_code, User.user_id).where(User.ref_code.in_(codes[start:start + MAX_BIND_PARAMS]))
+        )).all())
+    taken = [user_id for user_id, values in batch.items() if owners.setdefault(values["ref_code"], user_id) != user_id]
+    for user_id in taken:
+        del batch[user_id]
+    return len(taken)
+
+
+async def import_users(path: str, file_format: str, batch_size: int = 1000) -> dict:
+    """
+    Читает файл потоково и вставляет пользователей пачками по batch_size.
+    Возвращает счётчики: прочитано, вставлено, уже были, пропущено,
+    с занятым ref_code.
+    """
+    counters = {"read": 0, "inserted": 0, "existing": 0, "skipped": 0, "taken_ref_codes": 0}
+
+    async def write(batch: dict) -> None:
+        async with AsyncSessionLocal() as db:
+            counters["taken_ref_codes"] += await _drop_taken_ref_codes(db, batch)
+            inserted = await insert_users(db, list(batch.values()), batch_size)
+        counters["inserted"] += inserted
+        counters["existing"] += len(batch) - inserted
+
+    batch = {}
+    for row in _read_rows(path, file_format):
+        counters["read"] += 1
+        values = _user_values(row)
+        if values is None:
+            counters["skipped"] += 1
+            continue
+        # Повтор пользователя в выгрузке: остаётся последняя запись
+        batch[values["user_id"]] = values
+        if len(batch) >= batch_size:
+            await write(batch)
+            batch = {}
+    if batch:
+        await write(batch)
+    return counters
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="по умолчанию по расширению файла")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    file_format = args.format or ("csv" if os.path.splitext(args.path)[1].lower() == ".csv" else "jsonl")
+
+    await init_models()
+    counters = await import_users(args.path, file_format, args.batch_size)
+    print(f"Прочитано записей: {counters['read']}. Добавлено пользователей: {counters['inserted']}, "
+          f"уже были: {counters['existing']}, пропущено неполных: {counters['skipped']}, "
+          f"с занятым реферальным кодом: {counters['taken_ref_codes']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
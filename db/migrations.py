@@ -0,0 +1,84 @@
+import datetime
+from collections import Counter, defaultdict
+
+from sqlalchemy import and_, case, delete, exists, func, insert, inspect, or_, select
+from sqlalchemy.engine import Connection
+
+from db.models import Note, User, Payment, DailyStats, CreatorStats
+
+
+def _delete_duplicate_notes(conn: Connection) -> int:
+    """
+    Удаляет дубликаты посланий для одной пары (автор, получатель),
+    оставляя самое новое. Нужно перед созданием уникального индекса.
+    Возвращает количество удалённых строк.
+    """
+    notes = Note.__table__
+    newer = notes.alias("newer")
+    stmt = delete(notes).where(
+        exists().where(
+            newer.c.created_by_user_id == notes.c.created_by_user_id,
+            newer.c.for_user_id == notes.c.for_user_id,
+            or_(
+                newer.c.created_at > notes.c.created_at,
+                and_(newer.c.created_at == notes.c.created_at, newer.c.id > notes.c.id)
+            )
+        )
+    )
+    return conn.execute(stmt).rowcount
+
+
+def _backfill_rollups(conn: Connection) -> None:
+    """
+    Заполняет daily_stats и creator_stats по уже накопленным данным, если агрегатов
+    ещё нет (первый запуск с ними): один GROUP BY по каждой таблице.
+    Дата прочтения посланий не хранилась, поэтому прошлые прочтения попадают
+    только в creator_stats, а активные пользователи прошлых дней неизвестны.
+    """
+    if conn.execute(select(DailyStats.day).limit(1)).first() or conn.execute(select(CreatorStats.user_id).limit(1)).first():
+        return
+    daily = defaultdict(Counter)
+    sources = (
+        (User.created_at, {"new_users": func.count()}),
+        (Note.created_at, {"notes_created": func.count()}),
+        (Payment.created_at, {"payments": func.count(), "earnings": func.sum(Payment.total_amount),
+                              "read_cancels_sold": func.sum(Payment.quantity)}),
+    )
+    for created_at, columns in sources:
+        day = func.date(created_at)
+        for row in conn.execute(select(day, *columns.values()).where(created_at.is_not(None)).group_by(day)):
+            # SQLite отдаёт дату строкой, PostgreSQL - объектом date
+            daily[datetime.date.fromisoformat(str(row[0]))].update(dict(zip(columns, row[1:])))
+    if not daily:
+        return
+    # executemany требует одинаковый набор столбцов во всех строках
+    names = [name for _, columns in sources for name in columns]
+    conn.execute(insert(DailyStats), [{"day": day, **{name: counters[name] for name in names}} for day, counters in daily.items()])
+    conn.execute(insert(CreatorStats).from_select(
+        ["user_id", "notes_created", "notes_read"],
+        select(Note.created_by_user_id, func.count(), func.sum(case((Note.is_read == True, 1), else_=0)))
+        .group_by(Note.created_by_user_id)
+    ))
+    print(f"Статистика посчитана по существующим данным за {len(daily)} дней")
+
+
+def upgrade_schema(conn: Connection) -> None:
+    """
+    Доводит существующую базу до текущих моделей.
+    create_all создаёт только отсутствующие таблицы, поэтому индексы,
+    добавленные в уже существующие таблицы, создаются здесь, а агрегаты
+    статистики при первом запуске с ними заполняются по существующим данным.
+    Безопасно вызывать при каждом запуске.
+    """
+    for table in (Note.__table__,):
+        existing = {index["name"] for index in inspect(conn).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if index.unique:
+                removed = _delete_duplicate_notes(conn)
+                if removed:
+                    print(f"Удалено дубликатов посланий: {removed}")
+            index.create(conn)
+            print(f"Создан индекс {index.name}")
+    _backfill_rollups(conn)
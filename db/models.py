@@ -6,7 +6,7 @@ from .database import Base
 from sqlalchemy.orm import mapped_column, relationship, Mapped
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.sql import func
-from sqlalchemy import Integer, String, Boolean, DateTime, Text, ForeignKey
+from sqlalchemy import Integer, String, Boolean, Date, DateTime, Text, ForeignKey, Index, Float
 
 class User(Base):
     __tablename__ = "users"
@@ -38,9 +38,39 @@ class Note(Base):
     created_by_user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.user_id"), nullable=False)
     created_by_user: Mapped["User"] = relationship("User", back_populates="notes")
 
+    __table_args__ = (
+        # Одно послание на пару (автор, получатель): по нему же ищутся послания при переходе по ссылке
+        Index("uq_notes_creator_recipient", "created_by_user_id", "for_user_id", unique=True),
+        # Список /mynotes: фильтр по автору и keyset-пагинация по (created_at, id)
+        Index("ix_notes_creator_created_at", "created_by_user_id", "created_at", "id"),
+        # Поиск устаревших посланий для db.retention
+        Index("ix_notes_created_at", "created_at"),
+    )
+
     def __repr__(self):
         return f"<Note(id={self.id}, for_user_id={self.for_user_id}, is_read={self.is_read})>"
 
+class ArchivedNote(Base):
+    """
+    Послания, перенесённые из notes по сроку хранения (NOTES_RETENTION_DAYS, RETENTION_MODE=archive).
+    Бот их не читает: notes остаётся маленькой, а старые послания можно достать запросом к этой таблице.
+    """
+    __tablename__ = "archived_notes"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # id послания в notes; SQLite может выдать освободившийся id снова, поэтому он не ключ
+    note_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    for_user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    created_by_user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    text: Mapped[str] = mapped_column(Text, nullable=False)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+    fake_is_read: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+    is_read: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+    archived_at: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<ArchivedNote(id={self.id}, note_id={self.note_id})>"
+
 class AdminPanel(Base):
     __tablename__ = "admin_panel"
 
@@ -53,4 +83,76 @@ class AdminPanel(Base):
     admin_user: Mapped["User"] = relationship("User")
 
     def __repr__(self):
-        return f"<AdminPanel(id={self.id}, admin_user_id={self.admin_user_id})>"
\ No newline at end of file
+        return f"<AdminPanel(id={self.id}, admin_user_id={self.admin_user_id})>"
+
+class Payment(Base):
+    __tablename__ = "payments"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    telegram_payment_charge_id: Mapped[str] = mapped_column(String, unique=True, nullable=False)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.user_id"), nullable=False)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    total_amount: Mapped[int] = mapped_column(Integer, nullable=False)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<Payment(id={self.id}, user_id={self.user_id}, quantity={self.quantity})>"
+
+class BotState(Base):
+    __tablename__ = "bot_states"
+
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    state: Mapped[str | None] = mapped_column(String, nullable=True)
+    data: Mapped[str] = mapped_column(Text, default="{}", nullable=False)
+    # Unix time, после которого состояние считается брошенным
+    expires_at: Mapped[float] = mapped_column(Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<BotState(key={self.key}, state={self.state})>"
+
+class DailyStats(Base):
+    """
+    Счётчики за сутки (UTC) для /stats. Обновляются инкрементально из crud через db.rollups,
+    поэтому статистика за N дней - это N строк, а не проход по notes и payments.
+    """
+    __tablename__ = "daily_stats"
+
+    day: Mapped[datetime.date] = mapped_column(Date, primary_key=True)
+    new_users: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    active_users: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    notes_created: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    notes_read: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    payments: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    earnings: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    read_cancels_sold: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    read_cancels_spent: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<DailyStats(day={self.day}, notes_created={self.notes_created})>"
+
+class DailyActiveUser(Base):
+    """
+    Кто был активен в какой день: по ней считается DailyStats.active_users без повторов
+    """
+    __tablename__ = "daily_active_users"
+
+    day: Mapped[datetime.date] = mapped_column(Date, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+class CreatorStats(Base):
+    """
+    Счётчики автора за всё время: сколько посланий написал и сколько из них прочитали
+    """
+    __tablename__ = "creator_stats"
+
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    notes_created: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    notes_read: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        # Топ авторов по прочтениям в /stats
+        Index("ix_creator_stats_notes_read", "notes_read"),
+    )
+
+    def __repr__(self):
+        return f"<CreatorStats(user_id={self.user_id}, notes_read={self.notes_read})>"
@@ -0,0 +1,55 @@
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import update, or_
+
+from config import READ_RECEIPTS_MODE, READ_RECEIPTS_FLUSH_MS, READ_RECEIPTS_BATCH
+from db.database import AsyncSessionLocal
+from db.models import Note
+from db.write_behind import WriteBehindBuffer
+
+
+class ReadReceiptBuffer(WriteBehindBuffer):
+    """
+    Отложенная запись отметок о прочтении (READ_RECEIPTS_MODE=buffered).
+    Отметки копятся в памяти, повторные прочтения одного послания схлопываются,
+    и раз в interval секунд или по batch_size штук пишутся одной транзакцией
+    с одним UPDATE ... WHERE id IN (...) на пачку. При остановке всё накопленное
+    дописывается. Если enabled=False, буфер не используется и crud пишет сразу.
+    """
+
+    NAME = "read receipts"
+
+    def __init__(self, enabled: bool = READ_RECEIPTS_MODE == "buffered", session_factory=AsyncSessionLocal,
+                 interval: float = READ_RECEIPTS_FLUSH_MS / 1000, batch_size: int = READ_RECEIPTS_BATCH):
+        super().__init__(session_factory, interval, batch_size)
+        self.enabled = enabled
+        # note_id -> (created_by_user_id, for_user_id)
+        self._pending: Dict[int, Tuple[int, int]]
+
+    def add(self, note: Note) -> None:
+        self._pending[note.id] = (note.created_by_user_id, note.for_user_id)
+        self._added()
+
+    async def settle(self, note_id: Optional[int] = None, pair: Optional[Tuple[int, int]] = None) -> None:
+        """
+        Дописывает накопленные отметки, если среди них есть послание note_id
+        или послание пары (автор, получатель), либо если запись уже идёт.
+        Вызывается перед любым изменением статуса прочтения, чтобы отложенная
+        отметка не перезаписала более позднее изменение.
+        """
+        if self._lock.locked() or note_id in self._pending or (pair is not None and pair in self._pending.values()):
+            await self.flush()
+
+    async def _write(self, db, pending: Dict[int, Tuple[int, int]]) -> None:
+        note_ids = list(pending)
+        for start in range(0, len(note_ids), self.batch_size):
+            await db.execute(
+                update(Note)
+                .where(Note.id.in_(note_ids[start:start + self.batch_size]),
+                       or_(Note.is_read == False, Note.fake_is_read == False))
+                .values(is_read=True, fake_is_read=True)
+                .execution_options(synchronize_session=False)
+            )
+
+
+read_receipts = ReadReceiptBuffer()
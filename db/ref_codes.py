@@ -0,0 +1,71 @@
+"""
+Перевыпуск реферальных кодов пачками.
+
+По умолчанию новые коды получают только пользователи, чей код не в текущем
+формате: старые MD5-коды и коды прошлой REF_CODE_VERSION (например, после
+смены REF_CODE_SECRET). С --rotate новый код следующего поколения получают все.
+Старые ссылки перевыпущенных пользователей перестают работать; запущенный бот
+может отвечать по ним, пока не истечёт USER_CACHE_TTL.
+
+Запуск из корня репозитория:
+    python -m db.ref_codes [--rotate] [--batch-size 1000] [--dry-run]
+"""
+import argparse
+import asyncio
+from typing import Tuple
+
+from sqlalchemy import select, update
+
+from db.database import AsyncSessionLocal, init_models
+from db.models import User
+from db.utils import id_to_ref_code, next_ref_code, ref_code_to_id
+
+
+async def rewrite_ref_codes(rotate: bool = False, batch_size: int = 1000, dry_run: bool = False) -> Tuple[int, int]:
+    """
+    Проходит по пользователям пачками по batch_size (keyset по user_id)
+    и пишет новые коды одним bulk UPDATE по первичному ключу на пачку.
+    Коды не пересекаются между пользователями, поэтому порядок записи не важен.
+    Возвращает (просмотрено пользователей, изменено кодов).
+    """
+    checked = changed = 0
+    last_user_id = None
+    async with AsyncSessionLocal() as db:
+        while True:
+            query = select(User.user_id, User.ref_code).order_by(User.user_id).limit(batch_size)
+            if last_user_id is not None:
+                query = query.where(User.user_id > last_user_id)
+            rows = (await db.execute(query)).all()
+            if not rows:
+                break
+            last_user_id = rows[-1].user_id
+            checked += len(rows)
+
+            changes = []
+            for user_id, ref_code in rows:
+                if rotate:
+                    changes.append({"user_id": user_id, "ref_code": next_ref_code(user_id, ref_code)})
+                elif (ref_code_to_id(ref_code) or (None,))[0] != user_id:
+                    changes.append({"user_id": user_id, "ref_code": id_to_ref_code(user_id)})
+            changed += len(changes)
+            if changes and not dry_run:
+                await db.execute(update(User), changes)
+                await db.commit()
+    return checked, changed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rotate", action="store_true", help="выдать новые коды всем пользователям")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать, ничего не записывая")
+    args = parser.parse_args()
+
+    await init_models()
+    checked, changed = await rewrite_ref_codes(args.rotate, args.batch_size, args.dry_run)
+    action = "Нужно перевыпустить" if args.dry_run else "Перевыпущено"
+    print(f"Проверено пользователей: {checked}. {action} кодов: {changed}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,108 @@
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import REGISTRATIONS_MODE, REGISTRATIONS_FLUSH_MS, REGISTRATIONS_BATCH
+from db.database import AsyncSessionLocal, UPSERT_DIALECTS
+from db.models import User
+from db.utils import id_to_ref_code
+from db.write_behind import WriteBehindBuffer
+
+
+def new_user_values(user_id: int, username: Optional[str], first_name: str, last_name: Optional[str]) -> dict:
+    """
+    Строка нового пользователя для INSERT (created_at проставляет база)
+    """
+    return {
+        "user_id": user_id,
+        "username": username,
+        "first_name": first_name,
+        "last_name": last_name,
+        "ref_code": id_to_ref_code(user_id),
+        "count_read_cancel": 0,
+        "is_admin": False,
+    }
+
+
+# Предел параметров в одном запросе у PostgreSQL (у SQLite с 3.32 - 32766)
+MAX_BIND_PARAMS = 32766
+
+
+async def insert_users(db: AsyncSession, rows: List[dict], batch_size: int = REGISTRATIONS_BATCH) -> int:
+    """
+    Вставляет пользователей многострочными INSERT ... ON CONFLICT DO NOTHING
+    по batch_size строк (но не больше, чем позволяет MAX_BIND_PARAMS)
+    в одной транзакции и коммитит её.
+    Уже существующие пользователи (по user_id) пропускаются; если ref_code
+    занят другим пользователем, INSERT падает с IntegrityError, а не теряет строку молча.
+    Возвращает количество вставленных строк.
+    """
+    if not rows:
+        return 0
+    batch_size = max(1, min(batch_size, MAX_BIND_PARAMS // len(rows[0])))
+    dialect_insert = UPSERT_DIALECTS.get(db.bind.dialect.name)
+    inserted = 0
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        if dialect_insert is not None:
+            stmt = dialect_insert(User).values(batch).on_conflict_do_nothing(index_elements=[User.user_id])
+        else:
+            existing = set((await db.execute(
+                select(User.user_id).where(User.user_id.in_([row["user_id"] for row in batch]))
+            )).scalars())
+            batch = [row for row in batch if row["user_id"] not in existing]
+            if not batch:
+                continue
+            stmt = insert(User).values(batch)
+        inserted += (await db.execute(stmt)).rowcount
+    await db.commit()
+    return inserted
+
+
+class RegistrationBuffer(WriteBehindBuffer):
+    """
+    Отложенная запись новых пользователей (REGISTRATIONS_MODE=buffered).
+    create_or_update_user кладёт строку нового пользователя сюда и сразу
+    возвращает его, а раз в interval секунд или по batch_size штук все
+    накопленные пользователи пишутся одной транзакцией через insert_users.
+    Пока пользователь не записан, crud отдаёт его из буфера, а перед любой
+    записью, которая ссылается на пользователя, вызывает settle.
+    При остановке всё накопленное дописывается. Если enabled=False,
+    буфер не используется и crud вставляет пользователя сразу.
+    """
+
+    NAME = "registrations"
+
+    def __init__(self, enabled: bool = REGISTRATIONS_MODE == "buffered", session_factory=AsyncSessionLocal,
+                 interval: float = REGISTRATIONS_FLUSH_MS / 1000, batch_size: int = REGISTRATIONS_BATCH):
+        super().__init__(session_factory, interval, batch_size)
+        self.enabled = enabled
+        # user_id -> строка new_user_values
+        self._pending: Dict[int, dict]
+
+    def add(self, values: dict) -> None:
+        self._pending[values["user_id"]] = values
+        self._added()
+
+    def pending(self, user_id: int) -> Optional[dict]:
+        """
+        Значения ещё не записанного пользователя или None
+        """
+        return self._pending.get(user_id) or self._flushing.get(user_id)
+
+    async def settle(self, user_ids: Iterable[int]) -> None:
+        """
+        Дописывает накопленных пользователей, если среди них (или среди тех,
+        кто пишется прямо сейчас) есть кто-то из user_ids. Вызывается перед
+        записью, которая ссылается на пользователя или меняет его строку.
+        Запись чужой пачки не ждёт: вызывающий может держать открытую транзакцию.
+        """
+        if any(self.pending(user_id) for user_id in user_ids):
+            await self.flush()
+
+    async def _write(self, db, pending: Dict[int, dict]) -> None:
+        await insert_users(db, list(pending.values()), self.batch_size)
+
+
+registrations = RegistrationBuffer()
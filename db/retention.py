@@ -0,0 +1,220 @@
+"""
+Срок хранения посланий и чистка служебных таблиц.
+
+Послания старше NOTES_RETENTION_DAYS дней (по дате последней записи: при
+перезаписи дата обновляется) переносятся в archived_notes или удаляются,
+пачками по RETENTION_BATCH, по транзакции на пачку. Отметки активности
+daily_active_users за дни, которые уже не нужны для /stats, удаляются всегда.
+Бот делает это сам раз в RETENTION_INTERVAL секунд, отсюда можно запустить
+один проход вручную.
+
+Запуск из корня репозитория:
+    python -m db.retention [--days 365] [--mode archive|delete] [--batch-size 500] [--dry-run]
+"""
+import argparse
+import asyncio
+import contextvars
+import datetime
+import time
+from typing import Optional
+
+from sqlalchemy import and_, delete, func, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import NOTES_RETENTION_DAYS, RETENTION_MODE, RETENTION_INTERVAL, RETENTION_BATCH, RETENTION_DRY_RUN
+from db.cache import notes_cache
+from db.database import AsyncSessionLocal, init_models
+from db.models import Note, ArchivedNote, DailyActiveUser
+from db.rollups import today
+
+from global_logger import logger
+
+
+# Столбцы notes, которые переносятся в archived_notes (id послания пишется в note_id)
+ARCHIVED_COLUMNS = ("id", "for_user_id", "created_by_user_id", "text", "created_at", "fake_is_read", "is_read")
+
+
+def _archived_values(row) -> dict:
+    values = dict(row._mapping)
+    values["note_id"] = values.pop("id")
+    return values
+
+
+async def purge_notes_batch(db: AsyncSession, cutoff: datetime.datetime, batch_size: int, archive: bool) -> int:
+    """
+    Переносит в archived_notes (archive=True) или удаляет до batch_size самых старых
+    посланий, записанных раньше cutoff, и коммитит. Удалённые послания убираются из кэша.
+    Возвращает количество убранных из notes посланий.
+    """
+    ids = list((await db.execute(
+        select(Note.id).where(Note.created_at < cutoff).order_by(Note.created_at).limit(batch_size)
+    )).scalars())
+    if not ids:
+        return 0
+    # Послание могли перезаписать после выборки: у него новая дата, и оно остаётся
+    old = and_(Note.id.in_(ids), Note.created_at < cutoff)
+    columns = [getattr(Note, name) for name in ARCHIVED_COLUMNS]
+    stmt = delete(Note).where(old).execution_options(synchronize_session=False)
+    if db.bind.dialect.delete_returning:
+        rows = (await db.execute(stmt.returning(*columns))).all()
+    else:
+        rows = (await db.execute(select(*columns).where(old))).all()
+        await db.execute(stmt)
+    if archive and rows:
+        await db.execute(insert(ArchivedNote), [_archived_values(row) for row in rows])
+    await db.commit()
+    for row in rows:
+        notes_cache.invalidate((row.created_by_user_id, row.for_user_id))
+    return len(rows)
+
+
+async def purge_active_users(db: AsyncSession, before: datetime.date) -> int:
+    """
+    Удаляет отметки daily_active_users за дни раньше before, по транзакции на день.
+    Возвращает количество удалённых строк.
+    """
+    days = list((await db.execute(
+        select(DailyActiveUser.day).where(DailyActiveUser.day < before).distinct().order_by(DailyActiveUser.day)
+    )).scalars())
+    removed = 0
+    for day in days:
+        result = await db.execute(delete(DailyActiveUser).where(DailyActiveUser.day == day).execution_options(synchronize_session=False))
+        await db.commit()
+        removed += result.rowcount
+    return removed
+
+
+class NotesRetention:
+    """
+    Фоновая чистка по сроку хранения: при запуске бота и затем раз в interval секунд.
+    Пачки маленькие и между ними есть пауза, поэтому запись обработчиков не ждёт
+    долгой блокировки (на SQLite писать может только одна транзакция). При остановке
+    текущая пачка дописывается, остальное остаётся до следующего запуска.
+    С dry_run ничего не удаляется, только считается, сколько было бы убрано.
+    """
+
+    # Пауза между пачками, в секундах
+    BATCH_PAUSE = 0.05
+    # Отметки активности нужны StatsRollup только за сегодня и вчера (запись после полуночи)
+    ACTIVE_USERS_KEEP_DAYS = 2
+
+    def __init__(self, session_factory=AsyncSessionLocal, retention_days: int = NOTES_RETENTION_DAYS,
+                 mode: str = RETENTION_MODE, interval: float = RETENTION_INTERVAL,
+                 batch_size: int = RETENTION_BATCH, dry_run: bool = RETENTION_DRY_RUN):
+        self.session_factory = session_factory
+        self.retention_days = retention_days
+        self.mode = mode
+        self.interval = interval
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.runs = 0
+        self.purged_notes = 0
+        self.purged_active_users = 0
+        self.last_run: Optional[dict] = None
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def cutoff(self) -> Optional[datetime.datetime]:
+        """
+        Послания, записанные раньше этого момента, устарели; None - хранить всегда
+        """
+        if not self.retention_days:
+            return None
+        return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=self.retention_days)
+
+    async def run_once(self) -> dict:
+        """
+        Один проход чистки. Возвращает его итоги: сколько посланий и отметок
+        активности убрано (при dry_run - было бы убрано), пачек, секунд.
+        """
+        started = time.perf_counter()
+        run = {"dry_run": self.dry_run, "mode": self.mode, "notes": 0, "active_users": 0, "batches": 0}
+        cutoff = self.cutoff()
+        before = today() - datetime.timedelta(days=self.ACTIVE_USERS_KEEP_DAYS - 1)
+        try:
+            async with self.session_factory() as db:
+                if self.dry_run:
+                    if cutoff is not None:
+                        run["notes"] = (await db.execute(select(func.count()).where(Note.created_at < cutoff))).scalar_one()
+                    run["active_users"] = (await db.execute(
+                        select(func.count()).where(DailyActiveUser.day < before)
+                    )).scalar_one()
+                else:
+                    while cutoff is not None and not self._stopping.is_set():
+                        purged = await purge_notes_batch(db, cutoff, self.batch_size, self.mode == "archive")
+                        run["notes"] += purged
+                        run["batches"] += 1
+                        if purged < self.batch_size:
+                            break
+                        await asyncio.sleep(self.BATCH_PAUSE)
+                    run["active_users"] = await purge_active_users(db, before)
+        except SQLAlchemyError as e:
+            run["error"] = str(e)
+            logger.error("Retention run failed after %s notes, will retry: %s", run["notes"], e)
+        run["seconds"] = time.perf_counter() - started
+
+        self.runs += 1
+        if not self.dry_run:
+            self.purged_notes += run["notes"]
+            self.purged_active_users += run["active_users"]
+        self.last_run = run
+        action = "archived" if self.mode == "archive" else "deleted"
+        logger.info("Retention run: %s notes %s (cutoff %s), %s daily active user rows %s, %s batches in %.2fs",
+                    run["notes"], f"would be {action}" if self.dry_run else action, cutoff,
+                    run["active_users"], "would be removed" if self.dry_run else "removed", run["batches"], run["seconds"])
+        return run
+
+    def start(self) -> None:
+        if self._task is None:
+            self._stopping.clear()
+            # Пустой контекст: фоновая чистка не относится к тому, кто её запустил
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self) -> None:
+        while not self._stopping.is_set():
+            await self.run_once()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "purged_notes": self.purged_notes,
+            "purged_active_users": self.purged_active_users,
+            "last_run": self.last_run,
+        }
+
+    async def stop(self) -> None:
+        """
+        Останавливает фоновую чистку, дождавшись текущей пачки
+        """
+        if self._task is not None:
+            self._stopping.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+retention = NotesRetention()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=NOTES_RETENTION_DAYS, help="срок хранения посланий, 0 - хранить всегда")
+    parser.add_argument("--mode", choices=("archive", "delete"), default=RETENTION_MODE)
+    parser.add_argument("--batch-size", type=int, default=RETENTION_BATCH)
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать, ничего не удалять")
+    args = parser.parse_args()
+
+    await init_models()
+    run = await NotesRetention(retention_days=args.days, mode=args.mode, batch_size=args.batch_size,
+                               dry_run=args.dry_run).run_once()
+    action = "было бы убрано" if args.dry_run else ("перенесено в архив" if args.mode == "archive" else "удалено")
+    print(f"Посланий {action}: {run['notes']}, отметок активности: {run['active_users']}, "
+          f"пачек: {run['batches']}, {run['seconds']:.2f} с")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
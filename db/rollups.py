@@ -0,0 +1,143 @@
+import datetime
+from collections import Counter, defaultdict
+from typing import Dict, Optional, Set, Tuple
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import STATS_FLUSH_MS
+from db.database import AsyncSessionLocal, UPSERT_DIALECTS
+from db.models import DailyStats, DailyActiveUser, CreatorStats
+from db.write_behind import WriteBehindBuffer
+
+
+def today() -> datetime.date:
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+async def _add_counters(db: AsyncSession, model, key: dict, counters: Counter) -> None:
+    """
+    Прибавляет counters к строке модели с первичным ключом key, создавая её при необходимости:
+    INSERT ... ON CONFLICT DO UPDATE SET col = col + excluded.col
+    """
+    dialect_insert = UPSERT_DIALECTS.get(db.bind.dialect.name)
+    if dialect_insert is not None:
+        stmt = dialect_insert(model).values(**key, **counters)
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=list(key),
+            set_={name: getattr(model, name) + getattr(stmt.excluded, name) for name in counters}
+        ))
+        return
+    where = [getattr(model, name) == value for name, value in key.items()]
+    result = await db.execute(
+        update(model).where(*where)
+        .values({name: getattr(model, name) + value for name, value in counters.items()})
+        .execution_options(synchronize_session=False)
+    )
+    if not result.rowcount:
+        await db.execute(insert(model).values(**key, **counters))
+
+
+async def _insert_active_users(db: AsyncSession, day: datetime.date, user_ids: Set[int]) -> int:
+    """
+    Записывает активных за день пользователей, которых ещё нет в daily_active_users.
+    Возвращает, сколько из них новые за этот день.
+    """
+    rows = [{"day": day, "user_id": user_id} for user_id in user_ids]
+    dialect_insert = UPSERT_DIALECTS.get(db.bind.dialect.name)
+    if dialect_insert is not None:
+        return (await db.execute(dialect_insert(DailyActiveUser).values(rows).on_conflict_do_nothing())).rowcount
+    existing = set((await db.execute(
+        select(DailyActiveUser.user_id).where(DailyActiveUser.day == day, DailyActiveUser.user_id.in_(user_ids))
+    )).scalars())
+    rows = [row for row in rows if row["user_id"] not in existing]
+    if rows:
+        await db.execute(insert(DailyActiveUser).values(rows))
+    return len(rows)
+
+
+class _Increments:
+    """
+    Накопленные с последней записи приращения
+    """
+
+    def __init__(self):
+        self.daily: Dict[datetime.date, Counter] = defaultdict(Counter)
+        self.creators: Dict[int, Counter] = defaultdict(Counter)
+        self.active: Dict[datetime.date, Set[int]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self.daily) + len(self.creators) + len(self.active)
+
+
+class StatsRollup(WriteBehindBuffer):
+    """
+    Инкрементальные счётчики для /stats: по дням (daily_stats), по авторам (creator_stats)
+    и активные за день пользователи (daily_active_users).
+    crud вызывает count/count_creator после коммита события, db_handler - touch на каждый
+    апдейт. Приращения копятся в памяти и раз в interval секунд пишутся одной транзакцией:
+    по одному upsert на день и на автора, поэтому запись послания или оплата не ждёт
+    лишних запросов и не борется за одну строку daily_stats. При аварийном завершении
+    процесса теряются приращения за последний интервал.
+    """
+
+    NAME = "stats increments"
+    # Пользователей, отмеченных активными, пишется за раз не больше стольких
+    ACTIVE_BATCH = 500
+
+    def __init__(self, session_factory=AsyncSessionLocal, interval: float = STATS_FLUSH_MS / 1000):
+        super().__init__(session_factory, interval)
+        self._pending: _Increments
+        # Уже отмеченные сегодня этим процессом пользователи: повторные апдейты не пишутся
+        self._seen: Tuple[Optional[datetime.date], Set[int]] = (None, set())
+
+    def _new_pending(self) -> _Increments:
+        return _Increments()
+
+    def count(self, **deltas: int) -> None:
+        self._pending.daily[today()].update(deltas)
+        self._added()
+
+    def count_creator(self, user_id: int, **deltas: int) -> None:
+        self._pending.creators[user_id].update(deltas)
+        self._added()
+
+    def touch(self, user_id: int) -> None:
+        """
+        Отмечает пользователя активным сегодня
+        """
+        day = today()
+        seen_day, seen = self._seen
+        if seen_day != day:
+            seen = set()
+            self._seen = (day, seen)
+        if user_id in seen:
+            return
+        seen.add(user_id)
+        self._pending.active[day].add(user_id)
+        self._added()
+
+    async def _write(self, db, pending: _Increments) -> None:
+        for day, user_ids in pending.active.items():
+            user_ids = list(user_ids)
+            for start in range(0, len(user_ids), self.ACTIVE_BATCH):
+                added = await _insert_active_users(db, day, set(user_ids[start:start + self.ACTIVE_BATCH]))
+                if added:
+                    pending.daily[day]["active_users"] += added
+        for day, counters in pending.daily.items():
+            await _add_counters(db, DailyStats, {"day": day}, counters)
+        for user_id, counters in pending.creators.items():
+            await _add_counters(db, CreatorStats, {"user_id": user_id}, counters)
+
+    def _restore(self, pending: _Increments) -> None:
+        for day, counters in pending.daily.items():
+            # active_users посчитаны заново при следующей попытке
+            counters.pop("active_users", None)
+            self._pending.daily[day].update(counters)
+        for user_id, counters in pending.creators.items():
+            self._pending.creators[user_id].update(counters)
+        for day, user_ids in pending.active.items():
+            self._pending.active[day].update(user_ids)
+
+
+rollups = StatsRollup()
@@ -1,7 +1,79 @@
+import base64
 import hashlib
+import re
+from typing import Optional, Tuple
 
-def id_to_ref_code(user_id: int) -> str:
-    """Генерирует код из ID"""
-    hash_obj = hashlib.md5(str(user_id).encode())
-    hex_digest = hash_obj.hexdigest()
-    return hex_digest[:8].upper() 
\ No newline at end of file
+from config import REF_CODE_SECRET, REF_CODE_VERSION
+
+# Реферальный код - это версия формата и зашифрованный 64-битный блок
+# (поколение << USER_ID_BITS | user_id), записанные в base64url: 9 байт -> 12 символов.
+# Шифр - сеть Фейстеля с ключом, то есть биекция: у разных (user_id, поколение)
+# коды всегда разные, и проверять их уникальность запросами к базе не нужно.
+# Без ключа по коду нельзя ни узнать user_id, ни подобрать код другого пользователя.
+USER_ID_BITS = 52
+GENERATION_BITS = 64 - USER_ID_BITS
+FEISTEL_ROUNDS = 4
+REF_CODE_LENGTH = 12
+
+_HALF_MASK = (1 << 32) - 1
+_USER_ID_MASK = (1 << USER_ID_BITS) - 1
+_REF_CODE_RE = re.compile(rf"[A-Za-z0-9_-]{{{REF_CODE_LENGTH}}}")
+_KEY = hashlib.blake2b(REF_CODE_SECRET.encode(), digest_size=32, person=b"ref_code").digest()
+
+
+def _round(half: int, number: int, version: int) -> int:
+    data = half.to_bytes(4, "big") + bytes((number, version))
+    return int.from_bytes(hashlib.blake2b(data, key=_KEY, digest_size=4).digest(), "big")
+
+
+def _encrypt(block: int, version: int) -> int:
+    left, right = block >> 32, block & _HALF_MASK
+    for number in range(FEISTEL_ROUNDS):
+        left, right = right, left ^ _round(right, number, version)
+    return left << 32 | right
+
+
+def _decrypt(block: int, version: int) -> int:
+    left, right = block >> 32, block & _HALF_MASK
+    for number in reversed(range(FEISTEL_ROUNDS)):
+        left, right = right ^ _round(left, number, version), left
+    return left << 32 | right
+
+
+def id_to_ref_code(user_id: int, generation: int = 0) -> str:
+    """
+    Генерирует код из ID и номера поколения (сколько раз пользователь менял код).
+    Поколение берётся по модулю 2 ** GENERATION_BITS.
+    """
+    if not 0 <= user_id <= _USER_ID_MASK:
+        raise ValueError(f"user_id {user_id} does not fit into {USER_ID_BITS} bits")
+    generation %= 1 << GENERATION_BITS
+    block = _encrypt(generation << USER_ID_BITS | user_id, REF_CODE_VERSION)
+    return base64.urlsafe_b64encode(bytes((REF_CODE_VERSION,)) + block.to_bytes(8, "big")).decode()
+
+
+def ref_code_to_id(ref_code: str) -> Optional[Tuple[int, int]]:
+    """
+    Обратное к id_to_ref_code: возвращает (user_id, поколение) или None,
+    если код не в текущем формате (старый MD5-код, другая версия или мусор).
+    Любой код текущего формата во что-то расшифровывается, поэтому
+    найденный пользователь должен иметь именно этот ref_code.
+    """
+    if not _REF_CODE_RE.fullmatch(ref_code):
+        return None
+    raw = base64.urlsafe_b64decode(ref_code)
+    if raw[0] != REF_CODE_VERSION:
+        return None
+    block = _decrypt(int.from_bytes(raw[1:], "big"), REF_CODE_VERSION)
+    return block & _USER_ID_MASK, block >> USER_ID_BITS
+
+
+def next_ref_code(user_id: int, ref_code: Optional[str]) -> str:
+    """
+    Код следующего поколения для пользователя с кодом ref_code.
+    Если текущий код не в текущем формате, выдаётся код нулевого поколения.
+    """
+    decoded = ref_code_to_id(ref_code) if ref_code else None
+    if decoded and decoded[0] == user_id:
+        return id_to_ref_code(user_id, decoded[1] + 1)
+    return id_to_ref_code(user_id)
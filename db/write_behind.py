@@ -0,0 +1,121 @@
+import asyncio
+import contextvars
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from db.database import AsyncSessionLocal
+
+from global_logger import logger
+
+
+class WriteBehindBuffer(ABC):
+    """
+    Основа отложенной записи: данные копятся в памяти (self._pending) и раз в interval
+    секунд или по batch_size штук (None - только по времени) пишутся одной транзакцией
+    в фоновой задаче. Подкласс задаёт, как пишется пачка (_write), а если накопленное
+    не словарь - ещё _new_pending, _pending_size и _restore.
+    Если запись не удалась, накопленное возвращается в буфер и пишется в следующий раз.
+    При остановке всё накопленное дописывается.
+    """
+
+    # Что копится - для логов
+    NAME = "pending writes"
+
+    def __init__(self, session_factory=AsyncSessionLocal, interval: float = 1.0, batch_size: Optional[int] = None):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.batch_size = batch_size
+        self.flushes = 0
+        self.flushed = 0
+        self._pending = self._new_pending()
+        # То, что пишется прямо сейчас
+        self._flushing = self._new_pending()
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _new_pending(self) -> Any:
+        return {}
+
+    def _pending_size(self, pending) -> int:
+        return len(pending)
+
+    def _restore(self, pending) -> None:
+        """
+        Возвращает в буфер то, что не удалось записать; более новые данные не затираются
+        """
+        for key, value in pending.items():
+            self._pending.setdefault(key, value)
+
+    @abstractmethod
+    async def _write(self, db, pending) -> None:
+        """
+        Пишет накопленное в открытой сессии; коммитит flush
+        """
+
+    def _added(self) -> None:
+        """
+        Вызывается подклассом после добавления в буфер: запускает фоновую запись
+        и будит её, если набралась пачка
+        """
+        if self._task is None:
+            # Пустой контекст: фоновая запись не относится к обработчику, который её запустил
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+        if self.batch_size is not None and self._pending_size(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """
+        Пишет всё накопленное. Возвращает, сколько записей записано.
+        """
+        async with self._lock:
+            size = self._pending_size(self._pending)
+            if not size:
+                return 0
+            pending, self._pending = self._pending, self._new_pending()
+            self._flushing = pending
+            try:
+                async with self.session_factory() as db:
+                    await self._write(db, pending)
+                    await db.commit()
+            except Exception as e:
+                logger.error("Failed to flush %s %s, will retry: %s", size, self.NAME, e)
+                self._restore(pending)
+                return 0
+            finally:
+                self._flushing = self._new_pending()
+            self.flushes += 1
+            self.flushed += size
+            return size
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # Фоновая запись не должна останавливаться из-за одной неудачной пачки
+                logger.exception("Unexpected error while flushing %s", self.NAME)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._pending_size(self._pending),
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+        }
+
+    async def stop(self) -> None:
+        """
+        Останавливает фоновую запись и дописывает всё накопленное
+        """
+        if self._task is not None:
+            # Под блокировкой, чтобы не прервать запись посередине
+            async with self._lock:
+                self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
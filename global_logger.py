@@ -1,26 +1,102 @@
+import atexit
+import contextvars
+import copy
+import datetime
+import json
 import logging
+import logging.handlers
+import queue
 import sys
 
+from config import LOG_LEVEL, LOG_FORMAT, LOG_FILE, LOG_ROTATION, LOG_MAX_BYTES, LOG_ROTATE_WHEN, LOG_BACKUP_COUNT
+
+# Поля, которые попадают в каждую запись лога, пока выполняется обработчик апдейта
+log_context: contextvars.ContextVar[dict] = contextvars.ContextVar("log_context", default={})
+
+
+class ContextFilter(logging.Filter):
+    """
+    Добавляет к записи user_id и handler из log_context.
+    Работает в потоке, который пишет в лог, поэтому видит контекст текущего обработчика.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = log_context.get()
+        record.user_id = context.get("user_id")
+        record.handler = context.get("handler")
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Одна запись - одна строка JSON
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "user_id": getattr(record, "user_id", None),
+            "handler": getattr(record, "handler", None),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LoopQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который в потоке event loop только подставляет аргументы в сообщение.
+    Форматирование (время, трассировки) и запись в файл и консоль делает QueueListener
+    в своём потоке.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _file_handler() -> logging.Handler:
+    if LOG_ROTATION == "time":
+        return logging.handlers.TimedRotatingFileHandler(LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    return logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+
+
 def setup_logger() -> logging.Logger:
     logger = logging.getLogger('bot')
-    logger.setLevel(logging.INFO)
-    
-    formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%H:%M:%S'
-    )
-    
+    logger.setLevel(LOG_LEVEL)
+
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(message)s',
+            datefmt='%H:%M:%S'
+        )
+
     # логи в файл
-    file_handler = logging.FileHandler('bot.log', encoding='utf-8')
+    file_handler = _file_handler()
     file_handler.setFormatter(formatter)
-    
+
     # консоль
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
-    
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    
+
+    # Сам логгер только кладёт записи в очередь, пишет их отдельный поток
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = LoopQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    # Дописываем очередь до конца при выходе из процесса
+    atexit.register(listener.stop)
+
     return logger
 
-logger = setup_logger()
\ No newline at end of file
+logger = setup_logger()
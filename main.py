@@ -1,18 +1,32 @@
 import asyncio
-from telebot.async_telebot import AsyncTeleBot
+import signal
 from telebot import types
-from config import BOT_TOKEN
-from db.database import init_models
+from config import BOT_TOKEN, UPDATES_MODE, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, UPDATE_QUEUE_SIZE, UPDATE_WORKERS, METRICS_HOST, METRICS_PORT
+from db.database import init_models, engine
 from bot.handlers import register_handlers
+from bot.webhook import run_webhook
+from bot.polling import run_polling
+from bot.state_storage import create_state_storage
+from bot.sender import RateLimitedTeleBot
+from db.read_receipts import read_receipts
+from db.registrations import registrations
+from db.rollups import rollups
+from db.retention import retention
+from bot.metrics import instrument_engine, instrument_telegram, start_metrics_server
 
 
 from global_logger import logger
 
 async def main():
     logger.info("Started the bot launch")
+    instrument_engine(engine.sync_engine)
+    instrument_telegram()
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
     await init_models()
     await create_admin_panel(0, 0)
-    bot = AsyncTeleBot(BOT_TOKEN, parse_mode='HTML')
+    # Чистка устаревших посланий и отметок активности в фоне
+    retention.start()
+    bot = RateLimitedTeleBot(BOT_TOKEN, parse_mode='HTML', state_storage=create_state_storage())
     logger.info("Registration of handlers started")
     register_handlers(bot)
     logger.info("Success!")
@@ -27,8 +41,51 @@ async def main():
     await bot.set_my_commands(commands)
     logger.info("Set the commands")
     
-    logger.info("Bot started successfully! ")
-    await bot.polling()
+    logger.info("Bot started successfully in %s mode!", UPDATES_MODE)
+    # docker stop и Ctrl+C отменяют main, чтобы finally дописал отложенные данные;
+    # без обработчика SIGTERM процесс умирал бы сразу и терял буферы
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, main_task.cancel)
+    try:
+        if UPDATES_MODE == "webhook":
+            await run_webhook(
+                bot,
+                url=WEBHOOK_URL,
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                path=WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                queue_size=UPDATE_QUEUE_SIZE,
+                workers=UPDATE_WORKERS
+            )
+        else:
+            # getUpdates не работает, пока у бота установлен вебхук
+            await bot.remove_webhook()
+            await run_polling(bot, queue_size=UPDATE_QUEUE_SIZE, workers=UPDATE_WORKERS)
+    except asyncio.CancelledError:
+        logger.info("Stop signal received, shutting down")
+    finally:
+        # Повторный сигнал во время остановки завершает процесс сразу
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+        # Сначала дописываем отложенные данные, потом сетевое: ошибка одного шага не отменяет остальные
+        shutdown = [
+            ("retention", retention.stop),
+            ("registrations", registrations.stop),
+            ("read receipts", read_receipts.stop),
+            ("stats rollups", rollups.stop),
+            # Досылаем ответы, которые ещё ждут своей очереди
+            ("outbound sender", bot.sender.stop),
+        ]
+        if metrics_runner is not None:
+            shutdown.append(("metrics server", metrics_runner.cleanup))
+        for name, stop in shutdown:
+            try:
+                await stop()
+            except Exception:
+                logger.exception("Failed to stop %s", name)
 
 async def create_admin_panel(total_earnings: int = 0, total_read_cancels_sold: int = 0):
     from db.database import AsyncSessionLocal